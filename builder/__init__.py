@@ -1,14 +1,73 @@
+"""A framework for building batch processing pipelines
 
-import util
-import dependencies
-import expanders
-import targets
-import jobs
-import build
-import execution
-
-from jobs import JobDefinition, Job, MetaJob, TimestampExpandedJob, TimestampExpandedJobDefinition
-from expanders import Expander, TimestampExpander
-from targets import LocalFileSystemTarget, GlobLocalFileSystemTarget
-from build import RuleDependencyGraph, BuildGraph, BuildManager, BuildUpdate
-from execution import ExecutionManager, ExecutionDaemon, ExecutionResult, Executor, LocalExecutor, PrintExecutor
\ No newline at end of file
+The submodules and the names exported here are imported the first time they
+are used so importing builder does not pull in networkx, tornado and the rest
+of the execution stack until they are needed.
+"""
+
+import importlib
+import sys
+import types
+
+_SUBMODULES = frozenset([
+    "util", "metrics", "tracing", "objectstore", "dependencies", "expanders",
+    "targets", "jobs", "build", "execution", "memory", "futures",
+    "benchmarks", "workers", "spawner",
+])
+
+_EXPORTS = {
+    "JobDefinition": "jobs",
+    "Job": "jobs",
+    "MetaJob": "jobs",
+    "TimestampExpandedJob": "jobs",
+    "TimestampExpandedJobDefinition": "jobs",
+    "ObjectStoreClient": "objectstore",
+    "ObjectStoreConnectionPool": "objectstore",
+    "LocalDirectoryObjectStoreClient": "objectstore",
+    "Expander": "expanders",
+    "TimestampExpander": "expanders",
+    "LocalFileSystemTarget": "targets",
+    "GlobLocalFileSystemTarget": "targets",
+    "ObjectStoreTarget": "targets",
+    "GlobObjectStoreTarget": "targets",
+    "RuleDependencyGraph": "build",
+    "BuildGraph": "build",
+    "BuildManager": "build",
+    "BuildUpdate": "build",
+    "ExecutionManager": "execution",
+    "ExecutionDaemon": "execution",
+    "ExecutionResult": "execution",
+    "Executor": "execution",
+    "LocalExecutor": "execution",
+    "PrintExecutor": "execution",
+}
+
+
+class _LazyModule(types.ModuleType):
+    """The builder package, imports submodules and exported names on first
+    access
+    """
+
+    def __getattr__(self, name):
+        if name in _EXPORTS:
+            module = importlib.import_module(__name__ + "." + _EXPORTS[name])
+            value = getattr(module, name)
+        elif name in _SUBMODULES:
+            value = importlib.import_module(__name__ + "." + name)
+        else:
+            raise AttributeError("module '{}' has no attribute '{}'".format(
+                __name__, name))
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | _SUBMODULES | set(_EXPORTS))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(
+        (k, v) for k, v in globals().iteritems() if k != "__doc__")
+# Python 2 clears the globals of a module when it is garbage collected, keep
+# the original module alive so the functions above keep working
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
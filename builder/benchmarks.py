@@ -0,0 +1,341 @@
+"""Benchmarks for graph expansion, staleness checks and execution throughput
+
+Run with
+
+    python -m builder.benchmarks --output results.json
+
+Each benchmark builds a synthetic pipeline in memory. Targets keep their
+mtimes in a dict instead of on a file system and jobs are executed by a
+no-op executor, so the results measure builder itself and not I/O. The
+results are written as json along with the commit they were run at so runs
+against different commits can be compared.
+
+Startup is measured by importing builder modules in a new interpreter
+    import_builder, import_build, import_execution: The time taken by
+        import builder, import builder.build and import builder.execution
+
+For each pipeline the following are measured
+    build_manager: Constructing the BuildManager (rule dependency graph)
+    add_job: Expanding the pipeline in to a new build graph
+    bulk_refresh_targets: Refreshing every target in the build graph
+    get_jobs_to_run: Recomputing should run for every job in the graph
+    execution: Running every job with the no-op executor, reported as jobs
+        per second
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import arrow
+
+import builder.build
+import builder.execution
+import builder.expanders
+import builder.jobs
+import builder.targets
+
+
+FILE_STEP = "5min"
+START_TIME = arrow.get("2015-01-01T00:00:00+00:00")
+
+
+class MemoryTarget(builder.targets.Target):
+    """A target whose mtime is kept in the store dict of its config"""
+
+    def do_get_mtime(self):
+        return self.config["store"].get(self.unique_id)
+
+
+class NoopExecutor(builder.execution.Executor):
+    """Executes a job by setting the mtime of all of its targets to now"""
+
+    def do_execute(self, job):
+        build_graph = self.get_build_graph()
+        now = time.time()
+        for target_id in build_graph.get_target_ids(job.get_id()):
+            target = build_graph.get_target(target_id)
+            target.config["store"][target_id] = now
+        return builder.execution.ExecutionResult(is_async=False, status=True,
+                                                 stdout="", stderr="")
+
+
+class Pipeline(object):
+    """A synthetic pipeline
+
+    args:
+        name: The name of the pipeline used in the results
+        jobs: The job definitions
+        metas: The meta targets
+        submission: The id of the job definition or meta to submit
+        build_context: The build context to submit with
+        store: The dict the targets of the pipeline keep their mtimes in
+    """
+    def __init__(self, name, jobs, metas, submission, build_context, store):
+        self.name = name
+        self.jobs = jobs
+        self.metas = metas
+        self.submission = submission
+        self.build_context = build_context
+        self.store = store
+
+    def make_build_manager(self):
+        return builder.build.BuildManager(self.jobs, self.metas)
+
+    def expand(self, build_graph):
+        build_context = dict(self.build_context)
+        if build_graph.rule_dependency_graph.is_job_definition(self.submission):
+            return build_graph.add_job(self.submission, build_context)
+        return build_graph.add_meta(self.submission, build_context)
+
+
+def _target_expander(store, unexpanded_id, past=0):
+    return builder.expanders.TimestampExpander(
+            MemoryTarget, unexpanded_id + "-target_%Y-%m-%d-%H-%M-%S", FILE_STEP,
+            past=past, config={"store": store})
+
+
+def _job(store, unexpanded_id, depends=(), past=0):
+    return builder.jobs.TimestampExpandedJobDefinition(
+            unexpanded_id, file_step=FILE_STEP,
+            targets={"produces": [_target_expander(store, unexpanded_id)]},
+            dependencies={"depends": [_target_expander(store, x, past=past)
+                                      for x in depends]})
+
+
+def _build_context(n_steps):
+    return {
+        "start_time": START_TIME,
+        "end_time": START_TIME.replace(minutes=5 * n_steps),
+    }
+
+
+def deep_chain(depth, n_steps):
+    """A chain of depth jobs, each depending on the one before it"""
+    store = {}
+    jobs = [_job(store, "chain0")]
+    for i in xrange(1, depth):
+        jobs.append(_job(store, "chain{}".format(i),
+                         depends=["chain{}".format(i - 1)]))
+    return Pipeline("deep_chain", jobs, [], jobs[-1].unexpanded_id,
+                    _build_context(n_steps), store)
+
+
+def wide_fan_in(width, n_steps):
+    """width independent jobs all depended on by a single job"""
+    store = {}
+    jobs = [_job(store, "source{}".format(i)) for i in xrange(width)]
+    jobs.append(_job(store, "sink", depends=[x.unexpanded_id for x in jobs]))
+    return Pipeline("wide_fan_in", jobs, [], "sink", _build_context(n_steps),
+                    store)
+
+
+def past_window(past, n_steps):
+    """A job that depends on past steps of the job before it"""
+    store = {}
+    jobs = [
+        _job(store, "window_source"),
+        _job(store, "window", depends=["window_source"], past=past),
+    ]
+    return Pipeline("past_window", jobs, [], "window", _build_context(n_steps),
+                    store)
+
+
+def many_metas(n_metas, jobs_per_meta, n_steps):
+    """n_metas metas each pointing at jobs_per_meta jobs, with a meta that
+    points at every meta
+    """
+    store = {}
+    jobs = []
+    metas = []
+    for i in xrange(n_metas):
+        meta_jobs = []
+        for j in xrange(jobs_per_meta):
+            unexpanded_id = "meta{}_job{}".format(i, j)
+            depends = [meta_jobs[-1].unexpanded_id] if meta_jobs else []
+            meta_jobs.append(_job(store, unexpanded_id, depends=depends))
+        jobs.extend(meta_jobs)
+        metas.append(builder.jobs.MetaTarget(
+                unexpanded_id="meta{}".format(i),
+                job_collection=[x.unexpanded_id for x in meta_jobs]))
+    metas.append(builder.jobs.MetaTarget(
+            unexpanded_id="all_metas",
+            job_collection=[x.unexpanded_id for x in jobs]))
+    return Pipeline("many_metas", jobs, metas, "all_metas",
+                    _build_context(n_steps), store)
+
+
+def get_pipelines(scale=1.0):
+    """Returns the pipelines to benchmark, scale multiplies their sizes"""
+    def scaled(value):
+        return max(int(value * scale), 1)
+    return [
+        deep_chain(scaled(50), scaled(12)),
+        wide_fan_in(scaled(200), scaled(12)),
+        past_window(scaled(288), scaled(12)),
+        many_metas(scaled(20), scaled(10), scaled(12)),
+    ]
+
+
+def _summarize(times):
+    times = sorted(times)
+    return {
+        "n": len(times),
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "max": times[-1],
+    }
+
+
+def _time(f, repeat, setup=None):
+    """Calls setup and then times f repeat times, returns a summary of the
+    times and the result of the last call to f
+    """
+    times = []
+    result = None
+    for _ in xrange(repeat):
+        argument = setup() if setup is not None else None
+        start = time.time()
+        result = f(argument) if setup is not None else f()
+        times.append(time.time() - start)
+    return _summarize(times), result
+
+
+def benchmark_pipeline(pipeline, repeat=3):
+    """Runs every benchmark against pipeline and returns the results as a
+    dict
+    """
+    results = {}
+
+    results["build_manager"], build_manager = _time(
+            pipeline.make_build_manager, repeat)
+
+    def new_build():
+        pipeline.store.clear()
+        return build_manager.make_build()
+    def expand(build_graph):
+        pipeline.expand(build_graph)
+        return build_graph
+    results["add_job"], build_graph = _time(expand, repeat, setup=new_build)
+    results["n_jobs"] = sum(1 for _ in build_graph.job_iter())
+    results["n_targets"] = sum(1 for _ in build_graph.target_iter())
+    results["n_nodes"] = len(build_graph.node)
+    results["n_edges"] = build_graph.number_of_edges()
+
+    results["bulk_refresh_targets"], _ = _time(
+            lambda: build_graph.bulk_refresh_targets(uncached_only=False),
+            repeat)
+
+    execution_manager = builder.execution.ExecutionManager(
+            build_manager, NoopExecutor)
+    pipeline.store.clear()
+    pipeline.expand(execution_manager.build)
+    execution_manager.build.bulk_refresh_targets(uncached_only=False)
+    def invalidate():
+        for _, job in execution_manager.build.job_iter():
+            job.invalidate()
+    results["get_jobs_to_run"], _ = _time(
+            lambda _: execution_manager.get_jobs_to_run(), repeat,
+            setup=invalidate)
+
+    execution_times = []
+    for _ in xrange(repeat):
+        pipeline.store.clear()
+        execution_manager = builder.execution.ExecutionManager(
+                build_manager, NoopExecutor)
+        execution_manager.running = True
+        start = time.time()
+        execution_manager.submit(pipeline.submission,
+                                 dict(pipeline.build_context))
+        execution_manager.start_execution(inline=True)
+        seconds = time.time() - start
+        execution_times.append(seconds)
+    results["execution"] = _summarize(execution_times)
+    results["execution"]["n_completed_jobs"] = execution_manager.completed_jobs
+    results["execution"]["jobs_per_second"] = (
+            execution_manager.completed_jobs / results["execution"]["median"]
+            if results["execution"]["median"] else None)
+    return results
+
+
+def benchmark_startup(repeat=3):
+    """Times importing builder modules in a new interpreter, returns the
+    results as a dict
+    """
+    results = {}
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name, module in (("import_builder", "builder"),
+                         ("import_build", "builder.build"),
+                         ("import_execution", "builder.execution")):
+        code = ("import time; start = time.time(); import {}; "
+                "print(time.time() - start)".format(module))
+        times = [float(subprocess.check_output([sys.executable, "-c", code],
+                                               cwd=cwd))
+                 for _ in xrange(repeat)]
+        results[name] = _summarize(times)
+    return results
+
+
+def get_commit():
+    """Returns the commit of the checkout builder is running from, None if
+    it is not running from a git checkout
+    """
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(
+                    ["git", "rev-parse", "HEAD"],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale=1.0, repeat=3, only=None):
+    """Runs the benchmarks and returns the results as a json serializable
+    dict
+    """
+    results = {
+        "commit": get_commit(),
+        "timestamp": arrow.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "repeat": repeat,
+        "startup": benchmark_startup(repeat),
+        "pipelines": {},
+    }
+    for pipeline in get_pipelines(scale):
+        if only and pipeline.name not in only:
+            continue
+        results["pipelines"][pipeline.name] = benchmark_pipeline(pipeline, repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", "-o", default="-",
+                        help="The file to write the json results to, - for stdout")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="The number of times to run each benchmark")
+    parser.add_argument("--scale", "-s", type=float, default=1.0,
+                        help="Multiplies the size of every pipeline")
+    parser.add_argument("--only", action="append",
+                        help="Only run the pipeline with this name, may be "
+                             "given multiple times")
+    args = parser.parse_args(argv)
+
+    results = run(scale=args.scale, repeat=args.repeat, only=args.only)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == "-":
+        print data
+    else:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+
+
+if __name__ == "__main__":
+    main()
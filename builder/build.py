@@ -3,10 +3,14 @@ and the build graph
 """
 
 import collections
+import itertools
+import json
+import numbers
 import os
 import re
 import tempfile
 import subprocess
+import threading
 import time
 import logging
 
@@ -14,10 +18,17 @@ import networkx
 
 import builder.dependencies
 import builder.jobs
+import builder.metrics
 import builder.targets
+import builder.tracing
+from builder.util import convert_to_timedelta
 
 LOG = logging.getLogger(__name__)
 
+ADD_JOB_TIME = builder.metrics.histogram(
+        "builder_add_job_seconds",
+        "Time taken to expand the build graph for a job")
+
 class BuildUpdate(object):
     """Used to contain the results of a build update.
 
@@ -31,9 +42,11 @@ class BuildUpdate(object):
         jobs: jobs that were part of the expansion
         targets: targets that were part of the expansion
         forced: jobs that are forced
+        lazy_targets: targets whose creators were not expanded because the
+            expansion was lazy
     """
     def __init__(self, new_jobs=None, new_targets=None, newly_forced=None,
-                 jobs=None, targets=None, forced=None):
+                 jobs=None, targets=None, forced=None, lazy_targets=None):
         if new_jobs is None:
             new_jobs = set()
         if new_targets is None:
@@ -46,6 +59,8 @@ class BuildUpdate(object):
             targets = set()
         if forced is None:
             forced = set()
+        if lazy_targets is None:
+            lazy_targets = set()
 
         self.new_jobs = new_jobs
         self.new_targets = new_targets
@@ -53,6 +68,7 @@ class BuildUpdate(object):
         self.jobs = jobs
         self.targets = targets
         self.forced = forced
+        self.lazy_targets = lazy_targets
 
     def merge(self, build_update):
         self.new_jobs = self.new_jobs | build_update.new_jobs
@@ -61,6 +77,7 @@ class BuildUpdate(object):
         self.jobs = self.jobs | build_update.jobs
         self.targets = self.targets | build_update.targets
         self.forced = self.forced | build_update.forced
+        self.lazy_targets = self.lazy_targets | build_update.lazy_targets
 
 class BuildManager(object):
     """A build manager holds a rule dependency graph and is then creates a new
@@ -510,6 +527,20 @@ class BuildGraph(BaseGraph):
         self.dependency_registery = dependency_registery
         self.config = config
 
+        # Incremented every time a node or edge is added
+        self.version = 0
+        # The number of nodes by kind (job, target or dependency) and of
+        # edges by their kind, kept up to date as the graph changes
+        self.node_counts = collections.Counter()
+        self.edge_counts = collections.Counter()
+        # unexpanded_id -> set of the ids of the jobs and targets expanded
+        # from it
+        self.unexpanded_id_index = collections.defaultdict(set)
+        self.query_cache = collections.OrderedDict()
+        # The ids of the jobs added since they were last taken with
+        # pop_new_job_ids
+        self.new_job_ids = set()
+
     def add_node(self, node, build_update=None, attr_dict=None, **kwargs):
         """Adds a job, target, dependency node to the graph
 
@@ -559,10 +590,135 @@ class BuildGraph(BaseGraph):
             elif self.is_target_object(node):
                 build_update.targets.add(node.unique_id)
 
+        if node.unique_id not in self:
+            self.version += 1
+            self.node_counts[self.get_node_kind(node)] += 1
+            if self.is_job_object(node) or self.is_target_object(node):
+                self.unexpanded_id_index[node.unexpanded_id].add(node.unique_id)
+            if self.is_job_object(node):
+                self.new_job_ids.add(node.unique_id)
+
         super(BuildGraph, self).add_node(node.unique_id, attr_dict=node_data)
         node = self.node[node.unique_id]["object"]
         return node
 
+    def add_edge(self, u, v, attr_dict=None, **attr):
+        """Adds an edge, see networkx.DiGraph.add_edge"""
+        if not self.has_edge(u, v):
+            self.version += 1
+            kind = attr.get("kind", (attr_dict or {}).get("kind", "unknown"))
+            self.edge_counts[kind] += 1
+        super(BuildGraph, self).add_edge(u, v, attr_dict=attr_dict, **attr)
+
+    def get_node_kind(self, node):
+        """Returns "job", "target" or "dependency" for a node object"""
+        if self.is_job_object(node):
+            return "job"
+        if self.is_target_object(node):
+            return "target"
+        return "dependency"
+
+    def remove_node(self, node_id):
+        """Removes a node and its edges, see networkx.DiGraph.remove_node"""
+        node = self.node[node_id]["object"]
+        if self.is_dependency_type_object(node):
+            for target in list(node.members):
+                node.remove_member(target)
+        elif self.is_target_object(node):
+            for dependency_node in list(node.dependency_nodes):
+                dependency_node.remove_member(node)
+        if self.is_job_object(node) or self.is_target_object(node):
+            node_ids = self.unexpanded_id_index.get(node.unexpanded_id)
+            if node_ids is not None:
+                node_ids.discard(node_id)
+                if not node_ids:
+                    del self.unexpanded_id_index[node.unexpanded_id]
+        self.new_job_ids.discard(node_id)
+        self.version += 1
+        self.node_counts[self.get_node_kind(node)] -= 1
+        for edge_data in itertools.chain(self.succ[node_id].itervalues(),
+                                         self.pred[node_id].itervalues()):
+            self.edge_counts[edge_data.get("kind", "unknown")] -= 1
+        super(BuildGraph, self).remove_node(node_id)
+
+    def pop_new_job_ids(self):
+        """Returns the ids of the jobs added since the last call"""
+        new_job_ids = self.new_job_ids
+        self.new_job_ids = set()
+        return new_job_ids
+
+    def get_ids_from_unexpanded_id(self, unexpanded_id):
+        """Returns the set of the ids of the jobs and targets in the graph
+        that were expanded from unexpanded_id
+        """
+        return self.unexpanded_id_index.get(unexpanded_id, set())
+
+    def is_prunable(self, job_id, older_than):
+        """Returns whether or not the job can be removed from the graph
+
+        A job can be removed if the end time (or the start time if there is
+        no end time) of its build context is before older_than, it is not
+        running, it does not need to run and none of the jobs that depend on
+        its targets are running or need to run.
+
+        Only the cached should_run and stale state is read so that pruning
+        never recomputes state or checks targets. A job whose state has not
+        been computed may need to run and is not prunable.
+        """
+        job = self.get_job(job_id)
+        build_context = job.build_context or {}
+        end_time = build_context.get("end_time") or build_context.get("start_time")
+        if end_time is None or end_time >= older_than:
+            return False
+        if job.get_force() or not self._is_settled(job):
+            return False
+        for target_id in self.get_target_ids_iter(job_id):
+            for dependent_id in self.get_dependent_ids_iter(target_id):
+                if not self._is_settled(self.get_job(dependent_id)):
+                    return False
+        return True
+
+    @staticmethod
+    def _is_settled(job):
+        """Returns whether the job is not running and its cached state says
+        it does not need to run
+        """
+        if job.is_running or job.force:
+            return False
+        return job.should_run is False or job.stale is False
+
+    def prune_job(self, job_id):
+        """Removes the job, its dependency nodes and any of its targets and
+        dependencies that are not connected to another job
+
+        The targets that are kept are marked as not expanded in the direction
+        of the job so the job is expanded again if it is needed later.
+
+        Returns:
+            The set of the ids of the nodes that were removed
+        """
+        target_ids = set(self.get_target_ids_iter(job_id))
+        dependency_ids = set(self.get_dependency_ids_iter(job_id))
+        dependency_node_ids = [x for x in self.predecessors_iter(job_id)
+                               if self.is_dependency_type(x)]
+
+        removed_ids = set()
+        for node_id in dependency_node_ids + [job_id]:
+            self.remove_node(node_id)
+            removed_ids.add(node_id)
+
+        for target_id in target_ids | dependency_ids:
+            if not self.in_degree(target_id) and not self.out_degree(target_id):
+                self.remove_node(target_id)
+                removed_ids.add(target_id)
+                continue
+            target = self.get_target(target_id)
+            if target_id in target_ids:
+                target.expanded_directions["up"] = False
+            if target_id in dependency_ids:
+                target.expanded_directions["down"] = False
+        return removed_ids
+
     def is_dependency_type_object(self, dependency_type):
         """Returns true if the object passed in is a dependnecy type object"""
         return isinstance(dependency_type, builder.dependencies.Dependency)
@@ -909,12 +1065,12 @@ class BuildGraph(BaseGraph):
             node.unique_id, dependency_type.func_name,
             "_".join([x.unique_id for x in dependencies]))
 
-        dependency = builder.dependencies.Dependency(dependency_type,
-                                                     dependency_node_id,
-                                                     dependency_type.func_name)
+        dependency_node = builder.dependencies.Dependency(
+                dependency_type, dependency_node_id, dependency_type.func_name,
+                job=node)
 
         # self.add_node(dependency, build_update, label=dependency_type.func_name)
-        self.add_node(dependency, build_update)
+        dependency_node = self.add_node(dependency_node, build_update)
 
         self.add_edge(dependency_node_id, node.unique_id, data,
                       label=dependency_type.func_name,
@@ -922,6 +1078,8 @@ class BuildGraph(BaseGraph):
 
         for dependency in dependencies:
             dependency = self.add_node(dependency, build_update)
+            if not self.has_edge(dependency.unique_id, dependency_node_id):
+                dependency_node.add_member(dependency)
             self.add_edge(dependency.unique_id, dependency_node_id, data,
                           label=dependency_type.func_name,
                           kind=dependency_type.func_name)
@@ -974,7 +1132,8 @@ class BuildGraph(BaseGraph):
 
     def _self_expand_next_direction(self, expanded_directions, depth,
                                     current_depth, build_update, cache_set,
-                                    direction, directions_to_recurse):
+                                    direction, directions_to_recurse,
+                                    lazy=False):
         """Expands out the next job nodes
 
         Args:
@@ -985,6 +1144,8 @@ class BuildGraph(BaseGraph):
             cache_set: A set of jobs that have already been expanded
             direction: The direction that the next nodes sould be in relation to
                 the current
+            lazy: Whether or not the dependencies of the next nodes should be
+                expanded lazily
         """
         next_nodes = []
         for expanded_direction in expanded_directions:
@@ -1019,11 +1180,56 @@ class BuildGraph(BaseGraph):
         # continue expanding in the direction given
         for next_node in next_nodes:
             self._self_expand(next_node, directions_to_recurse, depth, current_depth,
-                              build_update, cache_set)
+                              build_update, cache_set, lazy=lazy)
         return next_nodes
 
+    def _defer_expansion(self, targets, build_update):
+        """Returns the targets whose creators should be expanded now during a
+        lazy expansion
+
+        Targets that are already expanded up or that are not created by any
+        job definition are expanded as usual. The rest are left in the graph
+        without their creators and added to build_update.lazy_targets.
+        """
+        expand_now = []
+        for target in targets:
+            if self.is_deferred_target(target):
+                build_update.lazy_targets.add(target.unique_id)
+            else:
+                expand_now.append(target)
+        return expand_now
+
+    def is_deferred_target(self, target):
+        """Returns True if target has creators that were left unexpanded by a
+        lazy expansion
+        """
+        return (not target.expanded_directions["up"] and
+                bool(self.rule_dependency_graph.get_dependents_or_creators(
+                    target.unexpanded_id, "up")))
+
+    def expand_lazy_targets(self, target_ids, lazy=True):
+        """Expands the creators of targets that were left unexpanded by a
+        lazy expansion
+
+        Args:
+            target_ids: The ids of the targets to expand the creators of
+            lazy: Whether or not the dependencies of the creators should be
+                expanded lazily
+
+        Returns:
+            A BuildUpdate of the nodes that were expanded
+        """
+        build_update = BuildUpdate()
+        targets = [self.get_target(x) for x in target_ids]
+        targets = [x for x in targets if not x.expanded_directions["up"]]
+        self._self_expand_next_direction(targets, None, 0, build_update, set(),
+                                         "up", set(["up"]), lazy=lazy)
+        return build_update
 
-    def _self_expand(self, job, direction, depth, current_depth, build_update, cache_set):
+
+    @builder.tracing.traced("BuildGraph._self_expand")
+    def _self_expand(self, job, direction, depth, current_depth, build_update, cache_set,
+                     lazy=False):
         """Input a node to expand and a build_context, magic ensues
 
         The node should already be an expanded node. It then expands out the
@@ -1036,6 +1242,8 @@ class BuildGraph(BaseGraph):
             current_depth: the depth that the branch is in
             build_update: the BuildUpdate to hold all the values relating to the
                 current update
+            lazy: If True the creators of the job's dependencies are not
+                expanded, see _defer_expansion
         """
         if job.unique_id in cache_set:
             return
@@ -1055,18 +1263,21 @@ class BuildGraph(BaseGraph):
         expanded_nodes = []
         if "up" in direction:
             new_direction = set(["up"])
+            if lazy:
+                expanded_dependencies = self._defer_expansion(
+                        expanded_dependencies, build_update)
             expanded_nodes += self._self_expand_next_direction(
                     expanded_dependencies, depth, current_depth, build_update,
-                    cache_set, "up", new_direction)
+                    cache_set, "up", new_direction, lazy=lazy)
         if "down" in direction:
             expanded_nodes += self._self_expand_next_direction(
                     expanded_targets, depth, current_depth, build_update,
-                    cache_set, "down", direction)
+                    cache_set, "down", direction, lazy=lazy)
         return expanded_nodes
 
 
     def add_meta(self, new_meta, build_context, direction=None, depth=None,
-                 force=False):
+                 force=False, lazy=False):
         """Adds in a specific meta and expands it using the expansion strategy
 
         Args:
@@ -1083,13 +1294,15 @@ class BuildGraph(BaseGraph):
         for job in jobs:
             build_update.merge(self.add_job(job, build_context,
                                             direction=direction,
-                                            depth=depth, force=force))
+                                            depth=depth, force=force,
+                                            lazy=lazy))
 
         return build_update
 
 
+    @builder.tracing.traced("BuildGraph.add_job")
     def add_job(self, job_definition_id, build_context, direction=None, depth=None,
-                force=False):
+                force=False, lazy=False):
         """Adds in a specific job and expands it using the expansion strategy
 
         Args:
@@ -1098,6 +1311,12 @@ class BuildGraph(BaseGraph):
             direction: the direction to expand the graph
             depth: the number of job nodes deep to expand
             force: whether or not to force the new job
+            lazy: whether or not to leave the creators of the dependencies
+                unexpanded. The dependencies are returned in lazy_targets and
+                their creators can be expanded later with
+                expand_lazy_targets if they turn out to be needed. A lazy
+                dependency that exists is an input, changes further up are
+                not seen until it is updated or deleted
 
         Returns:
             A list of ids of nodes that are new to the graph during the adding
@@ -1121,7 +1340,7 @@ class BuildGraph(BaseGraph):
         cache_set = set()
         for expanded_job in expanded_jobs:
             self._self_expand(expanded_job, direction, depth, current_depth,
-                              build_update, cache_set)
+                              build_update, cache_set, lazy=lazy)
             if force:
                 job_id = expanded_job.get_id()
                 job = self.get_job(job_id)
@@ -1130,6 +1349,7 @@ class BuildGraph(BaseGraph):
                 build_update.forced.add(job_id)
                 job.set_force(True)
         stop = time.time()
+        ADD_JOB_TIME.observe(stop - start)
         LOG.debug("It took {} seconds to expand the build graph".format((stop - start)))
         return build_update
 
@@ -1207,90 +1427,403 @@ class BuildGraph(BaseGraph):
             if self.is_target(node_id):
                 yield node_id, self.get_target(node_id)
 
-    def bulk_refresh_targets(self, uncached_only=True):
+    def bulk_refresh_targets(self, uncached_only=True, max_age=None):
         """
         Refresh all target existences in bulk.
 
+        The targets are filtered before anything is fetched so the cost of a
+        refresh is proportional to the number of targets that need it. The
+        target types are refreshed concurrently, see
+        builder.targets.get_bulk_exists_mtime_parallel. The config values
+        bulk_refresh_workers and bulk_refresh_chunk_size control the pool.
+
         uncached_only: Only refresh targets that have no cached value for existence
+        max_age: Only refresh targets that have no cached value or whose
+            cached value was retrieved longer than max_age ago. Either a
+            number of seconds or anything convert_to_timedelta accepts.
+            Takes precedence over uncached_only.
+
+        Returns:
+            A dict of the form {target_type: seconds} holding how long each
+            type took to refresh
         """
         LOG.debug("Bulk refreshing existence")
-        type_target_map = collections.defaultdict(list)
-        for target_id, target in self.target_iter():
-            type_target_map[type(target)].append(target)
-
-        touched_target_ids = []
-        for target_type, targets in type_target_map.iteritems():
-            LOG.debug("Refreshing {} targets of type {}".format(len(targets), target_type))
-            exists_map = target_type.get_bulk_exists_mtime(targets)
-            for target_id, state in exists_map.iteritems():
-                target = self.get_target(target_id)
-                if target.is_cached() and uncached_only:
-                    continue
-                touched_target_ids.append(target_id)
+        if max_age is not None:
+            if not isinstance(max_age, numbers.Number):
+                max_age = convert_to_timedelta(max_age).total_seconds()
+            now = time.time()
+            targets = []
+            for _, target in self.target_iter():
+                cache_age = target.get_cache_age(now)
+                if cache_age is None or cache_age > max_age:
+                    targets.append(target)
+        elif uncached_only:
+            targets = [target for _, target in self.target_iter()
+                       if not target.is_cached()]
+        else:
+            targets = [target for _, target in self.target_iter()]
+
+        LOG.debug("Refreshing {} targets".format(len(targets)))
+        exists_map, timings = builder.targets.get_bulk_exists_mtime_parallel(
+                targets,
+                max_workers=self.config.get("bulk_refresh_workers", 4),
+                chunk_size=self.config.get("bulk_refresh_chunk_size"))
+
+        for target in targets:
+            state = exists_map.get(target.unique_id)
+            if state is not None:
                 target.set_mtime(state['mtime'])
+        return timings
+
+
+class JobSnapshot(object):
+    """A read only copy of the state of a job
+
+    Only the values the job had cached are copied, nothing is recomputed.
+    A value of None means that the job had not computed it yet.
+    """
+    __slots__ = ("unique_id", "unexpanded_id", "build_context", "stale",
+                 "buildable", "should_run", "parents_should_run", "failed",
+                 "retries", "force", "always_force", "is_running", "last_run")
+
+    def __init__(self, job):
+        self.unique_id = job.unique_id
+        self.unexpanded_id = job.unexpanded_id
+        self.build_context = job.build_context
+        self.stale = job.stale
+        self.buildable = job.buildable
+        self.should_run = job.should_run
+        self.parents_should_run = job.parents_should_run
+        self.failed = job.failed
+        self.retries = job.retries
+        self.force = job.force
+        self.always_force = job.job.get_always_force()
+        self.is_running = job.is_running
+        self.last_run = job.last_run
+
+    def __repr__(self):
+        return "{}:{}".format(self.unexpanded_id, self.unique_id)
+
+    def get_id(self):
+        return self.unique_id
+
+    def get_stale(self):
+        return self.stale
+
+    def get_buildable(self):
+        return self.buildable
+
+    def get_failed(self):
+        return self.failed
+
+    def get_force(self):
+        return self.force
+
+    def get_parents_should_run(self):
+        return self.parents_should_run
+
+    def get_should_run_immediate(self):
+        if self.force or self.always_force:
+            return True
+        if self.failed:
+            return False
+        return self.should_run
+
+    def get_should_run(self):
+        if self.force:
+            return True
+        if self.parents_should_run:
+            return False
+        return self.get_should_run_immediate()
+
+
+class TargetSnapshot(object):
+    """A read only copy of the cached state of a target"""
+    __slots__ = ("unique_id", "unexpanded_id", "build_context",
+                 "cached_mtime", "mtime")
+
+    def __init__(self, target):
+        self.unique_id = target.unique_id
+        self.unexpanded_id = target.unexpanded_id
+        self.build_context = target.build_context
+        self.cached_mtime = target.cached_mtime
+        self.mtime = target.mtime
+
+    def __repr__(self):
+        return "TargetSnapshot({}, {}, mtime={}, cached={})".format(
+            self.unexpanded_id, self.unique_id, self.mtime, self.cached_mtime)
+
+    def get_id(self):
+        return self.unique_id
+
+    def is_cached(self):
+        return self.cached_mtime
+
+    def get_mtime(self):
+        if not self.cached_mtime:
+            return None
+        return self.mtime
+
+    def get_exists(self):
+        return self.get_mtime() is not None
+
+
+class BuildGraphSnapshot(BuildGraph):
+    """A read only copy of a build graph at a particular version
+
+    The structure of the graph is copied and every job and target is
+    replaced by a JobSnapshot or TargetSnapshot so that readers never see
+    the graph change underneath them and never trigger any recomputation of
+    state. Edge data dicts are shared with the original graph.
+
+    Use from_build_graph while holding whatever lock protects the build
+    graph, everything after that is safe without the lock.
+    """
+    def __init__(self, rule_dependency_graph=None, dependency_registery=None,
+                 config=None, version=None):
+        super(BuildGraphSnapshot, self).__init__(
+                rule_dependency_graph=rule_dependency_graph,
+                dependency_registery=dependency_registery,
+                config=config)
+        self.version = version
+
+    def add_edge(self, *args, **kwargs):
+        raise RuntimeError("A build graph snapshot is read only")
+
+    @classmethod
+    def from_build_graph(cls, build_graph, version=None):
+        """Copies the build graph in to a new snapshot"""
+        snapshot = cls(build_graph.rule_dependency_graph,
+                       dependency_registery=build_graph.dependency_registery,
+                       config=build_graph.config, version=version)
+
+        snapshot_node = snapshot.node
+        for node_id, node_data in build_graph.node.iteritems():
+            node = node_data["object"]
+            node_data = dict(node_data)
+            if build_graph.is_job_object(node):
+                node_data["object"] = JobSnapshot(node)
+            elif build_graph.is_target_object(node):
+                node_data["object"] = TargetSnapshot(node)
+            snapshot_node[node_id] = node_data
+
+        for node_id, neighbors in build_graph.succ.iteritems():
+            snapshot.succ[node_id] = dict(neighbors)
+        for node_id, neighbors in build_graph.pred.iteritems():
+            snapshot.pred[node_id] = dict(neighbors)
+        for unexpanded_id, node_ids in build_graph.unexpanded_id_index.iteritems():
+            snapshot.unexpanded_id_index[unexpanded_id] = set(node_ids)
+        snapshot.node_counts = collections.Counter(build_graph.node_counts)
+        snapshot.edge_counts = collections.Counter(build_graph.edge_counts)
+        return snapshot
+
+    def is_job_object(self, job):
+        return isinstance(job, (JobSnapshot, builder.jobs.Job))
+
+    def is_target_object(self, target):
+        return isinstance(target, (TargetSnapshot, builder.targets.Target))
+
+    def add_job(self, *args, **kwargs):
+        raise RuntimeError("A build graph snapshot is read only")
+
+    def add_meta(self, *args, **kwargs):
+        raise RuntimeError("A build graph snapshot is read only")
+
+    def remove_node(self, *args, **kwargs):
+        raise RuntimeError("A build graph snapshot is read only")
+
+
+# Numbered or named backreferences and global inline flags such as (?i)
+_UNCOMBINABLE_EXPR = re.compile(r"\\[1-9]|\(\?P=|\(\?[iLmsux]+\)")
+
+
+class _AnyPattern(object):
+    """Matches a string if any of the compiled patterns match it"""
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def match(self, string):
+        for pattern in self.patterns:
+            match = pattern.match(string)
+            if match is not None:
+                return match
+        return None
 
 
 class BuildQuery(object):
+    """Selects jobs and targets from a build graph
+
+    The query is a dict with the following optional keys
+        job_definition_ids: select the jobs expanded from these job
+            definitions
+        expander_ids: select the targets expanded from these expanders
+        includes: select nodes whose id matches one of these regexes
+        excludes: do not select nodes whose id matches one of these regexes
+        include_neighbors: also select the jobs and targets next to the
+            selected ones
+
+    job_definition_ids and expander_ids are answered from the graph's
+    unexpanded id index, the regexes are combined in to a single regex each
+    where that does not change what they match.
+    The results of get_selected_ids are cached on the graph keyed by the
+    query and the graph's version.
+    """
+    cache_size = 16
+    _cache_lock = threading.Lock()
 
     def __init__(self, build_graph, query):
         self.build_graph = build_graph
         self.query = query
-        self.include_predicates = []
-        self.exclude_predicates = []
         self.include_neighbors = query.get('include_neighbors')
 
-        # Build predicates
-        job_definition_ids = query.get('job_definition_ids') or []
-        expander_ids = query.get('expander_ids') or []
+        self.job_definition_ids = set(query.get('job_definition_ids') or [])
+        self.expander_ids = set(query.get('expander_ids') or [])
         includes = query.get('includes') or []
         excludes = query.get('excludes') or []
 
-        include_patterns = []
-        exclude_patterns = []
-        for include in includes:
-            try:
-                include_patterns.append(re.compile(include))
-            except re.error:
-                LOG.warn("Invalid include expression: '{}'".format(include))
-        for exclude in excludes:
+        self.include_pattern = self._combine_patterns(includes, "include")
+        self.exclude_pattern = self._combine_patterns(excludes, "exclude")
+
+        self.has_includes = bool(self.job_definition_ids or
+                                 self.expander_ids or includes)
+        self.match_all = not self.has_includes and not excludes
+
+        self.cache_key = (
+            tuple(sorted(self.job_definition_ids)),
+            tuple(sorted(self.expander_ids)),
+            tuple(includes),
+            tuple(excludes),
+            bool(self.include_neighbors),
+        )
+
+    @staticmethod
+    def _combine_patterns(patterns, kind):
+        """Returns a single compiled regex matching any of the valid
+        patterns, or None if there are no patterns
+
+        Patterns with backreferences or global flags change meaning when
+        they are joined with others, those and any set of patterns that does
+        not compile once joined (e.g. two groups with the same name) are
+        matched one at a time instead.
+        """
+        valid_patterns = []
+        for pattern in patterns:
             try:
-                exclude_patterns.append(re.compile(exclude))
+                valid_patterns.append(re.compile(pattern))
             except re.error:
-                LOG.warn("Invalid exclude expression: '{}'".format(include))
+                LOG.warn("Invalid {} expression: '{}'".format(kind, pattern))
+        if not patterns:
+            return None
+        # A query with only invalid patterns matches nothing
+        if not valid_patterns:
+            return re.compile("(?!)")
+        if len(valid_patterns) == 1:
+            return valid_patterns[0]
+        if any(_UNCOMBINABLE_EXPR.search(x.pattern) for x in valid_patterns):
+            return _AnyPattern(valid_patterns)
+        try:
+            return re.compile("|".join("(?:{})".format(x.pattern)
+                                       for x in valid_patterns))
+        except re.error:
+            return _AnyPattern(valid_patterns)
+
+    def _matches_include(self, node_id):
+        if self.include_pattern is not None and self.include_pattern.match(node_id):
+            return True
+        if self.job_definition_ids and self.build_graph.is_job(node_id):
+            return self.build_graph.get_job(node_id).unexpanded_id in self.job_definition_ids
+        if self.expander_ids and self.build_graph.is_target(node_id):
+            return self.build_graph.get_target(node_id).unexpanded_id in self.expander_ids
+        return False
 
-        if job_definition_ids:
-            job_definition_ids = set(job_definition_ids)
-            self.include_predicates.append(
-                lambda x: self.build_graph.is_job(x) and self.build_graph.get_job(x).unexpanded_id in job_definition_ids)
+    def _matches_exclude(self, node_id):
+        return (self.exclude_pattern is not None and
+                self.exclude_pattern.match(node_id) is not None)
 
-        if expander_ids:
-            expander_ids = set(expander_ids)
-            self.include_predicates.append(
-                lambda x: self.build_graph.is_target(x) and self.build_graph.get_target(x).unexpanded_id in expander_ids)
+    def include_node(self, node_id):
+        if self.match_all:
+            return True
+        if self.has_includes and not self._matches_include(node_id):
+            return False
+        return not self._matches_exclude(node_id)
 
-        if includes:
-            self.include_predicates.append(lambda x: any([bool(p.match(x)) for p in include_patterns]))
+    def _get_candidate_ids(self):
+        """Returns the ids that could be selected by the query
 
-        if excludes:
-            self.exclude_predicates.append(lambda x: any([bool(p.match(x)) for p in exclude_patterns]))
+        When the query only selects by job definition or expander the
+        candidates come from the index, otherwise every node is a candidate
+        """
+        if self.include_pattern is not None or not self.has_includes:
+            return self.build_graph.node.iterkeys()
+
+        candidate_ids = set()
+        for job_definition_id in self.job_definition_ids:
+            for node_id in self.build_graph.get_ids_from_unexpanded_id(job_definition_id):
+                if self.build_graph.is_job(node_id):
+                    candidate_ids.add(node_id)
+        for expander_id in self.expander_ids:
+            for node_id in self.build_graph.get_ids_from_unexpanded_id(expander_id):
+                if self.build_graph.is_target(node_id):
+                    candidate_ids.add(node_id)
+        return candidate_ids
+
+    def _select_ids(self):
+        build_graph = self.build_graph
+        jobs, targets, links = set(), set(), set()
 
-        if len(self.include_predicates) == 0 and len(self.exclude_predicates) == 0:
-            self.match_all = True
-        else:
-            self.match_all = False
+        for node_id in self._get_candidate_ids():
+            if not self.include_node(node_id):
+                continue
+            if build_graph.is_target(node_id):
+                targets.add(node_id)
+                if self.include_neighbors:
+                    jobs.update(build_graph.get_creator_ids(node_id))
+                    jobs.update(build_graph.get_dependent_ids(node_id))
+            elif build_graph.is_job(node_id):
+                jobs.add(node_id)
+                if self.include_neighbors:
+                    targets.update(build_graph.get_dependency_ids(node_id))
+                    targets.update(build_graph.get_target_ids(node_id))
+            elif build_graph.is_dependency_type(node_id):
+                links.add(node_id)
 
-        if len(self.include_predicates) == 0:
-            self.include_predicates.append(lambda x: True)
+        return frozenset(jobs), frozenset(targets), frozenset(links)
 
-        if len(self.exclude_predicates) == 0:
-            self.exclude_predicates.append(lambda x: False)
+    def _get_cached(self, kind, compute):
+        """Returns the result of compute for the query and the current
+        version of the graph, computing it only if it is not in the graph's
+        query cache
+        """
+        build_graph = self.build_graph
+        key = (kind, self.cache_key, build_graph.version)
+        with self._cache_lock:
+            result = build_graph.query_cache.get(key)
+        if result is not None:
+            return result
+
+        result = compute()
+        with self._cache_lock:
+            build_graph.query_cache[key] = result
+            while len(build_graph.query_cache) > self.cache_size:
+                build_graph.query_cache.popitem(last=False)
+        return result
+
+    def get_selected_ids(self):
+        """Returns a tuple of frozensets of the form
+        (job_ids, target_ids, dependency_ids) selected by the query
+        """
+        return self._get_cached("selected", self._select_ids)
 
+    def _sort_ids(self):
+        job_ids, target_ids, _ = self.get_selected_ids()
+        return tuple(sorted(job_ids)) + tuple(sorted(target_ids))
 
-    def include_node(self, node_id):
-        if self.match_all:
-            return True
-        else:
-            return any([p(node_id) for p in self.include_predicates]) and not any([p(node_id) for p in self.exclude_predicates])
+    def get_sorted_ids(self):
+        """Returns a tuple of the selected job ids sorted by id followed by
+        the selected target ids sorted by id
+        """
+        return self._get_cached("sorted", self._sort_ids)
 
 
 class BuildGraphTransformer(object):
@@ -1304,40 +1837,160 @@ class BuildGraphTransformer(object):
         data = self._convert_graph_to_json_and_update(include_edges=include_edges, query=build_query)
         return data
 
-    def write_dot(self, output, build_query=None):
-        if isinstance(output, str):
-            output = open(output, 'w')
+    def iter_json_records(self, build_query=None, include_edges=False,
+                          fields=None, offset=0, limit=None):
+        """Returns an iterator over one json serializable dict per selected
+        job and target
 
+        Jobs come first and then targets, each sorted by id, so the order is
+        stable for pagination. The sorted ids are cached with the query's
+        selection so each page only slices them. The state of a node is
+        only computed when the node is in the requested page.
+
+        Args:
+            build_query: The query selecting the nodes
+            include_edges: Include the ids of the neighboring nodes
+            fields: The state fields to include, all of them if None. See
+                JOB_FIELDS and TARGET_FIELDS
+            offset: The number of records to skip
+            limit: The maximum number of records to return, None for all
+
+        Each record has the form
+            {
+                "id": "node_id",
+                "kind": "job" or "target",
+                "unexpanded_id": "unexpanded_id",
+                "field1": value,
+                ...
+            }
+        """
         build_query = self._get_build_query(build_query)
-        job_ids, target_ids, dependency_ids = self._get_selected_ids(build_query)
+        node_ids = build_query.get_sorted_ids()
+        stop = None if limit is None else offset + limit
+        for node_id in node_ids[offset:stop]:
+            yield self._get_json_record(node_id, include_edges, fields)
+
+    def iter_ndjson(self, build_query=None, include_edges=False, fields=None,
+                    offset=0, limit=None):
+        """Returns an iterator over the records of iter_json_records
+        serialized as newline delimited json
+        """
+        for record in self.iter_json_records(build_query, include_edges,
+                                             fields, offset, limit):
+            yield json.dumps(record) + "\n"
 
-        # Update selected nodes
-        for job_id in job_ids:
-            job = self.build_graph.get_job(job_id)
-            state = self._get_job_state(job)
-            self.build_graph.node[job_id].update(state)
-        for target_id in target_ids:
-            target = self.build_graph.get_target(target_id)
-            state = self._get_target_state(target)
-            self.build_graph.node[target_id].update(state)
+    def count_selected(self, build_query=None):
+        """Returns the number of jobs and targets selected by the query"""
+        build_query = self._get_build_query(build_query)
+        job_ids, target_ids, _ = self._get_selected_ids(build_query)
+        return len(job_ids) + len(target_ids)
+
+    JOB_FIELDS = {
+        "should_run": lambda job: job.get_should_run(),
+        "should_run_immediate": lambda job: job.get_should_run_immediate(),
+        "stale": lambda job: job.get_stale(),
+        "buildable": lambda job: job.get_buildable(),
+        "failed": lambda job: job.failed,
+        "retries": lambda job: job.retries,
+    }
 
-        # Get subgraph from selection
-        selected_nodes = tuple(job_ids) + tuple(target_ids) + tuple(dependency_ids)
-        subgraph = self.build_graph.subgraph(selected_nodes)
-        #subgraph = self.build_graph
+    TARGET_FIELDS = {
+        "exists": lambda target: (target.get_exists()
+                                  if target.cached_mtime else None),
+        "mtime": lambda target: (target.get_mtime()
+                                 if target.cached_mtime else None),
+    }
 
-        # Write dot
-        networkx.write_dot(subgraph, output)
+    def _get_json_record(self, node_id, include_edges, fields):
+        if self.build_graph.is_job(node_id):
+            node = self.build_graph.get_job(node_id)
+            kind = "job"
+            getters = self.JOB_FIELDS
+        else:
+            node = self.build_graph.get_target(node_id)
+            kind = "target"
+            getters = self.TARGET_FIELDS
+
+        record = {
+            "id": node_id,
+            "kind": kind,
+            "unexpanded_id": node.unexpanded_id,
+        }
+        for field, getter in getters.iteritems():
+            if fields is None or field in fields:
+                record[field] = getter(node)
+
+        if include_edges:
+            if kind == "job":
+                record["targets"] = self.build_graph.get_target_ids(node_id)
+                record["dependencies"] = self.build_graph.get_dependency_ids(node_id)
+            else:
+                record["creators"] = self.build_graph.get_creator_ids(node_id)
+                record["dependents"] = self.build_graph.get_dependent_ids(node_id)
+        return record
+
+    @staticmethod
+    def _quote_dot(value):
+        if isinstance(value, bool):
+            value = str(value).lower()
+        elif not isinstance(value, basestring):
+            value = str(value)
+        return u'"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+    @classmethod
+    def _format_dot_attributes(cls, attributes):
+        formatted = []
+        for key, value in sorted(attributes.iteritems()):
+            if value is None or not isinstance(value, (basestring, numbers.Number)):
+                continue
+            formatted.append(u"{}={}".format(key, cls._quote_dot(value)))
+        if not formatted:
+            return u""
+        return u" [{}]".format(", ".join(formatted))
 
-        return job_ids, target_ids, dependency_ids
+    def iter_dot(self, build_query=None):
+        """Returns an iterator over the lines of the dot representation of the
+        selected subgraph
+
+        Jobs and targets are colored by their current state. The graph itself
+        is not modified so this is safe to run against a shared snapshot.
+        """
+        build_query = self._get_build_query(build_query)
+        job_ids, target_ids, dependency_ids = self._get_selected_ids(build_query)
+        selected_ids = job_ids | target_ids | dependency_ids
+
+        yield u"strict digraph  {\n"
+        for node_id in sorted(selected_ids):
+            attributes = dict(self.build_graph.node[node_id])
+            if node_id in job_ids:
+                attributes.update(self._get_job_state(self.build_graph.get_job(node_id)))
+            elif node_id in target_ids:
+                attributes.update(self._get_target_state(self.build_graph.get_target(node_id)))
+            yield u"{}{};\n".format(self._quote_dot(node_id),
+                                     self._format_dot_attributes(attributes))
+        for node_id in sorted(selected_ids):
+            for neighbor_id, attributes in sorted(self.build_graph.succ[node_id].iteritems()):
+                if neighbor_id not in selected_ids:
+                    continue
+                yield u"{} -> {}{};\n".format(self._quote_dot(node_id),
+                                               self._quote_dot(neighbor_id),
+                                               self._format_dot_attributes(attributes))
+        yield u"}\n"
+
+    def write_dot(self, output, build_query=None):
+        """Writes the dot representation of the selected subgraph to output,
+        a file name or a file like object
+        """
+        if isinstance(output, basestring):
+            with open(output, 'w') as f:
+                return self.write_dot(f, build_query)
+
+        for line in self.iter_dot(build_query):
+            output.write(line.encode('utf-8'))
 
 
     def to_dot(self, build_query=None):
-        tf = tempfile.TemporaryFile()
-        self.write_dot(tf, build_query)
-        tf.seek(0)
-        data = tf.read()
-        return data
+        return u"".join(self.iter_dot(build_query)).encode('utf-8')
 
 
     def _get_target_state(self, target):
@@ -1359,23 +2012,34 @@ class BuildGraphTransformer(object):
 
 
     def _get_job_state(self, job):
+        """Returns the state of the job with its dot colors
+
+        The state is "unknown" when should_run or stale is None, which is
+        the case for a JobSnapshot of a job that was never evaluated.
+        """
+        should_run = job.get_should_run()
+        stale = job.get_stale()
         value = {
-            'should_run': job.get_should_run(),
+            'should_run': should_run,
             'should_run_immediate': job.get_should_run_immediate(),
-            'stale': job.get_stale(),
+            'stale': stale,
             'buildable': job.get_buildable(),
             'failed': job.failed,
             'retries': job.retries
         }
 
         # Update color for dot purposes
-        if (job.get_should_run() and job.get_stale()):
+        if should_run is None or stale is None:
+            value["state"] = "unknown"
+            value["fillcolor"] = "#FFFFFF"
+        elif should_run and stale:
+            value["state"] = "should_run"
             value["fillcolor"] = "#F4FA58"
-        elif not job.get_should_run() and not job.get_stale():
+        elif not should_run and not stale:
+            value["state"] = "up_to_date"
             value["fillcolor"] = "#2E9AFE"
-        elif not job.get_should_run() and not job.get_buildable():
-            value["fillcolor"] = "#D8D8D8"
         else:
+            value["state"] = "waiting"
             value["fillcolor"] = "#D8D8D8"
         value["style"] = "filled"
         return value
@@ -1391,31 +2055,7 @@ class BuildGraphTransformer(object):
 
 
     def _get_selected_ids(self, query):
-        jobs, targets, links = set(), set(), set()
-
-        # Filter based on query params
-        for node_id, node_data in self.build_graph.node.items():
-            include_node = query.include_node(node_id)
-            if not include_node:
-                continue
-            if self.build_graph.is_target(node_id):
-                targets.add(node_id)
-                if query.include_neighbors:
-                    creators = self.build_graph.get_creator_ids(node_id)
-                    dependents = self.build_graph.get_dependent_ids(node_id)
-                    jobs.update(creators)
-                    jobs.update(dependents)
-            elif self.build_graph.is_job(node_id):
-                jobs.add(node_id)
-                if query.include_neighbors:
-                    dependencies = self.build_graph.get_dependency_ids(node_id)
-                    target_ids = self.build_graph.get_target_ids(node_id)
-                    targets.update(dependencies)
-                    targets.update(target_ids)
-            elif self.build_graph.is_dependency_type(node_id):
-                links.add(node_id)
-
-        return jobs, targets, links
+        return query.get_selected_ids()
 
 
     def _convert_graph_to_json_and_update(self, include_edges=False, query={}):
@@ -1426,26 +2066,26 @@ class BuildGraphTransformer(object):
         # Make sure jobs and targets are in return data
         data['jobs']
         data['targets']
-        for node_id, node_data in self.build_graph.node.items():
-            if self.build_graph.is_target(node_id) and node_id in target_ids:
-                target = self.build_graph.get_target(node_id)
-                value = self._get_target_state(target)
-
-                node_data.update(value)
-                if include_edges:
-                    value['creators'] = self.build_graph.get_creator_ids(node_id)
-                    value['dependents'] = self.build_graph.get_dependent_ids(node_id)
-                data['targets'][target.unexpanded_id][target.get_id()] = value
-                #data['all_targets'][target.get_id()] = value
-            elif self.build_graph.is_job(node_id) and node_id in job_ids:
-                job = self.build_graph.get_job(node_id)
-                value = self._get_job_state(job)
-
-                if include_edges:
-                    value['targets'] = self.build_graph.get_target_ids(node_id)
-                    value['dependencies'] = self.build_graph.get_dependency_ids(node_id)
-                data['jobs'][job.unexpanded_id][job.get_id()] = value
-                #data['all_jobs'][job.get_id()] = value
+        for node_id in target_ids:
+            node_data = self.build_graph.node[node_id]
+            target = self.build_graph.get_target(node_id)
+            value = self._get_target_state(target)
+
+            node_data.update(value)
+            if include_edges:
+                value['creators'] = self.build_graph.get_creator_ids(node_id)
+                value['dependents'] = self.build_graph.get_dependent_ids(node_id)
+            data['targets'][target.unexpanded_id][target.get_id()] = value
+            #data['all_targets'][target.get_id()] = value
+        for node_id in job_ids:
+            job = self.build_graph.get_job(node_id)
+            value = self._get_job_state(job)
+
+            if include_edges:
+                value['targets'] = self.build_graph.get_target_ids(node_id)
+                value['dependencies'] = self.build_graph.get_dependency_ids(node_id)
+            data['jobs'][job.unexpanded_id][job.get_id()] = value
+            #data['all_jobs'][job.get_id()] = value
 
         data['n_selected_jobs'] = len(job_ids)
         data['n_selected_targets'] = len(target_ids)
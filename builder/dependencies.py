@@ -4,11 +4,75 @@ dependencies to be defined elsewhere, it might be usefull for a config file
 """
 
 class Dependency(object):
-    """Holds the dependency function and the unique_id"""
-    def __init__(self, func, unique_id, kind):
+    """Holds the dependency function and the unique_id
+
+    The targets the dependency is on are its members. Each member tells the
+    dependency when whether or not it is known to exist changes, so the
+    dependency keeps a count of the members that exist and can tell if
+    depends or depends_one_or_more is met without looking at every member.
+    When that changes the buildable state of the job is cleared.
+
+    Members whose existence is not known, because their mtime is not cached,
+    are fetched the next time is_met is called.
+    """
+    def __init__(self, func, unique_id, kind, job=None):
         self.func = func
         self.unique_id = unique_id
         self.kind = kind
+        self.job = job
+
+        self.members = []
+        self.n_existing = 0
+        self.unknown = set()
+
+    def add_member(self, target):
+        self.members.append(target)
+        target.dependency_nodes.append(self)
+        self.update_member(target, False, target.counted_exists)
+
+    def remove_member(self, target):
+        self.update_member(target, target.counted_exists, False)
+        self.members.remove(target)
+        target.dependency_nodes.remove(self)
+
+    def update_member(self, target, old_exists, new_exists):
+        """Called by a member when whether or not it exists changes from
+        old_exists to new_exists, None if it is not known
+        """
+        was_met = self._get_counted_met()
+        if old_exists:
+            self.n_existing -= 1
+        elif old_exists is None:
+            self.unknown.discard(target)
+        if new_exists:
+            self.n_existing += 1
+        elif new_exists is None:
+            self.unknown.add(target)
+        if self.job is not None and (
+                was_met is None or was_met != self._get_counted_met()):
+            self.job.set_buildable(None)
+
+    def _get_counted_met(self):
+        """Returns whether or not the dependency is met going by the counts,
+        None if that can not be told from the counts
+        """
+        if self.unknown:
+            return None
+        if self.func is depends:
+            return self.n_existing == len(self.members)
+        if self.func is depends_one_or_more:
+            return self.n_existing > 0
+        return None
+
+    def is_met(self):
+        """Returns whether or not the dependency is met"""
+        for target in list(self.unknown):
+            # Fetching the mtime moves the target out of unknown
+            target.get_exists()
+        met = self._get_counted_met()
+        if met is None:
+            return self.func(self.members)
+        return met
 
     def __repr__(self):
         return "Dependency({}, {})".format(self.unique_id, self.kind)
@@ -6,14 +6,26 @@ import subprocess
 import Queue
 import collections
 import concurrent.futures
+import contextlib
+import heapq
+import itertools
 import shlex
 import json
-import tempfile
 import os
+import random
 import re
+import datetime
 
 import builder.futures
+import builder.jobs
+import builder.memory
+import builder.metrics
+import builder.spawner
+import builder.targets
+import builder.tracing
+import builder.workers
 from builder.util import arrow_factory as arrow
+from builder.util import convert_to_timedelta
 import builder.build as build
 
 import networkx as nx
@@ -26,6 +38,19 @@ LOG = logging.getLogger(__name__)
 PROCESSING_LOG = logging.getLogger("builder.execution.processing")
 TRANSITION_LOG = logging.getLogger("builder.execution.transition")
 
+JOB_RUN_TIME = builder.metrics.histogram(
+        "builder_job_run_seconds", "Time from a job starting to it completing")
+QUEUE_WAIT_TIME = builder.metrics.histogram(
+        "builder_queue_wait_seconds", "Time jobs spend in the work queue")
+BULK_REFRESH_TIME = builder.metrics.histogram(
+        "builder_bulk_refresh_seconds", "Time taken to refresh targets in bulk")
+BUILD_LOCK_HOLD_TIME = builder.metrics.histogram(
+        "builder_build_lock_hold_seconds", "Time the build lock is held for")
+GRAPH_NODES = builder.metrics.gauge(
+        "builder_graph_nodes", "Number of nodes in the build graph")
+GRAPH_EDGES = builder.metrics.gauge(
+        "builder_graph_edges", "Number of edges in the build graph")
+
 def _interruptable_sleep(seconds):
     # Loop so it can be interrupted quickly (sleep does not pay attention to interrupt)
     for i in xrange(max(int(seconds), 1)):
@@ -50,11 +75,29 @@ class ExecutionResult(object):
         return self._is_async
 
 
+class ExecutionSnapshot(object):
+    """The state of an execution manager published after a mutation batch
+
+    Snapshots are never modified after they are published so readers can
+    use them without holding the build lock.
+
+    attr:
+        version: Incremented every time a snapshot is published
+        status: A json serializable dict describing the execution manager
+    """
+    def __init__(self, version, status):
+        self.version = version
+        self.status = status
+
+
 class Executor(object):
 
     # Should be False if this executor will handle updating the job state
     should_update_build_graph = True
 
+    # Should be True if this executor can execute a builder.jobs.JobBatch
+    supports_batches = False
+
     def __init__(self, execution_manager, config=None):
         self._build_graph = execution_manager.get_build()
         self._execution_manager = execution_manager
@@ -98,7 +141,24 @@ class Executor(object):
     def prepare_job_for_execution(self, job):
         return job
 
-    def finish_job(self, job, result, update_job_cache=True):
+    def finish_job(self, job, result, update_job_cache=True,
+                   release_resources=True):
+        """Marks job as finished with result and updates the build graph
+
+        release_resources is False when the job is finished before its
+        process has exited, it keeps its resources until the executor
+        finishes it again once the process is done.
+        """
+        if release_resources:
+            self.get_execution_manager()._release_resources(job.get_id())
+        # A batch is one result for the circuit breaker
+        self.get_execution_manager().record_job_result(job, bool(result.status))
+        if isinstance(job, builder.jobs.JobBatch):
+            self._finish_job_batch(job, result, update_job_cache)
+        else:
+            self._finish_job(job, result, update_job_cache)
+
+    def _finish_job(self, job, result, update_job_cache):
         LOG.info("Job {} complete. Status: {}".format(job.get_id(), result.status))
         LOG.debug("{}(stdout): {}".format(job.get_id(), result.stdout))
         LOG.debug("{}(stderr): {}".format(job.get_id(), result.stderr))
@@ -131,21 +191,76 @@ class Executor(object):
                     job.set_failed(True)
                     job.invalidate()
                     LOG.error("Maximum number of retries reached for {}".format(job))
+                else:
+                    self.get_execution_manager().schedule_retry(job)
+        self.get_execution_manager().add_ready_jobs_below(job.get_id())
         self.get_execution_manager().add_to_complete_queue(job.get_id())
 
+    def _finish_job_batch(self, job_batch, result, update_job_cache):
+        """Finishes every member of job_batch with the batch's result"""
+        LOG.info("Batch {} of {} jobs complete. Status: {}".format(
+            job_batch.get_id(), len(job_batch), result.status))
+        execution_times = self.get_execution_manager().execution_times
+        started_on = execution_times.pop(job_batch, None)
+        for job in job_batch.jobs:
+            if started_on is not None:
+                execution_times[job] = started_on
+            self._finish_job(job, result, update_job_cache)
+
 
 class LocalExecutor(Executor):
+    """Executes shell commands in a new process and python callable
+    commands in a pool of warm worker processes
+
+    Shell commands are started by a spawner process (see builder.spawner)
+    unless use_spawner is False in the config.
+
+    config:
+        use_spawner: Start shell commands from the spawner, True by default
+        worker_pool_size: The number of worker processes, 1 by default
+        worker_preload: Modules each worker imports when it starts
+        worker_max_jobs: Replace a worker after it has run this many jobs
+        worker_max_rss: Replace a worker once its resident set size has grown
+            by more than this many bytes since it started
+    """
+
+    supports_batches = True
+
+    def __init__(self, execution_manager, config=None):
+        super(LocalExecutor, self).__init__(execution_manager, config=config)
+        config = config or {}
+        self.worker_pool = builder.workers.WorkerPool(
+                size=config.get("worker_pool_size", 1),
+                preload=config.get("worker_preload", ()),
+                max_jobs=config.get("worker_max_jobs"),
+                max_rss=config.get("worker_max_rss"))
+        self.spawner = None
+        if config.get("use_spawner", True):
+            self.spawner = builder.spawner.Spawner()
+
+    def initialize(self):
+        if self.spawner is not None:
+            self.spawner.start()
 
     def do_execute(self, job):
         command = job.get_command()
+        if callable(command):
+            LOG.info("Executing {!r} in a worker".format(command))
+            status, stdout, stderr = self.worker_pool.run(command)
+            return ExecutionResult(is_async=False, status=status,
+                                   stdout=stdout, stderr=stderr)
         command_list = shlex.split(command)
         LOG.info("Executing '{}'".format(command))
-        proc = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout, stderr) = proc.communicate()
+        if self.spawner is not None:
+            returncode, stdout, stderr = self.spawner.run(command_list)
+        else:
+            proc = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (stdout, stderr) = proc.communicate()
+            returncode = proc.returncode
         LOG.info("{} STDOUT: {}".format(command, stdout))
         LOG.info("{} STDERR: {}".format(command, stderr))
 
-        return ExecutionResult(is_async=False, status=proc.returncode == 0, stdout=stdout, stderr=stderr)
+        return ExecutionResult(is_async=False, status=returncode == 0, stdout=stdout, stderr=stderr)
 
 
 class PrintExecutor(Executor):
@@ -180,6 +295,457 @@ class PrintExecutor(Executor):
         return ExecutionResult(is_async=False, status=True, stdout='', stderr='')
 
 
+class TimerQueue(object):
+    """Calls functions at a later time from a single thread
+
+    The thread is started by the first call_later and sleeps until the
+    earliest call is due or a new call is added. Cancelled calls are left in
+    the heap and skipped, the heap is rebuilt without them once they are
+    more than half of it.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._calls = []
+        self._n_cancelled = 0
+        self._counter = itertools.count()
+        self._thread = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._calls) - self._n_cancelled
+
+    def call_later(self, delay, f):
+        """Calls f in delay seconds, returns a timer that can be passed to
+        cancel
+        """
+        with self._condition:
+            # The counter breaks ties so functions are never compared
+            timer = [time.time() + delay, next(self._counter), f]
+            heapq.heappush(self._calls, timer)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="TimerQueue")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+            return timer
+
+    def cancel(self, timer):
+        """Cancels a call returned by call_later if it has not been made"""
+        with self._condition:
+            if timer[2] is None:
+                return
+            timer[2] = None
+            self._n_cancelled += 1
+            if self._n_cancelled * 2 > len(self._calls):
+                self._calls = [x for x in self._calls if x[2] is not None]
+                heapq.heapify(self._calls)
+                self._n_cancelled = 0
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._calls:
+                        self._condition.wait()
+                        continue
+                    delay = self._calls[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                timer = heapq.heappop(self._calls)
+                f = timer[2]
+                if f is None:
+                    self._n_cancelled -= 1
+                    continue
+                # Calls that were made can no longer be cancelled
+                timer[2] = None
+            try:
+                f()
+            except Exception:
+                LOG.exception("Timer call {} failed".format(f))
+
+
+class UpdateAggregator(object):
+    """Coalesces notifications that targets have been updated
+
+    Target ids that are added are held for window seconds, every id added in
+    that time is merged in to a single set and refreshed with one call to
+    ExecutionManager.external_update_targets. A request to update the top most
+    targets is merged in to the same flush.
+
+    args:
+        execution_manager: The ExecutionManager to update
+        window: The number of seconds to wait for more notifications before
+            flushing
+    """
+    def __init__(self, execution_manager, window=0.5):
+        self.execution_manager = execution_manager
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending_ids = set()
+        self._top_most_pending = False
+        self._top_most_running = False
+        self._timer = None
+
+        self.n_notifications = 0
+        self.n_notified_ids = 0
+        self.n_flushed_ids = 0
+        # Ids that were not in the graph when they were flushed and ids
+        # whose refresh raised
+        self.n_dropped_ids = 0
+        self.n_failed_ids = 0
+        self.n_flushes = 0
+
+    def add(self, target_ids):
+        """Adds the target ids to the next flush, returns the number of ids
+        that are pending
+        """
+        with self._lock:
+            self.n_notifications += 1
+            self.n_notified_ids += len(target_ids)
+            self._pending_ids.update(target_ids)
+            self._schedule()
+            return len(self._pending_ids)
+
+    def update_top_most(self):
+        """Adds the top most targets to the next flush
+
+        Returns False if an update of the top most targets is already pending
+        or running
+        """
+        with self._lock:
+            if self._top_most_pending or self._top_most_running:
+                return False
+            self.n_notifications += 1
+            self._top_most_pending = True
+            self._schedule()
+            return True
+
+    def _schedule(self):
+        """Starts the timer for the next flush, must be called while holding
+        the lock
+        """
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(self.window, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        """Cancels the pending flush, the pending ids are kept and flushed
+        with the next one
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def flush(self):
+        """Updates every pending target, returns the ids that were updated"""
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                target_ids = self._pending_ids
+                self._pending_ids = set()
+                top_most = self._top_most_pending
+                self._top_most_pending = False
+                self._top_most_running = top_most
+
+            flushed = False
+            try:
+                build_graph = self.execution_manager.build
+                with self.execution_manager._hold_build_lock():
+                    top_most_ids = []
+                    if top_most:
+                        top_most_ids = self.execution_manager.get_top_most_target_ids()
+                    # The target may have been pruned since it was added
+                    unknown_ids = set(
+                        x for x in target_ids
+                        if x not in build_graph or not build_graph.is_target(x))
+                # The top most ids count as notified so that the ids they
+                # were merged with count as coalesced
+                with self._lock:
+                    self.n_notified_ids += len(top_most_ids)
+                    self.n_dropped_ids += len(unknown_ids)
+                if unknown_ids:
+                    LOG.warn("UPDATE => Dropping {} targets that are not in the "
+                             "build graph: {}".format(len(unknown_ids), sorted(unknown_ids)))
+                target_ids = (target_ids - unknown_ids) | set(top_most_ids)
+                if not target_ids:
+                    flushed = True
+                    return target_ids
+                LOG.debug("UPDATE => Flushing {} targets".format(len(target_ids)))
+                self.execution_manager.external_update_targets(target_ids)
+                flushed = True
+            finally:
+                with self._lock:
+                    self.n_flushes += 1
+                    if flushed:
+                        self.n_flushed_ids += len(target_ids)
+                    else:
+                        self.n_failed_ids += len(target_ids)
+                    self._top_most_running = False
+            return target_ids
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                "n_notifications": self.n_notifications,
+                "n_notified_ids": self.n_notified_ids,
+                "n_flushed_ids": self.n_flushed_ids,
+                "n_coalesced_ids": (self.n_notified_ids - self.n_flushed_ids
+                                    - self.n_dropped_ids - self.n_failed_ids
+                                    - len(self._pending_ids)),
+                "n_dropped_ids": self.n_dropped_ids,
+                "n_failed_ids": self.n_failed_ids,
+                "n_flushes": self.n_flushes,
+                "n_pending_ids": len(self._pending_ids),
+            }
+
+
+class GraphPruner(object):
+    """Removes jobs that have aged out from the build graph
+
+    A pass looks at every job in the graph in batches of batch_size jobs and
+    removes the ones that BuildGraph.is_prunable allows. The build lock is
+    released between batches so a pass over a large graph does not hold up
+    submissions or execution.
+
+    args:
+        execution_manager: The ExecutionManager whose graph is pruned
+        max_age: Jobs whose build context ended more than max_age ago are
+            removed. Either a timedelta or anything convert_to_timedelta
+            understands
+        batch_size: The number of jobs to look at while holding the lock
+        interval: The number of seconds to wait between passes
+    """
+    def __init__(self, execution_manager, max_age, batch_size=1000, interval=60):
+        if not isinstance(max_age, datetime.timedelta):
+            max_age = convert_to_timedelta(max_age)
+        self.execution_manager = execution_manager
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.n_pruned_jobs = 0
+        self.n_pruned_nodes = 0
+        self.last_pruned_on = None
+
+    def prune(self, now=None):
+        """Runs a single pass, returns the number of nodes removed"""
+        if now is None:
+            now = arrow.get()
+        older_than = now - self.max_age
+        execution_manager = self.execution_manager
+        with execution_manager._hold_build_lock():
+            job_ids = [job_id for job_id, _ in execution_manager.build.job_iter()]
+
+        n_removed = 0
+        for i in xrange(0, len(job_ids), self.batch_size):
+            batch = job_ids[i:i + self.batch_size]
+            n_removed += execution_manager._update_build(
+                    lambda: self._prune_batch(batch, older_than))
+        self.last_pruned_on = arrow.now()
+        LOG.info("RETENTION => Removed {} nodes from the build graph".format(n_removed))
+        return n_removed
+
+    def _prune_batch(self, job_ids, older_than):
+        build_graph = self.execution_manager.build
+        removed_ids = set()
+        for job_id in job_ids:
+            # The job may have been removed since the ids were listed
+            if job_id not in build_graph or not build_graph.is_job(job_id):
+                continue
+            if build_graph.is_prunable(job_id, older_than):
+                removed_ids |= build_graph.prune_job(job_id)
+                self.n_pruned_jobs += 1
+        self.n_pruned_nodes += len(removed_ids)
+        return len(removed_ids)
+
+    def run(self):
+        while self.execution_manager.running:
+            self.prune()
+            _interruptable_sleep(self.interval)
+
+    def get_status(self):
+        return {
+            "max_age_seconds": self.max_age.total_seconds(),
+            "n_pruned_jobs": self.n_pruned_jobs,
+            "n_pruned_nodes": self.n_pruned_nodes,
+            "last_pruned_on": unicode(self.last_pruned_on),
+        }
+
+
+class ResourcePool(object):
+    """Tokens for the resources of the host jobs are executed on
+
+    A job declares what it uses with resources in its job definition's
+    config, for example {"resources": {"cpu": 4, "memory": 8e9}}. A job is
+    only executed once every resource it declares is available and holds
+    them until it finishes. A job that times out holds them until its
+    process exits. Resources a job does not declare are not taken
+    and resources the pool does not have are ignored. A demand larger than
+    the capacity takes the whole capacity so the job runs on its own
+    instead of never running.
+
+    args:
+        capacities: A dict from resource name to the amount the host has
+    """
+    def __init__(self, capacities):
+        self.capacities = dict(capacities)
+        self.available = dict(capacities)
+        self._held = {}
+        self._lock = threading.Lock()
+
+    def get_demands(self, job):
+        demands = {}
+        for resource, amount in job.config.get("resources", {}).iteritems():
+            if resource in self.capacities:
+                demands[resource] = min(amount, self.capacities[resource])
+        return demands
+
+    def acquire(self, job):
+        """Takes the resources job needs, returns False and takes nothing if
+        they are not all available or if an earlier run of the job still
+        holds its resources
+        """
+        demands = self.get_demands(job)
+        with self._lock:
+            if job.get_id() in self._held:
+                return False
+            if any(self.available[x] < y for x, y in demands.iteritems()):
+                return False
+            for resource, amount in demands.iteritems():
+                self.available[resource] -= amount
+            self._held[job.get_id()] = demands
+            return True
+
+    def is_holding(self, job_id):
+        with self._lock:
+            return job_id in self._held
+
+    def release(self, job_id):
+        """Gives back the resources held by job_id, returns False if it did
+        not hold any
+        """
+        with self._lock:
+            demands = self._held.pop(job_id, None)
+            if demands is None:
+                return False
+            for resource, amount in demands.iteritems():
+                self.available[resource] += amount
+            return True
+
+    def get_status(self):
+        with self._lock:
+            return {
+                "capacities": dict(self.capacities),
+                "available": dict(self.available),
+                "n_holding_jobs": len(self._held),
+            }
+
+
+class CircuitBreaker(object):
+    """Tracks the recent results of the jobs of one job definition and stops
+    its jobs from being dispatched when too many of them fail
+
+    The breaker starts closed. It opens when at least min_failures of the
+    last window results failed and they are at least failure_rate of
+    them. Once open no jobs are dispatched until reset_timeout seconds have
+    passed, then it is half open and lets a single job through as a probe.
+    The breaker closes again if the probe succeeds and opens again if it
+    fails, the results of other jobs that finish while it is half open are
+    ignored.
+
+    args:
+        unexpanded_id: The id of the job definition
+        failure_rate: The fraction of failed results that opens the breaker
+        window: The number of recent results to look at
+        min_failures: The least number of failures that opens the breaker
+        reset_timeout: The number of seconds to stay open before probing
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, unexpanded_id, failure_rate=0.5, window=20,
+                 min_failures=5, reset_timeout=300):
+        self.unexpanded_id = unexpanded_id
+        self.failure_rate = failure_rate
+        self.min_failures = min_failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.results = collections.deque(maxlen=window)
+        self.probing = False
+        self.probe_id = None
+        self.opened_on = None
+        self.n_opened = 0
+
+    def allow(self, job_id=None):
+        """Returns True if job_id can be dispatched, a half open breaker only
+        allows the first job until its result is recorded
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            self.probe_id = job_id
+            return True
+        return False
+
+    def record(self, success, job_id=None):
+        """Adds the result of job_id, returns True if the state changed"""
+        if self.state == self.HALF_OPEN:
+            if not self.probing or job_id != self.probe_id:
+                return False
+            if success:
+                self._close()
+            else:
+                self._open()
+            return True
+
+        self.results.append(success)
+        n_failures = sum(1 for x in self.results if not x)
+        if (self.state == self.CLOSED and n_failures >= self.min_failures
+                and n_failures >= self.failure_rate * len(self.results)):
+            self._open()
+            return True
+        return False
+
+    def half_open(self):
+        self.state = self.HALF_OPEN
+        self.probing = False
+        self.probe_id = None
+
+    def _open(self):
+        self.state = self.OPEN
+        self.probing = False
+        self.probe_id = None
+        self.opened_on = time.time()
+        self.n_opened += 1
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.probing = False
+        self.probe_id = None
+        self.opened_on = None
+        self.results.clear()
+
+    def get_status(self):
+        return {
+            "state": self.state,
+            "n_results": len(self.results),
+            "n_failures": sum(1 for x in self.results if not x),
+            "opened_on": self.opened_on,
+            "n_opened": self.n_opened,
+        }
+
+
 class ExecutionManager(object):
 
     def __init__(self, build_manager, executor_factory, max_retries=5, job_timeout=30*60, config=None):
@@ -188,10 +754,19 @@ class ExecutionManager(object):
         self.max_retries = max_retries
         self.config = config
         self._build_lock = threading.RLock()
+        self._build_lock_depth = 0
         self._work_queue = Queue.Queue()
         self._complete_queue = Queue.Queue()
         self.executor = executor_factory(self, config=self.config)
         self.execution_times = {}
+        self._enqueued_on = {}
+        # Jobs that need to run and have not been put on the work queue
+        # yet. A job stays in the set until it is dispatched or no longer
+        # needs to run, jobs that are still running stay until they finish
+        self._ready_job_ids = set()
+        # Batches on the work queue by their id
+        self._job_batches = {}
+        self.bulk_refresh_times = {}
         self.submitted_jobs = 0
         self.completed_jobs = 0
         self.start_time = None
@@ -202,6 +777,41 @@ class ExecutionManager(object):
         self.job_timeout = job_timeout
 
         self.running = False
+        self.update_aggregator = UpdateAggregator(
+                self, window=(config or {}).get("update_window", 0.5))
+        self.memory_profiler = builder.memory.MemoryProfiler(
+                tracemalloc_frames=(config or {}).get("tracemalloc_frames", 0))
+        self.graph_pruner = None
+        if (config or {}).get("retention_max_age"):
+            self.graph_pruner = GraphPruner(
+                    self, config["retention_max_age"],
+                    batch_size=config.get("retention_batch_size", 1000),
+                    interval=config.get("retention_interval", 60))
+        self.timer_queue = TimerQueue()
+        # job id -> the timer of the job's scheduled cache expiry
+        self._cache_expiry_timers = {}
+        self.retry_backoff = (config or {}).get("retry_backoff", 0)
+        self.retry_backoff_max = (config or {}).get("retry_backoff_max", 600)
+        self.retry_jitter = (config or {}).get("retry_jitter", 0.5)
+        self.n_scheduled_retries = 0
+        self.circuit_breaker_config = (config or {}).get("circuit_breaker")
+        self.circuit_breakers = {}
+        # Jobs kept off the work queue by an open circuit breaker by the id
+        # of their job definition
+        self._paused_job_ids = collections.defaultdict(set)
+        self.resource_pool = None
+        # Jobs taken from the work queue that are waiting for resources
+        self._waiting_for_resources = collections.deque()
+        if (config or {}).get("resources"):
+            self.resource_pool = ResourcePool(config["resources"])
+
+        self._version = 0
+        self._snapshot = None
+        self._graph_snapshot = None
+        self._graph_snapshot_on = None
+        self.graph_snapshot_interval = (config or {}).get(
+                "graph_snapshot_interval", 5)
+        self._publish_snapshot()
 
     def _recursive_invalidate_job(self, job_id):
         job = self.build.get_job(job_id)
@@ -218,6 +828,7 @@ class ExecutionManager(object):
         for job_id in job_ids:
             self._recursive_invalidate_job(job_id)
 
+    @builder.tracing.traced("ExecutionManager.submit")
     def submit(self, job_definition_id, build_context, update_topmost=False, update_all=False, **kwargs):
         """
         Submit the provided job to be built
@@ -225,7 +836,7 @@ class ExecutionManager(object):
         if not self.running:
             raise RuntimeError("Cannot submit to a execution manager that "
                                "isn't running")
-        def update_build_graph():
+        def expand_build_graph():
             # Add the job
             LOG.debug("SUBMISSION => Expanding build graph for submission {} {}".format(job_definition_id, build_context))
             if self.build.rule_dependency_graph.is_job_definition(job_definition_id):
@@ -239,32 +850,217 @@ class ExecutionManager(object):
                     if self.build.in_degree(node_id) == 0 or update_all:
                         if self.build.is_target(node_id):
                             update_nodes.add(node_id)
+            return build_update, update_nodes
 
-                LOG.debug("UPDATE_SUBMITTED => {}".format(update_nodes))
-                self.external_update_targets(update_nodes)
-
+        # The targets are refreshed without holding the build lock, it is
+        # only held while expanding and while propagating
+        build_update, update_nodes = self._update_build(expand_build_graph)
+        if update_topmost or update_all:
+            LOG.debug("UPDATE_SUBMITTED => {}".format(update_nodes))
+            self.external_update_targets(update_nodes)
 
-            LOG.debug("SUBMISSION => Build graph expansion complete")
+        LOG.debug("SUBMISSION => Build graph expansion complete")
 
-            # Refresh all uncached existences
-            LOG.debug("updating {} targets".format(len(build_update.new_targets)))
-            self.update_targets(build_update.new_targets)
+        # Refresh all uncached existences
+        LOG.debug("updating {} targets".format(len(build_update.new_targets)))
+        self.update_targets(build_update.new_targets)
+        if build_update.lazy_targets:
+            build_update.merge(self._expand_missing_lazy_targets(
+                    build_update.lazy_targets))
 
+        def propagate():
             # Invalidate the build graph for all child nodes
             newly_invalidated_job_ids = build_update.new_jobs | build_update.newly_forced
             LOG.debug("SUBMISSION => Newly invlidated job ids: {}".format(newly_invalidated_job_ids))
             LOG.debug("SUBMISSION => Jobs expanded: {}".format(build_update.jobs))
-            for newly_invalidated_job_id in newly_invalidated_job_ids:
-                self.update_parents_should_run(newly_invalidated_job_id)
-                next_job_to_run_ids = self.get_next_jobs_to_run(
-                        newly_invalidated_job_id)
-                LOG.debug("SUBMISSION => Next jobs {} -> {}".format(newly_invalidated_job_id, next_job_to_run_ids))
-                for next_job_to_run_id in next_job_to_run_ids:
-                    self.add_to_work_queue(next_job_to_run_id)
+            self._propagate_should_run(newly_invalidated_job_ids)
             self.last_job_submitted_on = arrow.now()
             self.submitted_jobs += 1
 
-        self._update_build(update_build_graph)
+        self._update_build(propagate)
+
+    @builder.tracing.traced("ExecutionManager.submit_many")
+    def submit_many(self, submissions):
+        """Submit a batch of jobs to be built
+
+        Each submission is a dict with the same keys as the arguments of
+        submit. All the submissions are expanded while holding the build lock
+        once, the new targets are refreshed in a single bulk refresh and
+        should run is propagated in a single pass over every job that was
+        invalidated by the batch.
+
+        Returns the number of submissions
+        """
+        if not self.running:
+            raise RuntimeError("Cannot submit to a execution manager that "
+                               "isn't running")
+        submissions = [dict(x) for x in submissions]
+        new_target_ids = set()
+        update_target_ids = set()
+        lazy_target_ids = set()
+        invalidated_job_ids = set()
+
+        def expand_build_graph():
+            rule_dependency_graph = self.build.rule_dependency_graph
+            for submission in submissions:
+                job_definition_id = submission.pop("job_definition_id")
+                build_context = submission.pop("build_context", {})
+                update_topmost = submission.pop("update_topmost", False)
+                update_all = submission.pop("update_all", False)
+                LOG.debug("SUBMISSION => Expanding build graph for submission {} {}".format(job_definition_id, build_context))
+                if rule_dependency_graph.is_job_definition(job_definition_id):
+                    build_update = self.build.add_job(job_definition_id, build_context, **submission)
+                else:
+                    build_update = self.build.add_meta(job_definition_id, build_context, **submission)
+
+                if update_topmost or update_all:
+                    for node_id in build_update.targets:
+                        if self.build.in_degree(node_id) == 0 or update_all:
+                            if self.build.is_target(node_id):
+                                update_target_ids.add(node_id)
+                new_target_ids.update(build_update.new_targets)
+                lazy_target_ids.update(build_update.lazy_targets)
+                invalidated_job_ids.update(build_update.new_jobs)
+                invalidated_job_ids.update(build_update.newly_forced)
+            LOG.debug("SUBMISSION => Expanded {} submissions".format(len(submissions)))
+
+        self._update_build(expand_build_graph)
+
+        # Refresh all the new targets and the targets that were asked to be
+        # updated at once
+        self.update_targets(new_target_ids | update_target_ids)
+        if lazy_target_ids:
+            build_update = self._expand_missing_lazy_targets(lazy_target_ids)
+            invalidated_job_ids.update(build_update.new_jobs)
+
+        def propagate():
+            job_ids = invalidated_job_ids | self._get_update_job_ids(update_target_ids)
+            self._propagate_should_run(job_ids)
+            self.last_job_submitted_on = arrow.now()
+            self.submitted_jobs += len(submissions)
+
+        self._update_build(propagate)
+        return len(submissions)
+
+    def _expand_missing_lazy_targets(self, lazy_target_ids):
+        """Expands the creators of the targets left unexpanded by a lazy
+        expansion that do not exist
+
+        Targets that exist are treated as inputs and their creators are never
+        added to the graph. The creators that are expanded are expanded
+        lazily as well so this repeats until every missing target has its
+        creators. The targets must have been refreshed before calling this.
+
+        Returns a BuildUpdate of everything that was expanded
+        """
+        build_update = build.BuildUpdate()
+        while lazy_target_ids:
+            def expand():
+                missing_target_ids = [
+                    x for x in lazy_target_ids
+                    if x in self.build and not self.build.get_target(x).get_exists()]
+                LOG.debug("SUBMISSION => Expanding creators of {} missing "
+                          "targets".format(len(missing_target_ids)))
+                return self.build.expand_lazy_targets(missing_target_ids)
+            expanded = self._update_build(expand)
+            self.update_targets(expanded.new_targets)
+            build_update.merge(expanded)
+            lazy_target_ids = expanded.lazy_targets
+        return build_update
+
+    def _get_update_job_ids(self, target_ids):
+        """Returns the ids of the jobs whose state depends directly on the
+        targets
+        """
+        update_job_ids = set()
+        for target_id in target_ids:
+            add_ids = self.build.get_creator_ids(target_id)
+            if not add_ids:
+                add_ids = self.build.get_dependent_ids(target_id)
+            update_job_ids.update(add_ids)
+        return update_job_ids
+
+    def _propagate_should_run(self, job_ids):
+        """Updates should run below each of the jobs and adds the jobs that
+        need to run to the ready set
+
+        The jobs below are only walked once no matter how many of job_ids
+        they are below.
+        """
+        for job_id in job_ids:
+            self.update_parents_should_run(job_id)
+
+        visited = set()
+        for job_id in job_ids:
+            next_job_ids = self.get_next_jobs_to_run(job_id, visited=visited)
+            LOG.debug("PROPAGATION => Next jobs {} -> {}".format(job_id, next_job_ids))
+            self._ready_job_ids.update(next_job_ids)
+        # These have been looked at, start_execution does not need to
+        self.build.new_job_ids.difference_update(job_ids)
+        self._dispatch_ready_jobs()
+
+    def add_ready_jobs_below(self, job_id):
+        """Adds the jobs below job_id that need to run to the ready set, used
+        once a job has finished and the jobs below it have been invalidated
+        """
+        self._ready_job_ids.update(self.get_next_jobs_to_run(job_id))
+
+    def _dispatch_ready_jobs(self):
+        """Puts the jobs in the ready set on to the work queue
+
+        Jobs that were pruned or no longer need to run are dropped from the
+        set and jobs that are still running are kept until they finish.
+        """
+        ready_job_ids = []
+        running_job_ids = set()
+        for job_id in self._ready_job_ids:
+            if job_id not in self.build:
+                continue
+            job = self.build.get_job(job_id)
+            if not job.get_should_run():
+                continue
+            if job.is_running:
+                running_job_ids.add(job_id)
+            else:
+                ready_job_ids.append(job_id)
+        self._ready_job_ids = running_job_ids
+        if getattr(self.executor, "supports_batches", False):
+            ready_job_ids = self._add_job_batches_to_work_queue(ready_job_ids)
+        for job_id in ready_job_ids:
+            self.add_to_work_queue(job_id)
+
+    def _add_job_batches_to_work_queue(self, job_ids):
+        """Puts adjacent jobs of job definitions with a max batch size on to
+        the work queue as batches, returns the ids of the jobs that were not
+        batched
+        """
+        unbatched_job_ids = []
+        batchable_jobs = collections.defaultdict(list)
+        for job_id in job_ids:
+            job = self.build.get_job(job_id)
+            max_batch_size = job.job.get_max_batch_size()
+            if (max_batch_size > 1 and not job.is_running
+                    and job.retry_on is None
+                    and self._is_circuit_closed(job.unexpanded_id)):
+                batchable_jobs[max_batch_size].append(job)
+            else:
+                unbatched_job_ids.append(job_id)
+
+        for max_batch_size, jobs in batchable_jobs.iteritems():
+            for group in builder.jobs.JobBatch.group(jobs, max_batch_size):
+                if len(group) == 1:
+                    unbatched_job_ids.append(group[0].get_id())
+                    continue
+                job_batch = builder.jobs.JobBatch(group)
+                for job in group:
+                    job.is_running = True
+                self._job_batches[job_batch.get_id()] = job_batch
+                if builder.metrics.is_enabled():
+                    self._enqueued_on[job_batch.get_id()] = time.time()
+                self._work_queue.put(job_batch.get_id())
+                LOG.info("Adding batch {} of {} jobs to ExecutionManager's work queue".format(
+                    job_batch.get_id(), len(job_batch)))
+        return unbatched_job_ids
 
     def _update_parents_should_not_run_recurse(self, job_id):
         build_graph = self.build
@@ -299,6 +1095,7 @@ class ExecutionManager(object):
             for dependent_id in dependent_ids:
                 self._update_parents_should_run_recurse(dependent_id)
 
+    @builder.tracing.traced("ExecutionManager.update_parents_should_run")
     def update_parents_should_run(self, job_id):
         build_graph = self.build
         job = build_graph.get_job(job_id)
@@ -317,59 +1114,234 @@ class ExecutionManager(object):
             for dependent_id in dependent_ids:
                 self._update_parents_should_not_run_recurse(dependent_id)
 
+    @builder.tracing.traced("ExecutionManager.external_update_targets")
     def external_update_targets(self, target_ids):
         """Updates the state of a single target and updates everything below
         it
+
+        A target that a lazy expansion treated as an input, leaving its
+        creators out of the graph, has its creators expanded if it no longer
+        exists so that it is rebuilt
         """
-        build_graph = self.build
-        update_job_ids = set()
         self.update_targets(target_ids)
-        for target_id in target_ids:
-            add_ids = build_graph.get_creator_ids(target_id)
-            if not add_ids:
-                add_ids = build_graph.get_dependent_ids(target_id)
-            for add_id in add_ids:
-                update_job_ids.add(add_id)
-
-        LOG.debug("after updating targets, {} jobs are being updated".format(len(update_job_ids)))
-        for update_job_id in update_job_ids:
-            self.update_parents_should_run(update_job_id)
 
-        # Update the upper jobs that states depend on the target
-        for update_job_id in update_job_ids:
-            next_job_to_run_ids = self.get_next_jobs_to_run(update_job_id)
-            update_job = self.build.get_job(update_job_id)
-            for next_job_to_run_id in next_job_to_run_ids:
-                self.add_to_work_queue(next_job_to_run_id)
-
-    def update_top_most(self):
+        with self._hold_build_lock():
+            deferred_target_ids = [
+                x for x in target_ids
+                if x in self.build and
+                self.build.is_deferred_target(self.build.get_target(x))]
+        build_update = self._expand_missing_lazy_targets(deferred_target_ids)
+
+        def propagate():
+            update_job_ids = self._get_update_job_ids(target_ids)
+            update_job_ids.update(build_update.new_jobs)
+            LOG.debug("after updating targets, {} jobs are being updated".format(len(update_job_ids)))
+            self._propagate_should_run(update_job_ids)
+        self._update_build(propagate)
+
+    def get_top_most_target_ids(self):
         top_most = []
         for node_id in self.build:
             if self.build.in_degree(node_id) == 0:
                 if self.build.is_target(node_id):
                     top_most.append(node_id)
+        return top_most
+
+    def update_top_most(self):
+        top_most = self.get_top_most_target_ids()
         LOG.debug("TOP_MOST_JOBS => {}".format(top_most))
         self.external_update_targets(top_most)
 
+    @builder.tracing.traced("ExecutionManager.update_targets")
     def update_targets(self, target_ids):
         """Takes in a list of target ids and updates all of their needed
         values
+
+        The values are fetched concurrently for each target type without
+        holding the build lock, the lock is only held while the fetched
+        values are applied to the targets.
         """
         LOG.debug("updating {} targets".format(len(target_ids)))
-        update_function_list = collections.defaultdict(list)
-        for target_id in target_ids:
-            target = self.build.get_target(target_id)
-            func = target.get_bulk_exists_mtime
-            update_function_list[func].append(target)
+        targets = [self.build.get_target(x) for x in target_ids]
+        config = self.config or {}
+        exists_mtime_dict, timings = (
+                builder.targets.get_bulk_exists_mtime_parallel(
+                    targets,
+                    max_workers=config.get("bulk_refresh_workers", 4),
+                    chunk_size=config.get("bulk_refresh_chunk_size")))
+
+        def apply_exists_mtime():
+            for target in targets:
+                state = exists_mtime_dict.get(target.unique_id)
+                if state is not None:
+                    target.set_mtime(state["mtime"])
+            self._schedule_cache_expiries(targets)
+        self._update_build(apply_exists_mtime)
+
+        for target_type, seconds in timings.iteritems():
+            self.bulk_refresh_times[target_type.__name__] = seconds
+            BULK_REFRESH_TIME.observe(seconds, target_type=target_type.__name__)
+
+    def _schedule_cache_expiries(self, targets):
+        """Schedules the creators of the targets that have a cache time to be
+        re-evaluated when they go past it
+        """
+        job_ids = set()
+        for target in targets:
+            # The target may have been pruned while it was refreshed
+            if target.unique_id in self.build:
+                job_ids.update(self.build.get_creator_ids_iter(target.unique_id))
+        for job_id in job_ids:
+            job = self.build.get_job(job_id)
+            if job.cache_time is not None:
+                self.schedule_cache_expiry(job)
+
+    def schedule_cache_expiry(self, job):
+        """Schedules job to be re-evaluated when it goes past its cache time,
+        returns the time it is scheduled at or None if it was not scheduled
+
+        Jobs that are already past their cache time or that are already
+        scheduled for the same time are not scheduled. A job that is
+        scheduled for another time has that timer cancelled.
+        """
+        cache_expiry = job.get_cache_expiry()
+        if not cache_expiry or cache_expiry == job.cache_expires_on:
+            return None
+        delay = cache_expiry - time.time()
+        if delay <= 0:
+            return None
+        job_id = job.get_id()
+        job.cache_expires_on = cache_expiry
+        timer = self._cache_expiry_timers.pop(job_id, None)
+        if timer is not None:
+            self.timer_queue.cancel(timer)
+        self._cache_expiry_timers[job_id] = self.timer_queue.call_later(
+                delay, lambda: self._update_build(
+                    lambda: self._expire_cache(job_id, cache_expiry)))
+        return cache_expiry
+
+    def _expire_cache(self, job_id, cache_expiry):
+        if job_id not in self.build:
+            self._cache_expiry_timers.pop(job_id, None)
+            return
+        job = self.build.get_job(job_id)
+        # The job was rescheduled after its targets were updated again
+        if job.cache_expires_on != cache_expiry:
+            return
+        self._cache_expiry_timers.pop(job_id, None)
+        job.cache_expires_on = None
+        LOG.debug("Job {} is past its cache time".format(job_id))
+        job.invalidate()
+        self._propagate_should_run([job_id])
+
+    def get_retry_delay(self, job):
+        """Returns the number of seconds to wait before retrying job after
+        its last failure
+
+        The delay doubles with every retry starting at retry_backoff and is
+        capped at retry_backoff_max. Up to retry_jitter of it is taken off
+        at random so jobs that failed together are not retried together.
+        Each can be set in the job definition's config to override the
+        execution manager's config.
+        """
+        config = job.config
+        backoff = config.get("retry_backoff", self.retry_backoff)
+        if not backoff or job.retries <= 0:
+            return 0
+        backoff_max = config.get("retry_backoff_max", self.retry_backoff_max)
+        jitter = config.get("retry_jitter", self.retry_jitter)
+        delay = min(backoff * 2 ** (job.retries - 1), backoff_max)
+        return delay * (1 - jitter * random.random())
+
+    def schedule_retry(self, job):
+        """Keeps the failed job off of the work queue until its retry delay
+        has passed, returns the delay
+        """
+        delay = self.get_retry_delay(job)
+        if delay <= 0:
+            return 0
+        job_id = job.get_id()
+        job.retry_on = time.time() + delay
+        self.n_scheduled_retries += 1
+        LOG.info("Retrying {} in {:.1f} seconds".format(job_id, delay))
+        self.timer_queue.call_later(
+                delay, lambda: self._update_build(lambda: self._retry_job(job_id)))
+        return delay
+
+    def _retry_job(self, job_id):
+        if job_id not in self.build:
+            return
+        job = self.build.get_job(job_id)
+        job.retry_on = None
+        if job.get_should_run():
+            self._ready_job_ids.add(job_id)
+            self._dispatch_ready_jobs()
+
+    def _get_circuit_breaker(self, unexpanded_id):
+        """Returns the circuit breaker of the job definition, None if circuit
+        breakers are not configured
+        """
+        if self.circuit_breaker_config is None:
+            return None
+        circuit_breaker = self.circuit_breakers.get(unexpanded_id)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(unexpanded_id,
+                                             **self.circuit_breaker_config)
+            self.circuit_breakers[unexpanded_id] = circuit_breaker
+        return circuit_breaker
+
+    def _is_circuit_closed(self, unexpanded_id):
+        circuit_breaker = self._get_circuit_breaker(unexpanded_id)
+        return circuit_breaker is None or circuit_breaker.state == CircuitBreaker.CLOSED
+
+    def record_job_result(self, job, success):
+        """Adds the result of job to its job definition's circuit breaker"""
+        circuit_breaker = self._get_circuit_breaker(job.unexpanded_id)
+        if circuit_breaker is None or not circuit_breaker.record(success, job.get_id()):
+            return
+        unexpanded_id = job.unexpanded_id
+        if circuit_breaker.state == CircuitBreaker.OPEN:
+            LOG.error("Circuit breaker for {} is open, pausing its jobs for {} seconds".format(
+                unexpanded_id, circuit_breaker.reset_timeout))
+            self.timer_queue.call_later(
+                    circuit_breaker.reset_timeout,
+                    lambda: self._update_build(
+                        lambda: self._probe_circuit_breaker(unexpanded_id)))
+        else:
+            LOG.info("Circuit breaker for {} is closed, resuming its jobs".format(
+                unexpanded_id))
+            self._resume_paused_jobs(unexpanded_id)
 
-        for update_function, targets in update_function_list.iteritems():
-            update_function(targets)
+    def _probe_circuit_breaker(self, unexpanded_id):
+        """Half opens the breaker and dispatches one paused job as the probe,
+        when there are none the next job that is dispatched is the probe
+        """
+        self.circuit_breakers[unexpanded_id].half_open()
+        paused_job_ids = self._paused_job_ids[unexpanded_id]
+        while paused_job_ids:
+            job_id = paused_job_ids.pop()
+            if job_id in self.build and self.build.get_job(job_id).get_should_run():
+                self.add_to_work_queue(job_id)
+                return
+
+    def _resume_paused_jobs(self, unexpanded_id):
+        paused_job_ids = self._paused_job_ids.pop(unexpanded_id, set())
+        for job_id in paused_job_ids:
+            if job_id in self.build and self.build.get_job(job_id).get_should_run():
+                self._ready_job_ids.add(job_id)
+        self._dispatch_ready_jobs()
 
     def add_to_work_queue(self, job_id):
         job = self.build.get_job(job_id)
-        if job.is_running:
+        if job.is_running or job.retry_on is not None:
+            return
+        circuit_breaker = self._get_circuit_breaker(job.unexpanded_id)
+        if circuit_breaker is not None and not circuit_breaker.allow(job_id):
+            self._paused_job_ids[job.unexpanded_id].add(job_id)
             return
         job.is_running = True
+        if builder.metrics.is_enabled():
+            self._enqueued_on[job_id] = time.time()
         self._work_queue.put(job_id)
         LOG.info("Adding {} to ExecutionManager's work queue. There are now approximately {} jobs in the queue.".format(job_id, self._work_queue.qsize()))
 
@@ -386,18 +1358,24 @@ class ExecutionManager(object):
         self.running = True
         self.start_time = arrow.now()
         self.executor.initialize()
-        # Seed initial jobs
+        # Seed initial jobs, the graph may have been expanded without going
+        # through submit so the jobs added since they were last propagated
+        # are looked at along with the ready set
         work_queue = self._work_queue
-        next_jobs = self.get_jobs_to_run()
-        map(self.add_to_work_queue, next_jobs)
+        def seed_work_queue():
+            self._ready_job_ids.update(self.build.pop_new_job_ids())
+            self._dispatch_ready_jobs()
+        self._update_build(seed_work_queue)
 
         # Start completed jobs consumer if not inline
         executor = None
         if not inline:
-            executor = builder.futures.ThreadPoolExecutor(max_workers=3)
+            executor = builder.futures.ThreadPoolExecutor(max_workers=4)
             executor.submit(self._consume_completed_jobs, block=True)
             executor.submit(self._check_for_timeouts)
             executor.submit(self._check_for_passed_curfews)
+            if self.graph_pruner is not None:
+                executor.submit(self.graph_pruner.run)
 
         jobs_executed = 0
         ONEYEAR = 365 * 24 * 60 * 60
@@ -411,8 +1389,13 @@ class ExecutionManager(object):
             except Queue.Empty:
                 continue
             self.last_job_worked_on = arrow.now()
+            enqueued_on = self._enqueued_on.pop(job_id, None)
+            if enqueued_on is not None:
+                QUEUE_WAIT_TIME.observe(time.time() - enqueued_on)
 
             TRANSITION_LOG.debug("EXECUTION_LOOP => Got job {} from work queue".format(job_id))
+            if not self._acquire_resources(job_id):
+                continue
             result = self.execute(job_id)
             #LOG.debug("EXECUTION_LOOP => Finished job {} from work queue".format(job_id))
             jobs_executed += 1
@@ -433,9 +1416,38 @@ class ExecutionManager(object):
         if executor is not None:
             executor.shutdown(wait=True)
 
+    def _acquire_resources(self, job_id):
+        """Returns True if job_id can be executed, otherwise it waits until
+        a running job gives back its resources
+        """
+        if self.resource_pool is None:
+            return True
+        job = self._job_batches.get(job_id)
+        if job is None:
+            job = self.build.get_job(job_id)
+        with self._hold_build_lock():
+            if self.resource_pool.acquire(job):
+                return True
+            TRANSITION_LOG.debug("EXECUTION_LOOP => Job {} is waiting for resources".format(job_id))
+            self._waiting_for_resources.append(job_id)
+            return False
+
+    def _release_resources(self, job_id):
+        """Gives back the resources held by job_id and puts the jobs waiting
+        for resources back on the work queue
+        """
+        if self.resource_pool is None:
+            return
+        with self._hold_build_lock():
+            if not self.resource_pool.release(job_id):
+                return
+            while self._waiting_for_resources:
+                self._work_queue.put(self._waiting_for_resources.popleft())
+
     def stop_execution(self):
         LOG.info("Stopping execution")
         self.running = False
+        self.update_aggregator.stop()
 
 
     def _consume_completed_jobs(self, block=False):
@@ -450,22 +1462,24 @@ class ExecutionManager(object):
                 job_id = complete_queue.get(True, timeout=1)
             except Queue.Empty:
                 continue
-            self.last_job_completed_on = arrow.now()
-            self.completed_jobs += 1
+            self._update_build(lambda: self._complete_job(job_id))
+        LOG.debug("COMPLETION_LOOP => Done consuming completed jobs")
 
-            try:
-                job = self.build.get_job(job_id)
-                del self.execution_times[job]
-            except KeyError:
-                pass
+    def _complete_job(self, job_id):
+        self.last_job_completed_on = arrow.now()
+        self.completed_jobs += 1
 
+        try:
+            job = self.build.get_job(job_id)
+            started_on = self.execution_times.pop(job)
+        except KeyError:
+            pass
+        else:
+            JOB_RUN_TIME.observe((arrow.get() - started_on).total_seconds())
 
-            TRANSITION_LOG.debug("COMPLETION_LOOP =>  Completed job {}".format(job_id))
-            next_jobs = self.get_next_jobs_to_run(job_id)
-            next_jobs = filter(lambda job_id: not self.build.get_job(job_id).is_running, next_jobs)
-            TRANSITION_LOG.debug("COMPLETION_LOOP => Received completed job {}. Next jobs are {}".format(job_id, next_jobs))
-            map(self.add_to_work_queue, next_jobs)
-        LOG.debug("COMPLETION_LOOP => Done consuming completed jobs")
+        # finish_job added the jobs below this one to the ready set
+        TRANSITION_LOG.debug("COMPLETION_LOOP => Received completed job {}. Ready jobs are {}".format(job_id, self._ready_job_ids))
+        self._dispatch_ready_jobs()
 
     def _check_for_timeouts(self):
 
@@ -478,7 +1492,13 @@ class ExecutionManager(object):
                     timed_out_jobs.append(job)
             for job in timed_out_jobs:
                 self.execution_times.pop(job)
-                self.executor.finish_job(job, ExecutionResult(is_async=False, status=False))
+                # The job's process may still be running so its resources
+                # are kept until the executor finishes it
+                if self.resource_pool is not None and self.resource_pool.is_holding(job.get_id()):
+                    LOG.warn("Job {} timed out, keeping its resources until its process exits".format(job.get_id()))
+                self._update_build(lambda: self.executor.finish_job(
+                        job, ExecutionResult(is_async=False, status=False),
+                        release_resources=False))
 
             _interruptable_sleep(10)
 
@@ -487,44 +1507,63 @@ class ExecutionManager(object):
         while self.running:
             PROCESSING_LOG.debug("CURFEWS => Checking for stale jobs past curfew")
             stale_jobs_past_curfew = []
+            # The lock is taken per node so the pass does not hold up
+            # everything else, the snapshot is published once at the end
             for node_id in self.build.node.keys():
-
-                if (not node_id in self.build.node) or (not self.build.is_job(node_id)):
-                    continue
-                job = self.build.get_job(node_id)
-                if job.past_curfew() and job.get_stale() and job.get_buildable():
-                    job.invalidate()
-                    if job.get_should_run():
-                        stale_jobs_past_curfew.append(job)
-                        self._work_queue.put(job.get_id())
+                with self._hold_build_lock():
+                    self._check_passed_curfew(node_id, stale_jobs_past_curfew)
+            with self._hold_build_lock():
+                self._publish_snapshot()
             PROCESSING_LOG.debug("CURFEWS => These jobs were stale, past curfew, and should run: {}".format(
                 stale_jobs_past_curfew))
             _interruptable_sleep(60)
 
-    def get_next_jobs_to_run_recurse(self, job_id):
+    def _check_passed_curfew(self, node_id, stale_jobs_past_curfew):
+        if (not node_id in self.build.node) or (not self.build.is_job(node_id)):
+            return
+        job = self.build.get_job(node_id)
+        if job.past_curfew() and job.get_stale() and job.get_buildable():
+            job.invalidate()
+            if job.get_should_run():
+                stale_jobs_past_curfew.append(job)
+                self.add_to_work_queue(job.get_id())
+
+    @builder.tracing.traced("ExecutionManager.get_next_jobs_to_run")
+    def get_next_jobs_to_run(self, job_id, visited=None):
+        """Returns the jobs that are below job_id that need to run
+
+        The jobs are walked breadth first from job_id, the walk stops at jobs
+        that need to run. Every job walked is added to visited and jobs
+        already in visited are skipped, pass the same set to every call in a
+        propagation pass to only walk each job once.
+        """
+        if visited is None:
+            visited = set()
+        build_graph = self.build
         next_job_ids = set()
-        job = self.build.get_job(job_id)
-        if job.get_should_run():
-            next_job_ids.add(job_id)
-        else:
-            target_ids = self.build.get_target_ids(job_id)
-            for target_id in target_ids:
-                dependent_ids = self.build.get_dependent_ids(target_id)
-                for dependent_id in dependent_ids:
-                    next_job_ids |= self.get_next_jobs_to_run_recurse(
-                            dependent_id)
+        frontier = collections.deque([job_id])
+        while frontier:
+            job_id = frontier.popleft()
+            if job_id in visited:
+                continue
+            visited.add(job_id)
+            if build_graph.get_job(job_id).get_should_run():
+                next_job_ids.add(job_id)
+                continue
+            for target_id in build_graph.get_target_ids_iter(job_id):
+                for dependent_id in build_graph.get_dependent_ids_iter(target_id):
+                    if dependent_id not in visited:
+                        frontier.append(dependent_id)
         return next_job_ids
 
-    def get_next_jobs_to_run(self, job_id):
-        """Returns the jobs that are below job_id that need to run"""
-        next_jobs = self.get_next_jobs_to_run_recurse(job_id)
-        return next_jobs
-
 
+    @builder.tracing.traced("ExecutionManager.execute")
     def execute(self, job_id):
         # Don't run a job more than the configured max number of retries
         self.last_job_executed_on = arrow.get()
-        job = self.build.get_job(job_id)
+        job = self._job_batches.pop(job_id, None)
+        if job is None:
+            job = self.build.get_job(job_id)
 
         # Execute job
         result = self._execute(job)
@@ -560,22 +1599,133 @@ class ExecutionManager(object):
     def get_build_manager(self):
         return self.build_manager
 
-    def _update_build(self, f):
+    @contextlib.contextmanager
+    def _hold_build_lock(self):
+        """Holds the build lock for the with block and records how long it
+        was held for, nested holds are counted as part of the outermost one
+        """
         with self._build_lock:
-            return f()
+            self._build_lock_depth += 1
+            try:
+                if self._build_lock_depth > 1:
+                    yield
+                else:
+                    with builder.metrics.timer(BUILD_LOCK_HOLD_TIME):
+                        yield
+            finally:
+                self._build_lock_depth -= 1
+
+    def _update_build(self, f):
+        """Runs f while holding the build lock and then publishes a new
+        snapshot of the execution manager's state
+        """
+        with self._hold_build_lock():
+            result = f()
+            self._publish_snapshot()
+            return result
+
+    def _publish_snapshot(self):
+        """Publishes a new ExecutionSnapshot, must be called while holding
+        the build lock
+        """
+        self._version += 1
+        status = {
+            'version': self._version,
+            'n_submitted_jobs': self.submitted_jobs,
+            'n_completed_jobs': self.completed_jobs,
+            'running_jobs': [(k, v.isoformat()) for k, v in self.get_running_jobs()],
+            'last_job_executed_on': unicode(self.last_job_executed_on),
+            'last_job_submitted_on': unicode(self.last_job_submitted_on),
+            'last_job_completed_on': unicode(self.last_job_completed_on),
+            'last_job_worked_on': unicode(self.last_job_worked_on),
+            'bulk_refresh_times': dict(self.bulk_refresh_times),
+            'update_coalescing': self.update_aggregator.get_metrics(),
+            'retention': (self.graph_pruner.get_status()
+                          if self.graph_pruner is not None else None),
+            'resources': (self.resource_pool.get_status()
+                          if self.resource_pool is not None else None),
+            'n_scheduled_retries': self.n_scheduled_retries,
+            'n_pending_timers': len(self.timer_queue),
+            'circuit_breakers': dict(
+                (k, dict(v.get_status(), n_paused_jobs=len(self._paused_job_ids.get(k, ()))))
+                for k, v in self.circuit_breakers.iteritems()),
+            'n_build_graph_nodes': len(self.build.node),
+            'n_rdg_nodes': len(self.build_manager.get_rule_dependency_graph().node)
+        }
+        self._snapshot = ExecutionSnapshot(self._version, status)
+
+    def get_snapshot(self):
+        """Returns the most recently published ExecutionSnapshot, does not
+        need the build lock
+        """
+        return self._snapshot
+
+    def _is_graph_snapshot_fresh(self, graph_snapshot):
+        if graph_snapshot is None:
+            return False
+        if graph_snapshot.version == self._version:
+            return True
+        return time.time() - self._graph_snapshot_on < self.graph_snapshot_interval
+
+    def get_graph_snapshot(self):
+        """Returns a BuildGraphSnapshot of the build graph
+
+        Copying the graph holds the build lock for time proportional to the
+        size of the graph, so a new copy is made at most once every
+        graph_snapshot_interval seconds and only if the execution manager's
+        version changed. In between, readers get the last copy, which may
+        be up to graph_snapshot_interval seconds old.
+        """
+        graph_snapshot = self._graph_snapshot
+        if self._is_graph_snapshot_fresh(graph_snapshot):
+            return graph_snapshot
+
+        with self._hold_build_lock():
+            graph_snapshot = self._graph_snapshot
+            if not self._is_graph_snapshot_fresh(graph_snapshot):
+                graph_snapshot = build.BuildGraphSnapshot.from_build_graph(
+                        self.build, version=self._version)
+                self._graph_snapshot = graph_snapshot
+                self._graph_snapshot_on = time.time()
+            return graph_snapshot
+
+    def get_memory_report(self, deep=False):
+        """Returns a report of the memory used by the build graph
+
+        By default only the number of nodes and edges of each kind are
+        reported, the build graph keeps those counts as it changes. With
+        deep every node is sized, see builder.memory.MemoryProfiler.report.
+        The build lock is held while the graph is walked so a deep report
+        blocks the build for time proportional to the size of the graph.
+        """
+        with self._hold_build_lock():
+            if deep:
+                return self.memory_profiler.report(self.build)
+            node_counts = dict(self.build.node_counts)
+            edge_counts = dict(self.build.edge_counts)
+        return {"node_counts": node_counts, "edge_counts": edge_counts}
+
+    def update_graph_metrics(self):
+        """Sets the graph size gauges from the counts the build graph keeps
+        as it changes
+        """
+        if not builder.metrics.is_enabled():
+            return
+        with self._hold_build_lock():
+            node_counts = dict(self.build.node_counts)
+            edge_counts = dict(self.build.edge_counts)
+        GRAPH_NODES.set_values([({"kind": k}, v) for k, v in node_counts.iteritems()])
+        GRAPH_EDGES.set_values([({"kind": k}, v) for k, v in edge_counts.iteritems()])
 
     def get_running_jobs(self):
         running_jobs = []
-        for job, timestamp in self.execution_times.iteritems():
+        for job, timestamp in self.execution_times.items():
             running_jobs.append((job.get_id(), timestamp))
 
         return running_jobs
 
 
-def _submit_from_json(execution_manager, json_body):
-    payload = json.loads(json_body)
-    LOG.debug("Submitting job {}".format(payload))
-
+def _clean_submission(payload):
     # Clean up the payload a bit
     build_context = payload.get('build_context', {})
     for k in ('start_time', 'end_time'):
@@ -583,14 +1733,55 @@ def _submit_from_json(execution_manager, json_body):
             LOG.debug("converting {}".format(k))
             build_context[k] = arrow.get(build_context[k])
     LOG.debug("build_context is {}".format(build_context))
+    return payload
+
+def _submit_from_json(execution_manager, json_body):
+    payload = json.loads(json_body)
+    LOG.debug("Submitting job {}".format(payload))
 
-    execution_manager.submit(**payload)
+    execution_manager.submit(**_clean_submission(payload))
+
+def _submit_batch_from_json(execution_manager, json_body):
+    payload = json.loads(json_body)
+    if isinstance(payload, dict):
+        payload = payload["submissions"]
+    LOG.debug("Submitting {} jobs".format(len(payload)))
+
+    return execution_manager.submit_many(
+            [_clean_submission(x) for x in payload])
 
 def _update_from_json(execution_manager, json_body):
+    """Adds the target ids in json_body to the next update flush, raises
+    ValueError if any of them are not targets in the build graph
+    """
     payload = json.loads(json_body)
     LOG.debug("Updating target(s) {}".format(payload))
 
-    execution_manager.update_targets(payload["target_ids"])
+    target_ids = payload["target_ids"]
+    build_graph = execution_manager.build
+    with execution_manager._hold_build_lock():
+        unknown_ids = [x for x in target_ids
+                       if x not in build_graph or not build_graph.is_target(x)]
+    if unknown_ids:
+        raise ValueError("Unknown target ids: {}".format(", ".join(unknown_ids)))
+    return execution_manager.update_aggregator.add(target_ids)
+
+
+def _get_int_argument(handler, name, default, minimum=0):
+    """Returns the request argument name as an int, default if it is not
+    given. Raises ValueError with a message for the client if it is not an
+    int of at least minimum
+    """
+    value = handler.get_argument(name, default=None)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError("{} must be an integer, got {!r}".format(name, value))
+    if value < minimum:
+        raise ValueError("{} must be at least {}, got {}".format(name, minimum, value))
+    return value
 
 
 class SubmitHandler(RequestHandler):
@@ -602,78 +1793,172 @@ class SubmitHandler(RequestHandler):
         LOG.debug("{}".format(self.request.body))
         self.work_queue.submit(_submit_from_json, self.execution_manager, self.request.body)
 
-class UpdateHandler(RequestHandler):
+class SubmitBatchHandler(RequestHandler):
+    """Submits many jobs at once, the body is either a list of submissions
+    or a dict with the list under "submissions". Each submission has the
+    same form as the body of /submit.
+    """
     def initialize(self, execution_manager, work_queue):
         self.execution_manager = execution_manager
         self.work_queue = work_queue
 
     def post(self):
         LOG.debug("{}".format(self.request.body))
-        self.work_queue.submit(_update_from_json, self.execution_manager, self.request.body)
+        self.work_queue.submit(_submit_batch_from_json, self.execution_manager, self.request.body)
+
+class UpdateHandler(RequestHandler):
+    def initialize(self, execution_manager):
+        self.execution_manager = execution_manager
+
+    def post(self):
+        LOG.debug("{}".format(self.request.body))
+        try:
+            n_pending = _update_from_json(self.execution_manager, self.request.body)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"status": False, "message": str(e)})
+            return
+        self.write({"status": True, "message": "Updating", "n_pending": n_pending})
 
 class UpdateTopMostHandler(RequestHandler):
-    def initialize(self, execution_manager, work_queue):
+    def initialize(self, execution_manager):
         self.execution_manager = execution_manager
-        self.updating = False
-        self.executor = work_queue
 
     def post(self):
-        if self.updating:
+        if not self.execution_manager.update_aggregator.update_top_most():
             LOG.debug("Not updating; Update already in progress")
             self.write({"status": False, "message": "Update in progress"})
-        self.updating = True
+            return
         LOG.debug("Updating topmost")
-        self.executor.submit(self.update)
         self.write({"status": True, "message": "Updating"})
 
-    def update(self):
-        self.execution_manager.update_top_most()
-        LOG.debug("Updating topmost complete")
-        self.updating = False
-
 class StatusHandler(RequestHandler):
     def initialize(self, execution_manager):
         self.execution_manager = execution_manager
 
     def get(self):
-        status = {
-            'n_submitted_jobs': self.execution_manager.submitted_jobs,
-            'n_completed_jobs': self.execution_manager.completed_jobs,
-            'running_jobs': [(k, v.isoformat()) for k, v in self.execution_manager.get_running_jobs()],
-            'last_job_executed_on': unicode(self.execution_manager.last_job_executed_on),
-            'last_job_submitted_on': unicode(self.execution_manager.last_job_submitted_on),
-            'last_job_completed_on': unicode(self.execution_manager.last_job_completed_on),
-            'last_job_worked_on': unicode(self.execution_manager.last_job_worked_on),
-            'n_build_graph_nodes': len(self.execution_manager.get_build().node),
-            'n_rdg_nodes': len(self.execution_manager.get_build_manager().get_rule_dependency_graph().node)
-        }
+        self.write(self.execution_manager.get_snapshot().status)
 
-        self.write(status)
+class MetricsHandler(RequestHandler):
+    def initialize(self, execution_manager, read_queue):
+        self.execution_manager = execution_manager
+        self.read_queue = read_queue
+
+    @gen.coroutine
+    def get(self):
+        yield self.read_queue.submit(self.execution_manager.update_graph_metrics)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(builder.metrics.render())
+
+class TraceHandler(RequestHandler):
+    """Writes the recently recorded spans as Chrome trace event json, the
+    spans are cleared after they are written if clear is passed
+    """
+    def get(self):
+        data = builder.tracing.get_chrome_trace()
+        if self.get_argument("clear", default=None):
+            builder.tracing.clear()
+        self.write(data)
+
+class MemoryHandler(RequestHandler):
+    def initialize(self, execution_manager, read_queue):
+        self.execution_manager = execution_manager
+        self.read_queue = read_queue
+
+    @gen.coroutine
+    def get(self):
+        deep = bool(self.get_argument("deep", default=None))
+        data = yield self.read_queue.submit(
+            self.execution_manager.get_memory_report, deep=deep)
+        self.write(data)
 
 class RDGHandler(RequestHandler):
-    def initialize(self, execution_manager):
+    def initialize(self, execution_manager, read_queue):
         self.execution_manager = execution_manager
         self.build_manager = self.execution_manager.get_build_manager()
+        self.read_queue = read_queue
 
+    @gen.coroutine
     def get(self):
         LOG.info("Getting RDG")
         rdg = self.build_manager.get_rule_dependency_graph()
-        data = nx.to_agraph(rdg).string()
+        data = yield self.read_queue.submit(lambda: nx.to_agraph(rdg).string())
         self.write(data)
 
 
 
+class GraphRenderer(object):
+    """Renders build graphs in the background and caches the results
+
+    Renders are keyed by the format, the query and the version of the graph
+    so identical requests against an unchanged graph share a single render,
+    including one that is still in progress. The dot source is generated in
+    memory and piped to dot on stdin.
+
+    args:
+        max_workers: The number of renders that can run at once
+        cache_size: The number of renders to keep
+    """
+    dot_command = '/usr/bin/dot' if os.path.exists('/usr/bin/dot') else 'dot'
+    max_dot_size = 4e6
+
+    def __init__(self, max_workers=2, cache_size=32):
+        self.executor = builder.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, build_graph, query, format):
+        """Returns a future for the graph rendered in format
+
+        The result is None if the graph is too big to be rendered
+        """
+        build_query = build.BuildQuery(build_graph, query)
+        key = (format, build_query.cache_key, build_graph.version)
+        with self._lock:
+            future = self._cache.pop(key, None)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self.executor.submit(self._render, build_graph, build_query, format)
+            self._cache[key] = future
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return future
+
+    def _render(self, build_graph, build_query, format):
+        dot = build.BuildGraphTransformer(build_graph).to_dot(build_query)
+        if format == 'dot':
+            return dot
+        if len(dot) > self.max_dot_size:
+            return None
+
+        proc = subprocess.Popen([self.dot_command, '-T' + format],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate(dot)
+        if proc.returncode != 0:
+            raise RuntimeError("dot exited with {}: {}".format(proc.returncode, stderr))
+        return stdout
+
+
 class BuildGraphHandler(RequestHandler):
     ALL = object()
 
-    def initialize(self, execution_manager):
+    def initialize(self, execution_manager, read_queue, renderer):
         self.execution_manager = execution_manager
         self.build_manager = self.execution_manager.get_build_manager()
+        self.read_queue = read_queue
+        self.renderer = renderer
 
 
+    @gen.coroutine
     def get(self, format='json'):
-        LOG.info("Getting build graph as dot format")
-        build_graph = self.execution_manager.get_build()
+        if format == 'html':
+            self.render('build-graph.html')
+            return
+
+        LOG.info("Getting build graph as {} format".format(format))
+        build_graph = yield self.read_queue.submit(
+                self.execution_manager.get_graph_snapshot)
 
         LOG.debug("Updating graph display status")
 
@@ -686,27 +1971,20 @@ class BuildGraphHandler(RequestHandler):
             'excludes': self.get_arguments('exclude'),
             'include_neighbors': self.get_argument('neighbors', default=None)
         }
-        transformer = builder.build.BuildGraphTransformer(build_graph)
-        #data = self._convert_graph_to_json_and_update(build_graph, include_edges, query)
+        transformer = build.BuildGraphTransformer(build_graph)
 
         LOG.debug("Finished updating graph display status")
-        if format == 'dot':
-            data = transformer.to_dot(query)
+        if format == 'ndjson':
+            yield self._stream_ndjson(transformer, query, include_edges)
+        elif format == 'dot':
+            data = yield self.renderer.render(build_graph, query, format)
             self.write(data)
-        elif format == 'html':
-            self.render('build-graph.html')
         elif format in {'pdf', 'png', 'jpg'}:
-            dot_file = tempfile.NamedTemporaryFile()
-            transformer.write_dot(dot_file.name, query)
-            with open(dot_file.name) as f:
-                length = len(f.read())
-                if length > 4e6:
-                    self.write("Error: Graph is too big, not converting")
-                    return
-            pdf_file = tempfile.NamedTemporaryFile()
-            subprocess.call(['/usr/bin/dot', '-T'+format, dot_file.name, '-o', pdf_file.name])
-            pdf_file.seek(0)
-            self.write(pdf_file.read())
+            data = yield self.renderer.render(build_graph, query, format)
+            if data is None:
+                self.write("Error: Graph is too big, not converting")
+                return
+            self.write(data)
             if format == 'pdf':
                 mime_type = 'application/pdf'
             elif format == 'png':
@@ -715,24 +1993,80 @@ class BuildGraphHandler(RequestHandler):
                 mime_type = 'image/jpeg'
             self.set_header('Content-Type', mime_type)
         else:
-            data = transformer.to_json(include_edges, query)
+            data = yield self.read_queue.submit(transformer.to_json, include_edges, query)
             self.write(data)
 
+    @gen.coroutine
+    def _stream_ndjson(self, transformer, query, include_edges):
+        """Streams the selected nodes as newline delimited json in chunks of
+        chunk_size records, flushing after every chunk
+
+        Arguments:
+            offset: The number of records to skip
+            limit: The maximum number of records to send
+            field: A state field to include, may be given multiple times or
+                as a comma separated list. All fields are sent by default
+            chunk_size: The number of records to send in each chunk
+        """
+        try:
+            offset = _get_int_argument(self, 'offset', 0)
+            limit = _get_int_argument(self, 'limit', None)
+            chunk_size = _get_int_argument(self, 'chunk_size', 1000, minimum=1)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"status": False, "message": str(e)})
+            return
+        fields = None
+        if self.get_arguments('field'):
+            fields = set()
+            for field in self.get_arguments('field'):
+                fields.update(x for x in field.split(',') if x)
+
+        total = yield self.read_queue.submit(transformer.count_selected, query)
+        self.set_header('Content-Type', 'application/x-ndjson')
+        self.set_header('X-Total-Count', str(total))
+        if limit is not None and offset + limit < total:
+            self.set_header('X-Next-Offset', str(offset + limit))
+
+        lines = transformer.iter_ndjson(query, include_edges, fields, offset, limit)
+        take_chunk = lambda: ''.join(itertools.islice(lines, chunk_size))
+        while True:
+            chunk = yield self.read_queue.submit(take_chunk)
+            if not chunk:
+                break
+            self.write(chunk)
+            yield self.flush()
+
 
 
 class ExecutionDaemon(object):
 
-    def __init__(self, execution_manager, port=20345, debug=False):
+    def __init__(self, execution_manager, port=20345, debug=False, metrics=False,
+                 trace_sample_rate=None):
+        config = execution_manager.config or {}
+        if metrics or config.get("metrics"):
+            builder.metrics.enable()
+        if trace_sample_rate is None:
+            trace_sample_rate = config.get("trace_sample_rate")
+        builder.tracing.configure(sample_rate=trace_sample_rate,
+                                  buffer_size=config.get("trace_buffer_size"))
         work_queue = builder.futures.ThreadPoolExecutor(max_workers=2)
+        read_queue = builder.futures.ThreadPoolExecutor(max_workers=2)
+        renderer = GraphRenderer()
         self.execution_manager = execution_manager
         self.application = Application([
             (r"/submit", SubmitHandler, {"execution_manager" : self.execution_manager, "work_queue": work_queue}),
-            (r"/update", UpdateHandler, {"execution_manager" : self.execution_manager, "work_queue": work_queue}),
-            (r"/update_top_most", UpdateTopMostHandler, {"execution_manager" : self.execution_manager,
-                                                         "work_queue": work_queue}),
+            (r"/submit_batch", SubmitBatchHandler, {"execution_manager" : self.execution_manager, "work_queue": work_queue}),
+            (r"/update", UpdateHandler, {"execution_manager" : self.execution_manager}),
+            (r"/update_top_most", UpdateTopMostHandler, {"execution_manager" : self.execution_manager}),
             (r"/status", StatusHandler, {"execution_manager" : self.execution_manager}),
-            (r"/rdg", RDGHandler, {"execution_manager" : self.execution_manager}),
-            (r"/build-graph\.?(?P<format>[^\/]+)?", BuildGraphHandler, {"execution_manager" : self.execution_manager}),
+            (r"/trace", TraceHandler),
+            (r"/memory", MemoryHandler, {"execution_manager" : self.execution_manager, "read_queue": read_queue}),
+            (r"/metrics", MetricsHandler, {"execution_manager" : self.execution_manager, "read_queue": read_queue}),
+            (r"/rdg", RDGHandler, {"execution_manager" : self.execution_manager, "read_queue": read_queue}),
+            (r"/build-graph\.?(?P<format>[^\/]+)?", BuildGraphHandler, {"execution_manager" : self.execution_manager,
+                                                                         "read_queue": read_queue,
+                                                                         "renderer": renderer}),
             (r'/static/(.*)', StaticFileHandler, {'path': os.path.join(os.path.dirname(__file__), 'static')}),
         ], template_path=os.path.join(os.path.dirname(__file__), 'static'), debug=debug)
         self.port = port
@@ -8,9 +8,28 @@ import collections
 import arrow
 
 import builder.expanders
+import builder.metrics
 import builder.targets
 from builder.util import convert_to_timedelta
 
+SHOULD_RUN_RECOMPUTATIONS = builder.metrics.counter(
+        "builder_should_run_recomputations_total",
+        "Number of times a job's should run value was recomputed")
+
+# cache_time values converted to seconds, they are shared by every job of a
+# job definition so they are only converted once
+_CACHE_SECONDS = {}
+
+
+def get_cache_seconds(cache_time):
+    """Returns the number of seconds in cache_time"""
+    seconds = _CACHE_SECONDS.get(cache_time)
+    if seconds is None:
+        seconds = convert_to_timedelta(cache_time).total_seconds()
+        _CACHE_SECONDS[cache_time] = seconds
+    return seconds
+
+
 class Job(object):
     """A Job is a particular run of a JobDefinition.
     """
@@ -39,6 +58,12 @@ class Job(object):
         self.expanded_directions = {"up": False, "down": False}
         self.is_running = False
         self.force = False
+        # The time a failed job will be retried at, None when it is not
+        # waiting for a retry
+        self.retry_on = None
+        # The time a re-evaluation is scheduled at for when the job goes
+        # past its cache time
+        self.cache_expires_on = None
 
     def __repr__(self):
         return "{}:{}".format(self.unexpanded_id, self.unique_id)
@@ -214,16 +239,9 @@ class Job(object):
         if self.buildable is not None:
             return self.buildable
 
-        for dependency_node_id in self.build_graph.predecessors(self.unique_id):
-            dependency_node = self.build_graph.node[dependency_node_id]
-            dependency_func = dependency_node["object"].func
-            buildable_ids = self.build_graph.predecessors(dependency_node_id)
-            buildable_nodes = []
-            for buildable_id in buildable_ids:
-                buildable_nodes.append(
-                    self.build_graph.node[buildable_id]["object"])
-            buildable = dependency_func(buildable_nodes)
-            if not buildable:
+        node = self.build_graph.node
+        for dependency_node_id in self.build_graph.predecessors_iter(self.unique_id):
+            if not node[dependency_node_id]["object"].is_met():
                 self.buildable = False
                 return False
 
@@ -242,19 +260,33 @@ class Job(object):
         This implementation returns true if the oldest mtime is older than
         the cache_time or if non of the targets exist
         """
-        cache_time = self.cache_time
-        if cache_time is None:
+        if self.cache_time is None:
             return True
-        cache_delta = convert_to_timedelta(cache_time)
-        current_time = arrow.get()
-        for target_edge in self.build_graph.out_edges(self.unique_id, data=True):
-            if target_edge[2]["kind"] == "produces":
-                target = self.build_graph.node[target_edge[1]]["object"]
-                if not target.get_exists():
-                    return True
-                elif arrow.get(target.get_mtime()) + cache_delta < current_time:
-                    return True
-        return False
+        cache_expiry = self.get_cache_expiry()
+        return cache_expiry is not None and cache_expiry < arrow.get().float_timestamp
+
+    def get_cache_expiry(self):
+        """Returns the timestamp the job goes past its cache time at, 0 if a
+        target it produces does not exist and None if it has no cache time
+        or produces no targets
+
+        The job is past its cache time once the oldest target it produces is
+        older than the cache_time.
+        """
+        if self.cache_time is None:
+            return None
+        cache_seconds = get_cache_seconds(self.cache_time)
+        cache_expiry = None
+        for target_id, edge_data in self.build_graph.succ[self.unique_id].iteritems():
+            if edge_data["kind"] != "produces":
+                continue
+            target = self.build_graph.node[target_id]["object"]
+            if not target.get_exists():
+                return 0
+            expiry = arrow.get(target.get_mtime()).float_timestamp + cache_seconds
+            if cache_expiry is None or expiry < cache_expiry:
+                cache_expiry = expiry
+        return cache_expiry
 
     def all_dependencies(self):
         """Returns whether or not all the jobs dependencies exist"""
@@ -354,6 +386,7 @@ class Job(object):
         if self.should_run is not None:
             return self.should_run
 
+        SHOULD_RUN_RECOMPUTATIONS.inc()
         has_cache_time = self.cache_time is not None
         stale = self.get_stale()
         buildable = self.get_buildable()
@@ -405,6 +438,78 @@ class Job(object):
         """
         return self.unique_id
 
+class JobBatch(object):
+    """Adjacent jobs of the same job definition that are executed with a
+    single command
+
+    The batch is not a node in the build graph. Executors that support
+    batches execute it like a job and finishing it finishes every member.
+
+    args:
+        jobs: The member jobs sorted by start time, the build context window
+            of each job must end where the next one starts
+    """
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        first, last = self.jobs[0], self.jobs[-1]
+        self.job = first.job
+        self.unexpanded_id = first.unexpanded_id
+        self.config = first.config
+        self.build_graph = first.build_graph
+        self.unique_id = "{}..{}".format(first.unique_id, last.unique_id)
+        self.build_context = dict(first.build_context,
+                                  end_time=last.build_context["end_time"])
+
+    def __repr__(self):
+        return "{}:{}".format(self.unexpanded_id, self.unique_id)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    @staticmethod
+    def group(jobs, max_batch_size):
+        """Splits jobs in to lists of adjacent jobs of the same job
+        definition with at most max_batch_size jobs each
+
+        Jobs without a start and end time in their build context are put in
+        lists of their own.
+        """
+        by_definition = collections.defaultdict(list)
+        groups = []
+        for job in jobs:
+            if ("start_time" in job.build_context
+                    and "end_time" in job.build_context):
+                by_definition[job.unexpanded_id].append(job)
+            else:
+                groups.append([job])
+
+        for definition_jobs in by_definition.itervalues():
+            definition_jobs.sort(key=lambda x: x.build_context["start_time"])
+            group = []
+            for job in definition_jobs:
+                if group and (len(group) >= max_batch_size
+                              or group[-1].build_context["end_time"]
+                              != job.build_context["start_time"]):
+                    groups.append(group)
+                    group = []
+                group.append(job)
+            groups.append(group)
+        return groups
+
+    def get_id(self):
+        return self.unique_id
+
+    def get_member_ids(self):
+        return [job.unique_id for job in self.jobs]
+
+    def get_command(self):
+        """Returns the command that executes every member"""
+        return self.job.get_batch_command(
+                self.get_member_ids(),
+                [job.build_context for job in self.jobs],
+                self.build_graph)
+
+
 class TimestampExpandedJob(Job):
     def __init__(self, job, unique_id, build_graph, build_context):
         super(TimestampExpandedJob, self).__init__(job,
@@ -494,6 +599,24 @@ class JobDefinition(object):
         """Used to get the command related to the command"""
         return self.command
 
+    def get_max_batch_size(self):
+        """Returns the most jobs of this definition that can be executed by
+        one batch command, batching is off when it is 1
+
+        Set max_batch_size in the config to turn batching on, the job
+        definition must also implement get_batch_command.
+        """
+        return self.config.get("max_batch_size", 1)
+
+    def get_batch_command(self, unique_ids, build_contexts, build_graph):
+        """Returns a single command that does the work of the jobs with
+        unique_ids, build_contexts are their build contexts sorted by start
+        time and each one ends where the next one starts
+        """
+        raise NotImplementedError(
+                "{} has a max_batch_size but no batch command".format(
+                    self.unexpanded_id))
+
     def get_dependencies(self):
         """most jobs will depend on the existance of a file, this is what is
         returned here. It is in the form
@@ -0,0 +1,249 @@
+"""Reports on the memory used by a build graph
+
+The sizes are approximate. Each job, target and dependency node is sized by
+walking its attributes, containers are followed but other graph objects
+(the build graph, job definitions, expanders and other nodes) are not so
+that every byte is only attributed to one node. Objects shared between nodes,
+such as a build context shared by a job and its targets, are only counted the
+first time they are seen.
+
+If tracemalloc is installed and tracing, the report also holds the top
+allocation sites and how they have grown since the last report.
+"""
+
+import collections
+import sys
+import threading
+import time
+import types
+
+import networkx
+
+import builder.dependencies
+import builder.expanders
+import builder.jobs
+import builder.targets
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import logging
+LOG = logging.getLogger(__name__)
+
+KINDS = ("jobs", "targets", "dependencies", "build_contexts",
+         "node_attributes", "edge_attributes", "adjacency")
+
+# Types whose attributes are never followed when sizing an object
+_OPAQUE_TYPES = (
+    builder.jobs.Job,
+    builder.jobs.JobDefinition,
+    builder.jobs.MetaTarget,
+    builder.targets.Target,
+    builder.expanders.Expander,
+    builder.dependencies.Dependency,
+    networkx.Graph,
+    type,
+    types.FunctionType,
+    types.MethodType,
+    types.ModuleType,
+)
+
+# Attributes that hold other nodes of the graph, those are sized as nodes
+_SKIPPED_ATTRIBUTES = frozenset(["build_graph", "build_context", "job",
+                                 "members", "unknown", "dependency_nodes"])
+
+
+def get_size(obj, seen, max_depth=4):
+    """Returns the approximate number of bytes used by obj and everything it
+    holds that is not in seen. Every object that is counted is added to seen.
+
+    Graph objects and the other _OPAQUE_TYPES are not counted and not added
+    to seen so that they are still sized when they are reached as a node.
+    """
+    if id(obj) in seen or isinstance(obj, _OPAQUE_TYPES):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if max_depth <= 0:
+        return size
+
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += get_size(key, seen, max_depth - 1)
+            size += get_size(value, seen, max_depth - 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += get_size(value, seen, max_depth - 1)
+    elif hasattr(obj, "__dict__"):
+        size += get_size(obj.__dict__, seen, max_depth - 1)
+    return size
+
+
+def get_node_size(node, seen):
+    """Returns the approximate size of a job, target or dependency node not
+    counting the build graph, its job definition or its build context
+    """
+    if id(node) in seen:
+        return 0
+    seen.add(id(node))
+    size = sys.getsizeof(node, 0)
+    attributes = getattr(node, "__dict__", None)
+    if attributes is not None and id(attributes) not in seen:
+        seen.add(id(attributes))
+        size += sys.getsizeof(attributes, 0)
+        for key, value in attributes.iteritems():
+            size += get_size(key, seen)
+            if key not in _SKIPPED_ATTRIBUTES:
+                size += get_size(value, seen)
+    return size
+
+
+def get_memory_report(build_graph, top=10):
+    """Returns a json serializable dict describing the memory used by
+    build_graph
+
+    The caller must make sure the graph is not modified while the report is
+    being made.
+
+    Returns:
+        {
+            "kinds": {kind: {"count": int, "bytes": int}, ...},
+            "total_bytes": int,
+            "top_unexpanded_ids": [
+                {"unexpanded_id": str, "count": int, "bytes": int}, ...
+            ],
+        }
+    """
+    seen = set()
+    kinds = dict((kind, {"count": 0, "bytes": 0}) for kind in KINDS)
+    unexpanded_ids = collections.defaultdict(lambda: {"count": 0, "bytes": 0})
+
+    def add(kind, size):
+        kinds[kind]["count"] += 1
+        kinds[kind]["bytes"] += size
+
+    for node_id, node_data in build_graph.node.iteritems():
+        node = node_data["object"]
+        node_size = 0
+
+        build_context = getattr(node, "build_context", None)
+        if build_context is not None and id(build_context) not in seen:
+            size = get_size(build_context, seen)
+            add("build_contexts", size)
+            node_size += size
+
+        size = get_node_size(node, seen)
+        if build_graph.is_job_object(node):
+            add("jobs", size)
+        elif build_graph.is_target_object(node):
+            add("targets", size)
+        else:
+            add("dependencies", size)
+        node_size += size
+
+        size = sys.getsizeof(node_data, 0)
+        seen.add(id(node_data))
+        for key, value in node_data.iteritems():
+            if key != "object":
+                size += get_size(key, seen) + get_size(value, seen)
+        add("node_attributes", size)
+        node_size += size
+
+        for adjacency in (build_graph.succ[node_id], build_graph.pred[node_id]):
+            size = sys.getsizeof(adjacency, 0)
+            add("adjacency", size)
+            node_size += size
+        for edge_data in build_graph.succ[node_id].itervalues():
+            size = get_size(edge_data, seen)
+            add("edge_attributes", size)
+            node_size += size
+
+        unexpanded_id = getattr(node, "unexpanded_id", None)
+        if unexpanded_id is not None:
+            unexpanded_ids[unexpanded_id]["count"] += 1
+            unexpanded_ids[unexpanded_id]["bytes"] += node_size
+
+    top_unexpanded_ids = sorted(unexpanded_ids.iteritems(),
+                                key=lambda x: x[1]["bytes"], reverse=True)[:top]
+    return {
+        "kinds": kinds,
+        "total_bytes": sum(x["bytes"] for x in kinds.itervalues()),
+        "top_unexpanded_ids": [dict(unexpanded_id=k, **v)
+                               for k, v in top_unexpanded_ids],
+    }
+
+
+class MemoryProfiler(object):
+    """Makes memory reports and keeps the last one to report the growth
+    since it
+
+    args:
+        top: The number of unexpanded ids and allocation sites to report
+        tracemalloc_frames: If greater than 0 and tracemalloc is installed,
+            tracemalloc is started with this many frames per allocation
+    """
+    def __init__(self, top=10, tracemalloc_frames=0):
+        self.top = top
+        self._lock = threading.Lock()
+        self._last_report = None
+        self._last_report_on = None
+        self._last_tracemalloc_snapshot = None
+
+        if tracemalloc_frames > 0:
+            if tracemalloc is None:
+                LOG.warn("tracemalloc is not installed, not tracing allocations")
+            elif not tracemalloc.is_tracing():
+                tracemalloc.start(tracemalloc_frames)
+
+    def report(self, build_graph):
+        """Returns a memory report of build_graph with the growth since the
+        last report added under "growth" and tracemalloc statistics under
+        "tracemalloc" when it is tracing
+        """
+        with self._lock:
+            now = time.time()
+            report = get_memory_report(build_graph, top=self.top)
+            report["growth"] = self._get_growth(report, now)
+            report["tracemalloc"] = self._get_tracemalloc_report()
+            self._last_report = report
+            self._last_report_on = now
+            return report
+
+    def _get_growth(self, report, now):
+        last_report = self._last_report
+        if last_report is None:
+            return None
+        kinds = {}
+        for kind, values in report["kinds"].iteritems():
+            last_values = last_report["kinds"][kind]
+            kinds[kind] = {
+                "count": values["count"] - last_values["count"],
+                "bytes": values["bytes"] - last_values["bytes"],
+            }
+        return {
+            "seconds": now - self._last_report_on,
+            "total_bytes": report["total_bytes"] - last_report["total_bytes"],
+            "kinds": kinds,
+        }
+
+    def _get_tracemalloc_report(self):
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        top = [{"location": str(stat.traceback), "count": stat.count,
+                "bytes": stat.size}
+               for stat in snapshot.statistics("lineno")[:self.top]]
+        growth = None
+        if self._last_tracemalloc_snapshot is not None:
+            growth = [{"location": str(stat.traceback),
+                       "count": stat.count_diff, "bytes": stat.size_diff}
+                      for stat in snapshot.compare_to(
+                          self._last_tracemalloc_snapshot, "lineno")[:self.top]]
+        self._last_tracemalloc_snapshot = snapshot
+        return {
+            "traced_bytes": tracemalloc.get_traced_memory()[0],
+            "top": top,
+            "growth": growth,
+        }
@@ -0,0 +1,274 @@
+"""Prometheus style metrics for the execution daemon
+
+Metrics are registered once at import time of the module that records them
+and are disabled by default. While disabled every call to record a value
+returns immediately so the instrumented hot paths only pay for an attribute
+lookup. The daemon serves the text exposition format of every registered
+metric from /metrics.
+
+    JOB_RUN_TIME = builder.metrics.histogram(
+            "builder_job_run_seconds", "Time jobs take to run")
+
+    with builder.metrics.timer(JOB_RUN_TIME):
+        ...
+
+Labels are passed as keyword arguments when recording a value.
+"""
+
+import bisect
+import threading
+import time
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                   300, 900, 3600)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\")
+                                        .replace('"', '\\"')
+                                        .replace("\n", "\\n"))
+        for key, value in labels) + "}"
+
+
+class Metric(object):
+    """The base of all metrics
+
+    Values are kept per combination of labels, a combination is stored as a
+    sorted tuple of (label name, label value) tuples.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, registry):
+        self.name = name
+        self.documentation = documentation
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _get_key(labels):
+        if not labels:
+            return ()
+        return tuple(sorted(labels.iteritems()))
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def get_samples(self):
+        """Returns a list of (name, labels, value) tuples"""
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.iteritems())]
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        for name, labels, value in self.get_samples():
+            lines.append("{}{} {}".format(name, _format_labels(labels),
+                                          _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._get_key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down"""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_values(self, values):
+        """Replaces every value of the gauge, values is a list of
+        (labels, value) tuples where labels is a dict
+        """
+        if not self.registry.enabled:
+            return
+        values = dict((self._get_key(labels), value) for labels, value in values)
+        with self._lock:
+            self._values = values
+
+    def get(self, **labels):
+        return self._values.get(self._get_key(labels))
+
+
+class Histogram(Metric):
+    """Counts observed values in to cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, registry, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [[0] * (len(self.buckets) + 1), 0, 0.0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def get_count(self, **labels):
+        state = self._values.get(self._get_key(labels))
+        return 0 if state is None else state[1]
+
+    def get_sum(self, **labels):
+        state = self._values.get(self._get_key(labels))
+        return 0.0 if state is None else state[2]
+
+    def get_samples(self):
+        samples = []
+        with self._lock:
+            for key, (bucket_counts, count, total) in sorted(self._values.iteritems()):
+                cumulative = 0
+                for upper_bound, bucket_count in zip(self.buckets + (float("inf"),),
+                                                     bucket_counts):
+                    cumulative += bucket_count
+                    labels = key + (("le", _format_value(float(upper_bound))),)
+                    samples.append((self.name + "_bucket", labels, cumulative))
+                samples.append((self.name + "_count", key, count))
+                samples.append((self.name + "_sum", key, total))
+        return samples
+
+
+class _Timer(object):
+    """Observes the time spent in a with block in a histogram"""
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry(object):
+    """Holds metrics and renders them in the Prometheus text format"""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric_class, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, documentation, self, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric {} is already registered as a {}".format(
+                    name, metric.kind))
+            return metric
+
+    def counter(self, name, documentation):
+        return self._register(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._register(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def clear(self):
+        """Clears the values of every metric"""
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        return "".join(self._metrics[name].render() + "\n"
+                       for name in sorted(self._metrics))
+
+    def timer(self, histogram, **labels):
+        """Returns a context manager that observes the time spent in its with
+        block in histogram
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(histogram, labels)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation):
+    return REGISTRY.counter(name, documentation)
+
+def gauge(name, documentation):
+    return REGISTRY.gauge(name, documentation)
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, documentation, buckets=buckets)
+
+def timer(histogram, **labels):
+    return REGISTRY.timer(histogram, **labels)
+
+def is_enabled():
+    return REGISTRY.enabled
+
+def enable():
+    REGISTRY.enabled = True
+
+def disable():
+    REGISTRY.enabled = False
+
+def render():
+    return REGISTRY.render()
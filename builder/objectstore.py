@@ -0,0 +1,229 @@
+"""Clients used to talk to object stores
+
+An object store is addressed by a bucket and a key. Targets that live in an
+object store (see builder.targets.ObjectStoreTarget) do not talk to the store
+directly, instead they borrow a client from a ObjectStoreConnectionPool.
+
+A client must implement list_objects and head_object. list_objects is
+paginated the same way most object stores paginate their listings, a page of
+keys is returned along with a marker that is passed back in to get the next
+page. A listing with a delimiter only returns the keys that do not contain
+the delimiter after the prefix, i.e. the keys directly under a "directory".
+
+LocalDirectoryObjectStoreClient is a stand in for a real object store that is
+backed by a local directory. Every bucket is a directory under the root and
+every key is a path relative to the bucket.
+"""
+
+import bisect
+import contextlib
+import errno
+import os
+import Queue
+import threading
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+class ObjectStoreClient(object):
+    """The interface a client of an object store must implement"""
+
+    def list_objects(self, bucket, prefix, marker=None, max_keys=1000,
+                     delimiter=None):
+        """Returns a single page of the objects in bucket that start with
+        prefix
+
+        args:
+            bucket: The bucket to list
+            prefix: Only keys starting with prefix are returned
+            marker: Only keys strictly greater than the marker are returned
+            max_keys: The maximum number of keys to return in the page
+            delimiter: If given, keys that contain the delimiter after the
+                prefix are not returned
+
+        returns:
+            A tuple of the form (objects, next_marker). objects is a list of
+            (key, mtime) tuples sorted by key, next_marker is the marker to
+            use to get the next page or None if this is the last page
+        """
+        raise NotImplementedError()
+
+    def head_object(self, bucket, key):
+        """Returns the mtime of the object or None if it does not exist"""
+        raise NotImplementedError()
+
+    def close(self):
+        """Releases any resources held by the client"""
+        pass
+
+    def iter_objects(self, bucket, prefix, page_size=1000, delimiter=None):
+        """Returns an iterator over all the (key, mtime) tuples of the
+        objects in bucket that start with prefix, following the pagination
+        of list_objects
+        """
+        marker = None
+        while True:
+            objects, marker = self.list_objects(bucket, prefix, marker=marker,
+                                                max_keys=page_size,
+                                                delimiter=delimiter)
+            for key, mtime in objects:
+                yield key, mtime
+            if marker is None:
+                return
+
+
+class LocalDirectoryObjectStoreClient(ObjectStoreClient):
+    """An object store client backed by a local directory
+
+    Each bucket is a directory in root and each key is the path of a file
+    relative to it's bucket using "/" as the separator. Only "/" is
+    supported as a delimiter.
+
+    The keys of a listing are read from the directory when its first page
+    is asked for, the following pages are served from them.
+    """
+    def __init__(self, root):
+        self.root = root
+        # ((bucket, prefix, delimiter), keys, objects) of the last listing
+        self._listing = None
+
+    def _get_bucket_path(self, bucket):
+        return os.path.join(self.root, bucket)
+
+    def _get_keys(self, bucket, prefix, delimiter=None):
+        """Returns a sorted list of all the (key, mtime) tuples in the bucket
+        starting with prefix
+        """
+        if delimiter not in (None, "/"):
+            raise ValueError("Unsupported delimiter {!r}".format(delimiter))
+        bucket_path = self._get_bucket_path(bucket)
+        # Only walk the deepest directory that can contain the prefix
+        prefix_directory = prefix.rsplit("/", 1)[0] if "/" in prefix else ""
+        walk_path = os.path.join(bucket_path, *prefix_directory.split("/"))
+
+        if delimiter is None:
+            walk = os.walk(walk_path)
+        else:
+            # Keys below the prefix's directory contain the delimiter
+            try:
+                file_names = [
+                    x for x in os.listdir(walk_path)
+                    if not os.path.isdir(os.path.join(walk_path, x))]
+                walk = [(walk_path, None, file_names)]
+            except OSError as oserror:
+                if oserror.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise oserror
+                walk = []
+
+        objects = []
+        for directory, _, file_names in walk:
+            relative_directory = os.path.relpath(directory, bucket_path)
+            for file_name in file_names:
+                if relative_directory == os.curdir:
+                    key = file_name
+                else:
+                    key = "/".join(relative_directory.split(os.sep) +
+                                   [file_name])
+                if not key.startswith(prefix):
+                    continue
+                mtime = self.head_object(bucket, key)
+                if mtime is not None:
+                    objects.append((key, mtime))
+        objects.sort()
+        return objects
+
+    def list_objects(self, bucket, prefix, marker=None, max_keys=1000,
+                     delimiter=None):
+        listing_key = (bucket, prefix, delimiter)
+        if (marker is None or self._listing is None
+                or self._listing[0] != listing_key):
+            objects = self._get_keys(bucket, prefix, delimiter=delimiter)
+            self._listing = (listing_key, [x[0] for x in objects], objects)
+        _, keys, objects = self._listing
+
+        start = 0
+        if marker is not None:
+            start = bisect.bisect_right(keys, marker)
+        page = objects[start:start + max_keys]
+        next_marker = None
+        if start + max_keys < len(objects):
+            next_marker = page[-1][0]
+        return page, next_marker
+
+    def head_object(self, bucket, key):
+        path = os.path.join(self._get_bucket_path(bucket), *key.split("/"))
+        try:
+            return os.stat(path).st_mtime
+        except OSError as oserror:
+            if oserror.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise oserror
+
+
+class ObjectStoreConnectionPool(object):
+    """A pool of object store clients
+
+    At most max_size clients are handed out at once, idle clients are reused
+    so that the connection setup cost is only paid once per client.
+
+    args:
+        client_factory: A callable that takes no arguments and returns a new
+            ObjectStoreClient
+        max_size: The maximum number of clients that can be in use at once
+        page_size: The number of keys to ask for in each listing request
+    """
+    def __init__(self, client_factory, max_size=8, page_size=1000):
+        self.client_factory = client_factory
+        self.max_size = max_size
+        self.page_size = page_size
+
+        self._idle_clients = Queue.LifoQueue()
+        self._semaphore = threading.BoundedSemaphore(max_size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrows a client from the pool for the duration of the with block
+
+        If the block raises, the client is closed instead of being returned
+        to the pool as it may be in a bad state.
+        """
+        self._semaphore.acquire()
+        try:
+            try:
+                client = self._idle_clients.get_nowait()
+            except Queue.Empty:
+                client = self.client_factory()
+
+            try:
+                yield client
+            except Exception:
+                client.close()
+                raise
+            else:
+                self._idle_clients.put(client)
+        finally:
+            self._semaphore.release()
+
+    def list_prefix(self, bucket, prefix, delimiter=None):
+        """Returns a dict of key to mtime for every object in bucket starting
+        with prefix, keys that contain delimiter after the prefix are left
+        out if it is given
+        """
+        with self.connection() as client:
+            return dict(client.iter_objects(bucket, prefix,
+                                            page_size=self.page_size,
+                                            delimiter=delimiter))
+
+    def head_object(self, bucket, key):
+        with self.connection() as client:
+            return client.head_object(bucket, key)
+
+    def close(self):
+        """Closes all the idle clients"""
+        while True:
+            try:
+                client = self._idle_clients.get_nowait()
+            except Queue.Empty:
+                return
+            client.close()
@@ -0,0 +1,126 @@
+"""A small helper process that starts shell commands for LocalExecutor
+
+Starting a process with subprocess.Popen forks the calling process. When
+the caller is a daemon holding a large build graph every fork copies its
+page tables and every page it writes to while the child starts, so spawning
+gets slower and memory spikes as the graph grows. The spawner is a new
+interpreter that only imports the standard library. The daemon sends it the
+commands to run over a pipe and it does the forking, so the cost of
+starting a job does not depend on the size of the daemon.
+
+Requests and responses are pickled on to the spawner's stdin and stdout.
+A request is the command as a list of arguments and a response is the
+tuple (returncode, stdout, stderr), returncode is None if the command could
+not be started.
+"""
+
+import cPickle
+import os
+import subprocess
+import sys
+import threading
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+def _serve(requests, responses):
+    while True:
+        try:
+            command_list = cPickle.load(requests)
+        except EOFError:
+            return
+        try:
+            proc = subprocess.Popen(command_list, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, close_fds=True)
+            stdout, stderr = proc.communicate()
+            response = (proc.returncode, stdout, stderr)
+        except OSError as e:
+            response = (None, "", "Could not start {}: {}".format(
+                command_list, e))
+        cPickle.dump(response, responses, cPickle.HIGHEST_PROTOCOL)
+        responses.flush()
+
+
+def main():
+    requests = sys.stdin
+    # Keep anything written to stdout off of the response pipe
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    _serve(requests, responses)
+
+
+class Spawner(object):
+    """Runs commands through a spawner process, one at a time
+
+    The spawner process is started by start or by the first run and is
+    restarted if it exits.
+    """
+    def __init__(self):
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        path = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        self._process = subprocess.Popen(
+                [sys.executable, path], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, close_fds=True)
+        LOG.info("Started spawner {}".format(self._process.pid))
+
+    def start(self):
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+
+    def get_pid(self):
+        return self._process.pid if self._process is not None else None
+
+    def run(self, command_list):
+        """Runs command_list and waits for it to exit, returns its return
+        code, stdout and stderr
+        """
+        with self._lock:
+            # The command is only sent again if it could not be sent, once
+            # it has been sent it may have been started and running it again
+            # could run it twice
+            for _ in xrange(2):
+                if self._process is None or self._process.poll() is not None:
+                    self._start()
+                try:
+                    cPickle.dump(command_list, self._process.stdin,
+                                 cPickle.HIGHEST_PROTOCOL)
+                    self._process.stdin.flush()
+                except IOError as e:
+                    LOG.warn("Spawner {} failed receiving {}: {}".format(
+                        self._process.pid, command_list, e))
+                    self._stop(kill=True)
+                    continue
+                try:
+                    return cPickle.load(self._process.stdout)
+                except (IOError, EOFError, cPickle.UnpicklingError) as e:
+                    LOG.warn("Spawner {} failed running {}: {}".format(
+                        self._process.pid, command_list, e))
+                    self._stop(kill=True)
+                    return None, "", "The spawner failed running {}: {}".format(
+                        command_list, e)
+            return None, "", "The spawner could not run {}".format(command_list)
+
+    def _stop(self, kill=False):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        if kill and self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process = None
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,26 @@
 Likely these targets will be abstract target's, non abstract targets will
 maybe be defined in something that looks a little more config like
 """
+import collections
 import errno
 import fnmatch
 import glob
 import os
+import re
+import time
 
 import abc
 
+import builder.futures
+import builder.metrics
+
+import logging
+LOG = logging.getLogger(__name__)
+
+STAT_CALLS = builder.metrics.counter(
+        "builder_target_stat_calls_total",
+        "Number of target mtimes fetched from their backend")
+
 class Target(object):
     """A target class is one that can express certain attributes that are
     common to all targets
@@ -29,6 +42,12 @@ class Target(object):
         config: A dictionary of properties that the target may use as a config
     """
     def __init__(self, unexpanded_id, unique_id, build_context, config=None):
+        # The dependency nodes the target is a member of and whether or not
+        # they have counted it as existing, see
+        # builder.dependencies.Dependency
+        self.dependency_nodes = []
+        self.counted_exists = None
+
         self.unexpanded_id = unexpanded_id
         self.unique_id = unique_id
         self.build_context = build_context
@@ -36,15 +55,50 @@ class Target(object):
 
         self.cached_mtime = False
         self.mtime = None
+        self.cached_on = None
 
         self.expanded_directions = {"up": False, "down": False}
 
+    # The maximum number of targets of this type passed to a single
+    # get_bulk_exists_mtime call by get_bulk_exists_mtime_parallel, None
+    # to never split the targets up
+    bulk_chunk_size = 1000
+
     def __repr__(self):
         return "Target({unexpanded_id}, {unique_id}, mtime={mtime}, expanded_directions={expanded_directions}, cached={cached})".format(
             unexpanded_id=self.unexpanded_id, cached=self.cached_mtime,
             unique_id=self.unique_id, mtime=self.mtime, expanded_directions=self.expanded_directions
         )
 
+    @property
+    def mtime(self):
+        return self._mtime
+
+    @mtime.setter
+    def mtime(self, mtime):
+        self._mtime = mtime
+        self._update_counted_exists()
+
+    @property
+    def cached_mtime(self):
+        return self._cached_mtime
+
+    @cached_mtime.setter
+    def cached_mtime(self, cached_mtime):
+        self._cached_mtime = cached_mtime
+        self._update_counted_exists()
+
+    def _update_counted_exists(self):
+        """Tells the dependency nodes the target is a member of when whether
+        or not it is known to exist changes
+        """
+        exists = (self._mtime is not None) if self._cached_mtime else None
+        if exists is self.counted_exists:
+            return
+        for dependency in self.dependency_nodes:
+            dependency.update_member(self, self.counted_exists, exists)
+        self.counted_exists = exists
+
     def invalidate(self):
         """Sets the mtime value to not cached"""
         self.cached_mtime = False
@@ -76,8 +130,10 @@ class Target(object):
         if self.cached_mtime:
             return self.mtime
         else:
+            STAT_CALLS.inc(target_type=type(self).__name__)
             self.mtime = self.do_get_mtime()
             self.cached_mtime = True
+            self.cached_on = time.time()
             return self.mtime
 
     def set_mtime(self, mtime):
@@ -87,10 +143,21 @@ class Target(object):
         """
         self.mtime = mtime
         self.cached_mtime = True
+        self.cached_on = time.time()
 
     def is_cached(self):
         return self.cached_mtime
 
+    def get_cache_age(self, now=None):
+        """Returns the number of seconds since the cached mtime was
+        retrieved or None if there is no cached mtime
+        """
+        if not self.cached_mtime or self.cached_on is None:
+            return None
+        if now is None:
+            now = time.time()
+        return now - self.cached_on
+
     def get_id(self):
         """ Returns a unique ID for this target
         """
@@ -101,6 +168,10 @@ class Target(object):
     def get_bulk_exists_mtime(targets):
         """Gets the existance and mtime values for the targets in bulk
 
+        Implementations must not update the cached values of the targets, the
+        caller applies the returned values. This allows the values to be
+        fetched without holding any locks on the graph the targets are in.
+
         Returns:
             A dictionary with the form
             {
@@ -123,11 +194,76 @@ class Target(object):
                     "exists": exists,
                     "mtime": mtime,
             }
-            target.mtime = mtime
-            target.cached_mtime = True
         return exists_mtime_dict
 
 
+def get_bulk_exists_mtime_parallel(targets, max_workers=4, chunk_size=None):
+    """Gets the existance and mtime values for targets of any type in bulk
+
+    The targets are grouped by type and each group is split in to chunks of
+    the type's bulk_chunk_size, or of chunk_size if it is given and smaller.
+    Types whose bulk_chunk_size is None are never split up. Each chunk is
+    passed to the type's get_bulk_exists_mtime on a pool of at most
+    max_workers threads so that a slow type does not hold up the others.
+
+    The cached values of the targets are not updated.
+
+    Returns:
+        A tuple of the form (exists_mtime_dict, timings). exists_mtime_dict
+        is the merged result of all the get_bulk_exists_mtime calls and
+        timings is a dict of the form {target_type: seconds} holding the
+        wall clock time it took to refresh each type.
+    """
+    type_targets = collections.defaultdict(list)
+    for target in targets:
+        type_targets[type(target)].append(target)
+
+    chunks = []
+    for target_type, typed_targets in type_targets.iteritems():
+        type_chunk_size = target_type.bulk_chunk_size
+        if type_chunk_size and chunk_size:
+            type_chunk_size = min(chunk_size, type_chunk_size)
+        if not type_chunk_size:
+            chunks.append((target_type, typed_targets))
+            continue
+        for i in xrange(0, len(typed_targets), type_chunk_size):
+            chunks.append((target_type, typed_targets[i:i + type_chunk_size]))
+
+    def refresh_chunk(target_type, chunk):
+        STAT_CALLS.inc(len(chunk), target_type=target_type.__name__)
+        start = time.time()
+        exists_mtime_dict = target_type.get_bulk_exists_mtime(chunk)
+        return start, time.time(), exists_mtime_dict
+
+    if len(chunks) <= 1 or max_workers <= 1:
+        results = [(target_type, refresh_chunk(target_type, chunk))
+                   for target_type, chunk in chunks]
+    else:
+        with builder.futures.ThreadPoolExecutor(
+                max_workers=min(max_workers, len(chunks))) as executor:
+            futures = [(target_type,
+                        executor.submit(refresh_chunk, target_type, chunk))
+                       for target_type, chunk in chunks]
+            results = [(target_type, future.result())
+                       for target_type, future in futures]
+
+    exists_mtime_dict = {}
+    type_spans = {}
+    for target_type, (start, stop, chunk_exists_mtime) in results:
+        exists_mtime_dict.update(chunk_exists_mtime)
+        first_start, last_stop = type_spans.get(target_type, (start, stop))
+        type_spans[target_type] = (min(start, first_start),
+                                   max(stop, last_stop))
+
+    timings = {}
+    for target_type, (start, stop) in type_spans.iteritems():
+        timings[target_type] = stop - start
+        LOG.debug("Refreshed {} targets of type {} in {} seconds".format(
+            len(type_targets[target_type]), target_type.__name__,
+            stop - start))
+    return exists_mtime_dict, timings
+
+
 class LocalFileSystemTarget(Target):
     """A local file system target is one that lives on the local
     filesystem
@@ -167,8 +303,6 @@ class LocalFileSystemTarget(Target):
                     "exists": exists,
                     "mtime": mtime,
             }
-            target.mtime = mtime
-            target.cached_mtime = True
         return exists_mtime_dict
 
     def do_get_mtime(self):
@@ -231,3 +365,185 @@ class GlobLocalFileSystemTarget(Target):
         return exists_mtime_dict
 
 
+class PrefixListingTarget(Target):
+    """A target whose existence and mtime can be answered from a listing of
+    a prefix
+
+    Many storage systems are much cheaper to list than to query one object at
+    a time. get_bulk_exists_mtime groups the targets by their listing prefix,
+    lists each prefix once and then answers every target in the group from
+    the listing.
+
+    Subclasses implement get_listing_prefix, match_listing and list_prefix.
+    """
+    # Splitting the targets up could list the same prefix more than once
+    bulk_chunk_size = None
+
+    def get_listing_prefix(self):
+        """Returns the hashable prefix that has to be listed to answer this
+        target
+        """
+        raise NotImplementedError()
+
+    def match_listing(self, listing):
+        """Returns the mtime of the target given the listing of it's prefix
+        or None if the target does not exist in the listing
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def list_prefix(cls, prefix):
+        """Returns a dict of the form {key: mtime} containing everything
+        under prefix
+        """
+        raise NotImplementedError()
+
+    def do_get_mtime(self):
+        listing = self.list_prefix(self.get_listing_prefix())
+        return self.match_listing(listing)
+
+    @classmethod
+    def get_bulk_exists_mtime(cls, targets):
+        """Lists each distinct prefix once and answers all the targets from
+        the listings
+        """
+        prefix_targets = collections.defaultdict(list)
+        for target in targets:
+            prefix_targets[target.get_listing_prefix()].append(target)
+
+        exists_mtime_dict = {}
+        for prefix, prefix_group in prefix_targets.iteritems():
+            listing = cls.list_prefix(prefix)
+            for target in prefix_group:
+                mtime = target.match_listing(listing)
+                exists_mtime_dict[target.unique_id] = {
+                        "exists": mtime is not None,
+                        "mtime": mtime,
+                }
+        return exists_mtime_dict
+
+
+class ObjectStoreTarget(PrefixListingTarget):
+    """A target that is an object in an object store
+
+    The unique id is of the form [scheme://]bucket/key. The object store is
+    reached through the connection_pool class attribute, subclass this target
+    for each store and set connection_pool to a
+    builder.objectstore.ObjectStoreConnectionPool.
+
+    Bulk requests list the "directory" of the key once instead of asking for
+    every object, the listing uses "/" as the delimiter so only the keys
+    directly in the directory are listed. Directories with fewer than
+    min_listing_targets targets are answered with one head request per
+    target instead.
+    """
+    connection_pool = None
+    min_listing_targets = 2
+
+    object_id_expr = re.compile(r"^(?:[a-zA-Z][a-zA-Z0-9+.-]*://)?([^/]+)/(.*)$")
+
+    @classmethod
+    def get_connection_pool(cls):
+        if cls.connection_pool is None:
+            raise RuntimeError("{} does not have a connection pool".format(
+                cls.__name__))
+        return cls.connection_pool
+
+    @classmethod
+    def parse_object_id(cls, object_id):
+        """Returns the (bucket, key) that the object_id points to"""
+        match = cls.object_id_expr.match(object_id)
+        if match is None:
+            raise ValueError("{} is not of the form [scheme://]bucket/key"
+                             .format(object_id))
+        return match.group(1), match.group(2)
+
+    def get_bucket_key(self):
+        return self.parse_object_id(self.unique_id)
+
+    def get_listing_prefix(self):
+        """Returns (bucket, key prefix, delimiter)"""
+        bucket, key = self.get_bucket_key()
+        if "/" not in key:
+            return bucket, "", "/"
+        return bucket, key.rsplit("/", 1)[0] + "/", "/"
+
+    def match_listing(self, listing):
+        _, key = self.get_bucket_key()
+        return listing.get(key)
+
+    @classmethod
+    def list_prefix(cls, prefix):
+        bucket, key_prefix, delimiter = prefix
+        return cls.get_connection_pool().list_prefix(bucket, key_prefix,
+                                                     delimiter=delimiter)
+
+    def do_get_mtime(self):
+        bucket, key = self.get_bucket_key()
+        return self.get_connection_pool().head_object(bucket, key)
+
+    @classmethod
+    def get_bulk_exists_mtime(cls, targets):
+        """Lists the prefixes that hold enough targets to make a listing
+        cheaper than heads and heads the rest
+        """
+        prefix_targets = collections.defaultdict(list)
+        for target in targets:
+            prefix_targets[target.get_listing_prefix()].append(target)
+
+        listed_targets = []
+        exists_mtime_dict = {}
+        for prefix_group in prefix_targets.itervalues():
+            if len(prefix_group) >= cls.min_listing_targets:
+                listed_targets.extend(prefix_group)
+                continue
+            for target in prefix_group:
+                mtime = target.do_get_mtime()
+                exists_mtime_dict[target.unique_id] = {
+                        "exists": mtime is not None,
+                        "mtime": mtime,
+                }
+
+        exists_mtime_dict.update(
+                super(ObjectStoreTarget, cls).get_bulk_exists_mtime(
+                    listed_targets))
+        return exists_mtime_dict
+
+
+class GlobObjectStoreTarget(ObjectStoreTarget):
+    """A glob pattern matched against the keys of an object store
+
+    The unique id is of the form [scheme://]bucket/pattern. The mtime is the
+    largest mtime of the matching keys. The listing prefix is the part of
+    the pattern before the first wildcard so a pattern is always answered
+    with a listing, "/" is used as the delimiter when the rest of the
+    pattern is within a single directory.
+
+    Like GlobLocalFileSystemTarget the pattern is matched one "/" separated
+    segment at a time, wildcards do not match "/".
+    """
+    min_listing_targets = 1
+    wildcard_expr = re.compile(r"[*?[]")
+
+    def get_listing_prefix(self):
+        bucket, pattern = self.get_bucket_key()
+        prefix = self.wildcard_expr.split(pattern, 1)[0]
+        delimiter = None if "/" in pattern[len(prefix):] else "/"
+        return bucket, prefix, delimiter
+
+    def match_listing(self, listing):
+        _, pattern = self.get_bucket_key()
+        pattern_segments = pattern.split("/")
+        max_mtime = None
+        for key, mtime in listing.iteritems():
+            key_segments = key.split("/")
+            if len(key_segments) != len(pattern_segments):
+                continue
+            if all(fnmatch.fnmatchcase(x, y)
+                   for x, y in zip(key_segments, pattern_segments)):
+                if max_mtime is None or mtime > max_mtime:
+                    max_mtime = mtime
+        return max_mtime
+
+    def do_get_mtime(self):
+        return self.match_listing(self.list_prefix(self.get_listing_prefix()))
@@ -0,0 +1,37 @@
+"""Used to make sure the benchmarks keep running"""
+
+import json
+import unittest
+
+import builder.benchmarks
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_run(self):
+        # When
+        results = builder.benchmarks.run(scale=0.05, repeat=1)
+
+        # Then
+        json.dumps(results)
+        self.assertItemsEqual(results["startup"].keys(),
+                              ["import_builder", "import_build",
+                               "import_execution"])
+        self.assertItemsEqual(results["pipelines"].keys(),
+                              ["deep_chain", "wide_fan_in", "past_window",
+                               "many_metas"])
+        for name, pipeline_results in results["pipelines"].iteritems():
+            for benchmark in ("build_manager", "add_job",
+                              "bulk_refresh_targets", "get_jobs_to_run",
+                              "execution"):
+                self.assertEqual(pipeline_results[benchmark]["n"], 1)
+            self.assertEqual(pipeline_results["execution"]["n_completed_jobs"],
+                             pipeline_results["n_jobs"], name)
+
+    def test_only(self):
+        # When
+        results = builder.benchmarks.run(scale=0.05, repeat=1,
+                                         only=["deep_chain"])
+
+        # Then
+        self.assertEqual(results["pipelines"].keys(), ["deep_chain"])
@@ -1,6 +1,10 @@
 """Used to test the construction of graphs and general use of graphs"""
 
+import collections
 import copy
+import json
+import subprocess
+import sys
 import unittest
 import datetime
 
@@ -10,6 +14,7 @@ import mock
 import networkx
 
 from builder.tests.tests_jobs import *
+import builder.dependencies
 import builder.jobs
 import builder.build
 import builder.util
@@ -3694,6 +3699,64 @@ class GraphTest(unittest.TestCase):
         self.assertIn("job2_1970-01-01-00-10-00", build_update2.forced)
         self.assertIn("job2_1970-01-01-00-15-00", build_update2.forced)
 
+class BulkRefreshTargetsTest(unittest.TestCase):
+
+    def _get_build(self):
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target1", "A-target2"],
+                                    depends=["A-depends"])
+        ]
+        build_manager = builder.build.BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build.add_job("A", {})
+        for target_id, target in build.target_iter():
+            target.do_get_mtime = mock.Mock(return_value=100)
+        return build
+
+    def test_uncached_only_skips_cached_targets(self):
+        # Given
+        build = self._get_build()
+        build.get_target("A-target1").set_mtime(50)
+
+        # When
+        build.bulk_refresh_targets(uncached_only=True)
+
+        # Then
+        self.assertFalse(build.get_target("A-target1").do_get_mtime.called)
+        self.assertEqual(build.get_target("A-target1").get_mtime(), 50)
+        self.assertEqual(build.get_target("A-target2").get_mtime(), 100)
+        self.assertEqual(build.get_target("A-depends").get_mtime(), 100)
+
+    def test_refresh_all(self):
+        # Given
+        build = self._get_build()
+        build.get_target("A-target1").set_mtime(50)
+
+        # When
+        build.bulk_refresh_targets(uncached_only=False)
+
+        # Then
+        self.assertEqual(build.get_target("A-target1").get_mtime(), 100)
+
+    def test_max_age(self):
+        # Given
+        build = self._get_build()
+        old_target = build.get_target("A-target1")
+        new_target = build.get_target("A-target2")
+        old_target.set_mtime(50)
+        new_target.set_mtime(50)
+        old_target.cached_on = old_target.cached_on - 3600
+
+        # When
+        build.bulk_refresh_targets(max_age="10min")
+
+        # Then
+        self.assertEqual(old_target.get_mtime(), 100)
+        self.assertEqual(new_target.get_mtime(), 50)
+        self.assertFalse(new_target.do_get_mtime.called)
+        self.assertEqual(build.get_target("A-depends").get_mtime(), 100)
+
+
 class RuleDependencyGraphTest(unittest.TestCase):
 
     def _get_rdg(self):
@@ -3928,4 +3991,507 @@ class BuildGraphQueryTest(unittest.TestCase):
         # Then
         self.assertTrue(query.include_node("A"))
         self.assertFalse(query.include_node("A-target1"))
-        self.assertTrue(query.include_node("A-depends"))
\ No newline at end of file
+        self.assertTrue(query.include_node("A-depends"))
+
+    def test_query_uses_unexpanded_id_index(self):
+        # Given
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target1"],
+                                    depends=["A-depends"]),
+            SimpleTestJobDefinition("B", targets=["B-target1"]),
+        ]
+
+        build_manager = builder.build.BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build.add_job("A", {})
+        build.add_job("B", {})
+
+        # When
+        query = builder.build.BuildQuery(
+            build, query={'job_definition_ids': ['A'],
+                          'expander_ids': ['B-target1']})
+        candidate_ids = query._get_candidate_ids()
+        job_ids, target_ids, _ = query.get_selected_ids()
+
+        # Then
+        self.assertEqual(candidate_ids, set(["A", "B-target1"]))
+        self.assertEqual(job_ids, frozenset(["A"]))
+        self.assertEqual(target_ids, frozenset(["B-target1"]))
+
+    def test_combined_patterns(self):
+        # Given
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target1"],
+                                    depends=["A-depends"])
+        ]
+
+        build_manager = builder.build.BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build.add_job("A", {})
+
+        # When
+        query = builder.build.BuildQuery(
+            build, query={'includes': ['A-t.*', '[invalid', 'A-dep'],
+                          'excludes': ['[invalid']})
+        invalid_query = builder.build.BuildQuery(
+            build, query={'includes': ['[invalid']})
+
+        # Then
+        self.assertFalse(query.include_node("A"))
+        self.assertTrue(query.include_node("A-target1"))
+        self.assertTrue(query.include_node("A-depends"))
+        self.assertFalse(invalid_query.include_node("A"))
+        self.assertFalse(invalid_query.include_node("A-target1"))
+
+    def test_uncombinable_patterns(self):
+        # Given
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-A"],
+                                    depends=["A-depends"])
+        ]
+
+        build_manager = builder.build.BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build.add_job("A", {})
+
+        # When
+        backreference_query = builder.build.BuildQuery(
+            build, query={'includes': ['B', r'(A)-\1$']})
+        duplicate_names_query = builder.build.BuildQuery(
+            build, query={'includes': ['(?P<x>A)-d', '(?P<x>A)-A']})
+        flags_query = builder.build.BuildQuery(
+            build, query={'includes': ['X', '(?i)a-a']})
+
+        # Then
+        self.assertTrue(backreference_query.include_node("A-A"))
+        self.assertFalse(backreference_query.include_node("A-depends"))
+        self.assertTrue(duplicate_names_query.include_node("A-depends"))
+        self.assertTrue(duplicate_names_query.include_node("A-A"))
+        self.assertFalse(duplicate_names_query.include_node("A"))
+        self.assertTrue(flags_query.include_node("A-A"))
+        self.assertFalse(flags_query.include_node("x"))
+
+    def test_selected_ids_cached_by_version(self):
+        # Given
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target1"],
+                                    depends=["A-depends"]),
+            SimpleTestJobDefinition("B", targets=["B-target1"]),
+        ]
+
+        build_manager = builder.build.BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build.add_job("A", {})
+        query_dict = {'job_definition_ids': ['A', 'B']}
+
+        # When
+        first = builder.build.BuildQuery(build, query_dict).get_selected_ids()
+        second = builder.build.BuildQuery(build, query_dict).get_selected_ids()
+        version = build.version
+        build.add_job("B", {})
+        third = builder.build.BuildQuery(build, query_dict).get_selected_ids()
+
+        # Then
+        self.assertIs(first, second)
+        self.assertGreater(build.version, version)
+        self.assertEqual(first[0], frozenset(["A"]))
+        self.assertEqual(third[0], frozenset(["A", "B"]))
+
+
+class BuildGraphTransformerTest(unittest.TestCase):
+
+    def _get_build(self):
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target1", "A-target2"],
+                                    depends=["A-depends"]),
+            SimpleTestJobDefinition("B", targets=["B-target"],
+                                    depends=["A-target1"]),
+        ]
+        build_manager = builder.build.BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build.add_job("B", {})
+        return build
+
+    def test_iter_json_records_pagination(self):
+        # Given
+        build = self._get_build()
+        transformer = builder.build.BuildGraphTransformer(build)
+
+        # When
+        all_records = list(transformer.iter_json_records())
+        page1 = list(transformer.iter_json_records(offset=0, limit=3))
+        page2 = list(transformer.iter_json_records(offset=3, limit=3))
+
+        # Then
+        self.assertEqual([x["id"] for x in all_records],
+                         ["A", "B", "A-depends", "A-target1", "A-target2",
+                          "B-target"])
+        self.assertEqual(page1 + page2, all_records)
+        self.assertEqual(transformer.count_selected(), 6)
+
+    def test_iter_json_records_sorts_once_per_version(self):
+        # Given
+        build = self._get_build()
+        transformer = builder.build.BuildGraphTransformer(build)
+        sort_ids = builder.build.BuildQuery._sort_ids.im_func
+
+        # When
+        with mock.patch.object(builder.build.BuildQuery, "_sort_ids",
+                               autospec=True,
+                               side_effect=sort_ids) as mock_sort_ids:
+            page1 = list(transformer.iter_json_records(offset=0, limit=3))
+            page2 = list(transformer.iter_json_records(offset=3, limit=3))
+            sorts_before_update = mock_sort_ids.call_count
+            # As if a node was added
+            build.version += 1
+            list(transformer.iter_json_records(offset=0, limit=3))
+
+        # Then
+        self.assertEqual(len(page1 + page2), 6)
+        self.assertEqual(sorts_before_update, 1)
+        self.assertEqual(mock_sort_ids.call_count, 2)
+
+    def test_iter_json_records_fields(self):
+        # Given
+        build = self._get_build()
+        transformer = builder.build.BuildGraphTransformer(build)
+        job = build.get_job("A")
+        job.get_should_run = mock.Mock(wraps=job.get_should_run)
+
+        # When
+        records = list(transformer.iter_json_records(
+            {"job_definition_ids": ["A"]}, fields={"retries"},
+            include_edges=True))
+
+        # Then
+        self.assertEqual(len(records), 1)
+        self.assertItemsEqual(records[0].pop("targets"),
+                              ["A-target1", "A-target2"])
+        self.assertEqual(records[0], {
+            "id": "A",
+            "kind": "job",
+            "unexpanded_id": "A",
+            "retries": 0,
+            "dependencies": ["A-depends"],
+        })
+        self.assertFalse(job.get_should_run.called)
+
+    def test_iter_ndjson(self):
+        # Given
+        build = self._get_build()
+        transformer = builder.build.BuildGraphTransformer(build)
+
+        # When
+        lines = list(transformer.iter_ndjson({"expander_ids": ["B-target"]},
+                                             fields=["exists"]))
+
+        # Then
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("\n"))
+        self.assertEqual(json.loads(lines[0]), {
+            "id": "B-target", "kind": "target", "unexpanded_id": "B-target",
+            "exists": None})
+
+    def test_to_dot(self):
+        # Given
+        build = self._get_build()
+        transformer = builder.build.BuildGraphTransformer(build)
+        version = build.version
+
+        # When
+        dot = transformer.to_dot({"job_definition_ids": ["A"],
+                                  "include_neighbors": True})
+
+        # Then
+        lines = dot.splitlines()
+        self.assertEqual(lines[0], "strict digraph  {")
+        self.assertEqual(lines[-1], "}")
+        self.assertIn('"A" -> "A-target1" [ignore_mtime="false", '
+                      'ignore_produce="false", kind="produces", '
+                      'label="produces"];', lines)
+        self.assertNotIn('"B"', dot)
+        self.assertTrue(any(line.startswith('"A" [') and 'style="filled"' in line
+                            for line in lines))
+        self.assertNotIn("object", dot)
+        self.assertEqual(build.version, version)
+
+    def test_unknown_job_state(self):
+        # Given
+        build = self._get_build()
+        snapshot1 = builder.build.BuildGraphSnapshot.from_build_graph(build)
+        build.get_job("B").get_should_run()
+        snapshot2 = builder.build.BuildGraphSnapshot.from_build_graph(build)
+
+        # When
+        unknown = builder.build.BuildGraphTransformer(
+            snapshot1)._get_job_state(snapshot1.get_job("B"))
+        known = builder.build.BuildGraphTransformer(
+            snapshot2)._get_job_state(snapshot2.get_job("B"))
+
+        # Then
+        self.assertIsNone(unknown["should_run"])
+        self.assertEqual(unknown["state"], "unknown")
+        self.assertEqual(unknown["fillcolor"], "#FFFFFF")
+        self.assertNotEqual(known["state"], "unknown")
+        self.assertNotEqual(known["fillcolor"], "#FFFFFF")
+
+
+class BuildGraphRetentionTest(unittest.TestCase):
+
+    def _get_build(self):
+        jobs = [
+            SimpleTestJobDefinition(
+                "A", targets=[{"unexpanded_id": "A-target", "start_mtime": 100}],
+                depends=[{"unexpanded_id": "A-depends", "start_mtime": 50}]),
+            SimpleTestJobDefinition(
+                "B", targets=[{"unexpanded_id": "B-target", "start_mtime": 200}],
+                depends=[{"unexpanded_id": "A-target", "start_mtime": 100}]),
+        ]
+        build = builder.build.BuildManager(jobs, []).make_build()
+        build_context = {
+            "start_time": arrow.get("2015-01-01T00:00:00+00:00"),
+            "end_time": arrow.get("2015-01-01T01:00:00+00:00"),
+        }
+        build.add_job("B", build_context)
+        return build
+
+    def test_prune_job(self):
+        # Given
+        build = self._get_build()
+        version = build.version
+
+        build.get_job("B").get_should_run()
+
+        # When
+        prunable = build.is_prunable("B", arrow.get("2015-01-02T00:00:00+00:00"))
+        removed_ids = build.prune_job("B")
+
+        # Then
+        self.assertTrue(prunable)
+        self.assertEqual(removed_ids, set(["B", "B-target", "B_depends_A-target"]))
+        self.assertNotIn("B", build)
+        self.assertIn("A-target", build)
+        self.assertFalse(build.get_target("A-target").expanded_directions["down"])
+        self.assertEqual(build.get_ids_from_unexpanded_id("B"), set())
+        self.assertEqual(build.get_ids_from_unexpanded_id("B-target"), set())
+        self.assertGreater(build.version, version)
+
+    def test_prune_job_updates_counts(self):
+        # Given
+        build = self._get_build()
+
+        # When
+        build.prune_job("B")
+
+        # Then
+        node_counts = collections.Counter()
+        edge_counts = collections.Counter()
+        for node_id, node in build.node.iteritems():
+            node_counts[build.get_node_kind(node["object"])] += 1
+            for edge_data in build.succ[node_id].itervalues():
+                edge_counts[edge_data["kind"]] += 1
+        self.assertEqual(
+            {kind: count for kind, count in build.node_counts.iteritems() if count},
+            node_counts)
+        self.assertEqual(
+            {kind: count for kind, count in build.edge_counts.iteritems() if count},
+            edge_counts)
+
+    def test_is_prunable(self):
+        # Given
+        build = self._get_build()
+        older_than = arrow.get("2015-01-02T00:00:00+00:00")
+        build.get_job("A").get_should_run()
+        build.get_job("B").get_should_run()
+
+        # When
+        too_recent = build.is_prunable("B", arrow.get("2015-01-01T00:30:00+00:00"))
+        build.get_job("B").is_running = True
+        running = build.is_prunable("B", older_than)
+        build.get_job("B").is_running = False
+        build.get_job("A").is_running = True
+        dependent_running = build.is_prunable("A", older_than)
+
+        # Then
+        self.assertFalse(too_recent)
+        self.assertFalse(running)
+        self.assertFalse(dependent_running)
+        self.assertTrue(build.is_prunable("B", older_than))
+
+    def test_is_prunable_reads_cached_state(self):
+        # Given
+        build = self._get_build()
+        older_than = arrow.get("2015-01-02T00:00:00+00:00")
+        job = build.get_job("B")
+        job.get_should_run = mock.Mock(wraps=job.get_should_run)
+
+        # When
+        not_computed = build.is_prunable("B", older_than)
+        job.set_should_run(True)
+        should_run = build.is_prunable("B", older_than)
+        job.set_should_run(None)
+        job.set_stale(False)
+        not_stale = build.is_prunable("B", older_than)
+
+        # Then
+        self.assertFalse(not_computed)
+        self.assertFalse(should_run)
+        self.assertTrue(not_stale)
+        self.assertFalse(job.get_should_run.called)
+
+
+class LazyExpansionTest(unittest.TestCase):
+
+    def _get_build(self):
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target"]),
+            SimpleTestJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+            SimpleTestJobDefinition("C", depends=["B-target"], targets=["C-target"]),
+        ]
+        return builder.build.BuildManager(jobs, []).make_build()
+
+    def test_add_job_lazy(self):
+        # Given
+        build = self._get_build()
+
+        # When
+        build_update = build.add_job("C", {}, lazy=True)
+
+        # Then
+        self.assertEqual(build_update.lazy_targets, set(["B-target"]))
+        self.assertEqual(build_update.new_jobs, set(["C"]))
+        self.assertIn("B-target", build)
+        self.assertNotIn("B", build)
+        self.assertNotIn("A-target", build)
+        self.assertFalse(build.get_target("B-target").expanded_directions["up"])
+
+    def test_expand_lazy_targets(self):
+        # Given
+        build = self._get_build()
+        build.add_job("C", {}, lazy=True)
+
+        # When
+        build_update = build.expand_lazy_targets(["B-target"])
+
+        # Then
+        self.assertEqual(build_update.new_jobs, set(["B"]))
+        self.assertEqual(build_update.lazy_targets, set(["A-target"]))
+        self.assertEqual(build.get_creator_ids("B-target"), ["B"])
+        self.assertTrue(build.get_target("B-target").expanded_directions["up"])
+        self.assertNotIn("A", build)
+
+    def test_eager_add_job_expands_lazy_targets(self):
+        # Given
+        build = self._get_build()
+        build.add_job("C", {}, lazy=True)
+
+        # When
+        build_update = build.add_job("C", {})
+
+        # Then
+        self.assertEqual(build_update.lazy_targets, set())
+        self.assertEqual(build_update.new_jobs, set(["A", "B"]))
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def test_import_is_lazy(self):
+        # When
+        modules = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, builder; print(' '.join(sys.modules))"]).split()
+
+        # Then
+        self.assertNotIn("tornado", modules)
+        self.assertNotIn("networkx", modules)
+        self.assertNotIn("builder.execution", modules)
+
+
+class DependencyCountTest(unittest.TestCase):
+
+    def _get_targets(self, n):
+        return [FakeTarget("target", "target{}".format(i), {})
+                for i in xrange(n)]
+
+    def test_counts_follow_mtimes(self):
+        # Given
+        targets = self._get_targets(2)
+        depends = builder.dependencies.Dependency(
+                builder.dependencies.depends, "depends", "depends")
+        one_or_more = builder.dependencies.Dependency(
+                builder.dependencies.depends_one_or_more, "one_or_more",
+                "depends_one_or_more")
+        for target in targets:
+            depends.add_member(target)
+            one_or_more.add_member(target)
+
+        # When
+        targets[0].set_mtime(100)
+        targets[1].set_mtime(None)
+
+        # Then
+        self.assertEqual(depends.n_existing, 1)
+        self.assertEqual(depends.unknown, set())
+        self.assertFalse(depends.is_met())
+        self.assertTrue(one_or_more.is_met())
+
+    def test_unknown_members_are_fetched(self):
+        # Given
+        targets = self._get_targets(2)
+        depends = builder.dependencies.Dependency(
+                builder.dependencies.depends, "depends", "depends")
+        for target in targets:
+            target.set_mtime(100)
+            depends.add_member(target)
+
+        # When
+        targets[1].invalidate()
+        unknown = set(depends.unknown)
+        targets[1].do_get_mtime = mock.Mock(return_value=None)
+
+        # Then
+        self.assertEqual(unknown, set([targets[1]]))
+        self.assertFalse(depends.is_met())
+        self.assertEqual(targets[1].do_get_mtime.call_count, 1)
+        self.assertEqual(depends.unknown, set())
+        self.assertEqual(depends.n_existing, 1)
+
+    def _get_build(self):
+        jobs = [
+            SimpleTestJobDefinition("A", targets=["A-target"]),
+            SimpleTestJobDefinition("B", targets=["B-target"],
+                                    depends=["A-target"]),
+            SimpleTestJobDefinition("C", targets=["C-target"],
+                                    depends=["A-target"]),
+        ]
+        build = builder.build.BuildManager(jobs, []).make_build()
+        build.add_job("B", {})
+        build.add_job("C", {})
+        return build
+
+    def test_newly_met_clears_buildable(self):
+        # Given
+        build = self._get_build()
+        build.get_target("A-target").set_mtime(None)
+        job = build.get_job("B")
+        buildable = job.get_buildable()
+
+        # When
+        build.get_target("A-target").set_mtime(100)
+
+        # Then
+        self.assertFalse(buildable)
+        self.assertIsNone(job.buildable)
+        self.assertTrue(job.get_buildable())
+
+    def test_remove_node_removes_members(self):
+        # Given
+        build = self._get_build()
+        target = build.get_target("A-target")
+
+        # When
+        build.prune_job("B")
+
+        # Then
+        self.assertEqual([x.unique_id for x in target.dependency_nodes],
+                         ["C_depends_A-target"])
@@ -1,6 +1,8 @@
 
 import mock
 import numbers
+import threading
+import time
 import unittest
 import copy
 import json
@@ -8,6 +10,7 @@ import json
 
 import builder.build
 import builder.execution
+import builder.jobs
 from builder.tests.tests_jobs import *
 from builder.build import BuildManager
 from builder.execution import Executor, ExecutionManager, ExecutionResult, _submit_from_json
@@ -55,6 +58,30 @@ class ExtendedMockExecutor(Executor):
         return result
 
 
+class BatchMockExecutor(ExtendedMockExecutor):
+    """Executes batches by running the effect of every member"""
+    supports_batches = True
+
+    def __init__(self, execution_manager, config=None):
+        super(BatchMockExecutor, self).__init__(execution_manager, config=config)
+        self.commands = []
+
+    def do_execute(self, job):
+        self.commands.append(job.get_command())
+        if not isinstance(job, builder.jobs.JobBatch):
+            return super(BatchMockExecutor, self).do_execute(job)
+        for member in job.jobs:
+            super(BatchMockExecutor, self).do_execute(member)
+        return ExecutionResult(False, True, "", "")
+
+
+class BatchEffectJobDefinition(EffectTimestampExpandedJobDefinition):
+
+    def get_batch_command(self, unique_ids, build_contexts, build_graph):
+        return "batch {} {}".format(build_contexts[0]["start_time"].format("HH:mm"),
+                                    build_contexts[-1]["end_time"].format("HH:mm"))
+
+
 class ExecutionManagerTests1(unittest.TestCase):
 
     def _get_execution_manager(self, jobs, executor=None):
@@ -146,9 +173,9 @@ class ExecutionManagerTests1(unittest.TestCase):
 
 class ExecutionManagerTests2(unittest.TestCase):
 
-    def _get_execution_manager(self, jobs):
+    def _get_execution_manager(self, jobs, config=None):
         build_manager = BuildManager(jobs, metas=[])
-        execution_manager = ExecutionManager(build_manager, lambda execution_manager, config=None: ExtendedMockExecutor(execution_manager, config=config))
+        execution_manager = ExecutionManager(build_manager, lambda execution_manager, config=None: ExtendedMockExecutor(execution_manager, config=config), config=config)
         return execution_manager
 
     def _get_execution_manager_with_effects(self, jobs):
@@ -602,6 +629,780 @@ class ExecutionManagerTests2(unittest.TestCase):
         self.assertEquals(execution_manager.get_build().get_job("E").get_should_run(), True)
         self.assertEquals(execution_manager.get_build().get_job("D").get_should_run(), True)
 
+    def test_next_jobs_diamond_walks_each_job_once(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+            EffectJobDefinition("C", depends=["A-target"], targets=["C-target"]),
+            EffectJobDefinition("D", depends=["B-target", "C-target"],
+                                targets=["D-target"]),
+            EffectJobDefinition("E", depends=["D-target"], targets=["E-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        build_graph = execution_manager.build
+        build_graph.add_job("A", {}, direction={"down"})
+        calls = []
+        for job_id in ("A", "B", "C", "D", "E"):
+            job = build_graph.get_job(job_id)
+            job.get_should_run = (lambda job_id: lambda: calls.append(job_id) or job_id == "E")(job_id)
+
+        # When
+        next_job_ids = execution_manager.get_next_jobs_to_run("A")
+
+        # Then
+        self.assertEquals({"E"}, next_job_ids)
+        self.assertItemsEqual(["A", "B", "C", "D", "E"], calls)
+
+    def test_ready_set_persists(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        build_graph = execution_manager.build
+        build_graph.add_job("B", {})
+        execution_manager.get_jobs_to_run = mock.Mock()
+        execution_manager.get_next_jobs_to_run = mock.Mock(
+                wraps=execution_manager.get_next_jobs_to_run)
+        job = build_graph.get_job("A")
+        job.is_running = True
+
+        # When
+        new_job_ids = set(build_graph.new_job_ids)
+        execution_manager._update_build(
+                lambda: execution_manager._ready_job_ids.update(build_graph.pop_new_job_ids()))
+        execution_manager._update_build(lambda: execution_manager._dispatch_ready_jobs())
+        kept_while_running = set(execution_manager._ready_job_ids)
+        job.is_running = False
+        execution_manager._update_build(lambda: execution_manager._complete_job("A"))
+        queued = execution_manager._work_queue.get_nowait()
+        job.is_running = False
+        job.get_should_run = mock.Mock(return_value=False)
+        execution_manager._ready_job_ids.add("A")
+        execution_manager._update_build(lambda: execution_manager._dispatch_ready_jobs())
+
+        # Then
+        self.assertEqual(new_job_ids, {"A", "B"})
+        self.assertEqual(kept_while_running, {"A"})
+        self.assertEqual(queued, "A")
+        self.assertEqual(execution_manager._ready_job_ids, set())
+        self.assertFalse(execution_manager.get_jobs_to_run.called)
+        self.assertFalse(execution_manager.get_next_jobs_to_run.called)
+
+    def test_start_execution_dispatches_new_jobs(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.build.add_job("A", {})
+        execution_manager.get_jobs_to_run = mock.Mock()
+
+        # When
+        execution_manager.start_execution(inline=True)
+
+        # Then
+        self.assertEqual(execution_manager.build.get_job("A").count, 1)
+        self.assertEqual(execution_manager.build.new_job_ids, set())
+        self.assertFalse(execution_manager.get_jobs_to_run.called)
+
+    def test_update_targets_applies_bulk_values(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None,
+                                    targets=["A-target1", "A-target2"])]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.build.add_job("A", {})
+        target1 = execution_manager.build.get_target("A-target1")
+        target2 = execution_manager.build.get_target("A-target2")
+        target1.do_get_mtime = mock.Mock(return_value=10)
+        target2.do_get_mtime = mock.Mock(return_value=None)
+
+        # When
+        execution_manager.update_targets(["A-target1", "A-target2"])
+
+        # Then
+        self.assertTrue(target1.is_cached())
+        self.assertEqual(target1.get_mtime(), 10)
+        self.assertTrue(target2.is_cached())
+        self.assertFalse(target2.get_exists())
+        self.assertIn("Target", execution_manager.bulk_refresh_times)
+
+    def test_snapshots_are_versioned(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"])
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"graph_snapshot_interval": 0})
+        execution_manager.running = True
+        initial_snapshot = execution_manager.get_snapshot()
+
+        # When
+        execution_manager.submit("A", {})
+        status_snapshot = execution_manager.get_snapshot()
+        graph_snapshot = execution_manager.get_graph_snapshot()
+        same_graph_snapshot = execution_manager.get_graph_snapshot()
+        execution_manager.submit("B", {})
+        new_graph_snapshot = execution_manager.get_graph_snapshot()
+
+        # Then
+        self.assertGreater(status_snapshot.version, initial_snapshot.version)
+        self.assertEqual(status_snapshot.status["n_submitted_jobs"], 1)
+        self.assertEqual(initial_snapshot.status["n_submitted_jobs"], 0)
+        self.assertIs(graph_snapshot, same_graph_snapshot)
+        self.assertEqual(graph_snapshot.version, status_snapshot.version)
+        self.assertNotIn("B", graph_snapshot)
+        self.assertIn("B", new_graph_snapshot)
+        self.assertTrue(new_graph_snapshot.get_job("A").get_should_run())
+        self.assertRaises(RuntimeError, new_graph_snapshot.add_job, "A", {})
+
+    def test_graph_snapshot_is_throttled(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=None, targets=["B-target"])
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"graph_snapshot_interval": 60})
+        execution_manager.running = True
+        execution_manager.submit("A", {})
+        graph_snapshot = execution_manager.get_graph_snapshot()
+
+        # When
+        execution_manager.submit("B", {})
+        throttled_graph_snapshot = execution_manager.get_graph_snapshot()
+        execution_manager._graph_snapshot_on -= 60
+        new_graph_snapshot = execution_manager.get_graph_snapshot()
+
+        # Then
+        self.assertIs(throttled_graph_snapshot, graph_snapshot)
+        self.assertNotIn("B", throttled_graph_snapshot)
+        self.assertIn("B", new_graph_snapshot)
+
+    def test_graph_snapshot_does_not_recompute(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.build.add_job("A", {})
+        job = execution_manager.build.get_job("A")
+        job.get_stale = mock.Mock(wraps=job.get_stale)
+
+        # When
+        graph_snapshot = execution_manager.get_graph_snapshot()
+        data = builder.build.BuildGraphTransformer(graph_snapshot).to_json()
+
+        # Then
+        self.assertFalse(job.get_stale.called)
+        self.assertIsNone(data["jobs"]["A"]["A"]["stale"])
+        self.assertIsNone(data["targets"]["A-target"]["A-target"]["exists"])
+
+    def test_submit_many(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+            EffectJobDefinition("C", depends=["A-target"], targets=["C-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.update_targets = mock.Mock(wraps=execution_manager.update_targets)
+
+        # When
+        count = execution_manager.submit_many([
+            {"job_definition_id": "B", "build_context": {}},
+            {"job_definition_id": "C", "build_context": {}},
+        ])
+
+        # Then
+        self.assertEqual(count, 2)
+        self.assertEqual(execution_manager.submitted_jobs, 2)
+        self.assertEqual(execution_manager.update_targets.call_count, 1)
+        self.assertEqual(set(execution_manager.update_targets.call_args[0][0]),
+                         {"A-target", "B-target", "C-target"})
+        self.assertEqual(execution_manager._work_queue.qsize(), 1)
+        self.assertEqual(execution_manager._work_queue.get(), "A")
+
+    def test_submit_batch_from_json(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        json_body = json.dumps({"submissions": [
+            {"job_definition_id": "A", "build_context": {}},
+            {"job_definition_id": "B", "build_context": {}, "update_topmost": True},
+        ]})
+
+        # When
+        count = builder.execution._submit_batch_from_json(execution_manager, json_body)
+
+        # Then
+        self.assertEqual(count, 2)
+        self.assertTrue(execution_manager.build.is_job("A"))
+        self.assertTrue(execution_manager.build.is_job("B"))
+        self.assertRaises(RuntimeError, builder.execution._submit_batch_from_json,
+                          ExecutionManager(BuildManager(jobs, []), ExtendedMockExecutor),
+                          json_body)
+
+    def test_submit_refreshes_targets_without_build_lock(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        lock_depths = []
+
+        def get_bulk_exists_mtime_parallel(targets, **kwargs):
+            lock_depths.append(execution_manager._build_lock_depth)
+            return {}, {}
+
+        # When
+        with mock.patch("builder.targets.get_bulk_exists_mtime_parallel",
+                        get_bulk_exists_mtime_parallel):
+            execution_manager.submit("B", {}, update_topmost=True)
+
+        # Then
+        self.assertTrue(lock_depths)
+        self.assertEqual(set(lock_depths), {0})
+        self.assertTrue(execution_manager.build.is_job("B"))
+        self.assertEqual(execution_manager.submitted_jobs, 1)
+
+    def test_update_aggregator_coalesces(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("B", {})
+        execution_manager.external_update_targets = mock.Mock()
+        aggregator = builder.execution.UpdateAggregator(execution_manager, window=60)
+        self.addCleanup(aggregator.stop)
+
+        # When
+        aggregator.add(["A-target"])
+        aggregator.add(["A-target", "B-target"])
+        n_pending = aggregator.add(["B-target"])
+        flushed_ids = aggregator.flush()
+        empty_flush_ids = aggregator.flush()
+
+        # Then
+        self.assertEqual(n_pending, 2)
+        self.assertEqual(flushed_ids, {"A-target", "B-target"})
+        self.assertEqual(empty_flush_ids, set())
+        execution_manager.external_update_targets.assert_called_once_with(
+                {"A-target", "B-target"})
+        metrics = aggregator.get_metrics()
+        self.assertEqual(metrics["n_notifications"], 3)
+        self.assertEqual(metrics["n_notified_ids"], 4)
+        self.assertEqual(metrics["n_flushed_ids"], 2)
+        self.assertEqual(metrics["n_coalesced_ids"], 2)
+        self.assertEqual(metrics["n_pending_ids"], 0)
+
+    def test_update_aggregator_drops_unknown_ids(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("B", {})
+        execution_manager.external_update_targets = mock.Mock()
+        aggregator = builder.execution.UpdateAggregator(execution_manager, window=60)
+        self.addCleanup(aggregator.stop)
+
+        # When
+        aggregator.add(["A-target"])
+        aggregator.add(["missing-target"])
+        flushed_ids = aggregator.flush()
+        execution_manager.external_update_targets.side_effect = IOError()
+        aggregator.add(["B-target"])
+        self.assertRaises(IOError, aggregator.flush)
+
+        # Then
+        self.assertEqual(flushed_ids, {"A-target"})
+        execution_manager.external_update_targets.assert_any_call({"A-target"})
+        metrics = aggregator.get_metrics()
+        self.assertEqual(metrics["n_notified_ids"], 3)
+        self.assertEqual(metrics["n_flushed_ids"], 1)
+        self.assertEqual(metrics["n_dropped_ids"], 1)
+        self.assertEqual(metrics["n_failed_ids"], 1)
+        self.assertEqual(metrics["n_coalesced_ids"], 0)
+
+    def test_update_from_json_rejects_unknown_ids(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("A", {})
+        self.addCleanup(execution_manager.update_aggregator.stop)
+
+        # When
+        self.assertRaisesRegexp(
+            ValueError, "missing-target", builder.execution._update_from_json,
+            execution_manager, json.dumps({"target_ids": ["A-target", "missing-target"]}))
+        n_pending = builder.execution._update_from_json(
+            execution_manager, json.dumps({"target_ids": ["A-target"]}))
+
+        # Then
+        self.assertEqual(n_pending, 1)
+
+    def test_update_aggregator_top_most(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("B", {})
+        execution_manager.external_update_targets = mock.Mock()
+        aggregator = builder.execution.UpdateAggregator(execution_manager, window=60)
+        self.addCleanup(aggregator.stop)
+
+        # When
+        first = aggregator.update_top_most()
+        second = aggregator.update_top_most()
+        aggregator.add(["B-target"])
+        aggregator.flush()
+        third = aggregator.update_top_most()
+
+        # Then
+        self.assertTrue(first)
+        self.assertFalse(second)
+        self.assertTrue(third)
+        top_most_ids = set(execution_manager.get_top_most_target_ids())
+        execution_manager.external_update_targets.assert_called_once_with(
+                top_most_ids | {"B-target"})
+        metrics = aggregator.get_metrics()
+        self.assertEqual(metrics["n_notified_ids"], 1 + len(top_most_ids))
+        self.assertEqual(metrics["n_flushed_ids"], len(top_most_ids | {"B-target"}))
+        self.assertGreaterEqual(metrics["n_coalesced_ids"], 0)
+        self.assertEqual(metrics["n_coalesced_ids"],
+                         1 + len(top_most_ids) - len(top_most_ids | {"B-target"}))
+
+    def test_stop_execution_cancels_update_flush(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.update_aggregator.add(["A-target"])
+        timer = execution_manager.update_aggregator._timer
+
+        # When
+        execution_manager.stop_execution()
+
+        # Then
+        timer.join(1)
+        self.assertFalse(timer.is_alive())
+        self.assertIsNone(execution_manager.update_aggregator._timer)
+        self.assertEqual(
+            execution_manager.update_aggregator.get_metrics()["n_pending_ids"], 1)
+
+    def test_submit_lazy(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+            EffectJobDefinition("C", depends=["B-target"], targets=["C-target"]),
+            EffectJobDefinition(
+                "D", depends=None,
+                targets=[{"unexpanded_id": "D-target", "start_mtime": 100}]),
+            EffectJobDefinition(
+                "E", depends=["C-target", {"unexpanded_id": "D-target",
+                                           "start_mtime": 100}],
+                targets=["E-target"], effect=200),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+
+        # When
+        execution_manager.submit("E", {}, lazy=True)
+        execution_manager.start_execution(inline=True)
+
+        # Then
+        build_graph = execution_manager.build
+        self.assertNotIn("D", build_graph)
+        self.assertFalse(build_graph.get_target("D-target").expanded_directions["up"])
+        for job_id in ("A", "B", "C", "E"):
+            self.assertEqual(build_graph.get_job(job_id).count, 1)
+
+    def test_deleted_lazy_target_is_expanded(self):
+        # Given
+        jobs = [
+            EffectJobDefinition(
+                "D", depends=None,
+                targets=[{"unexpanded_id": "D-target", "start_mtime": 100}]),
+            EffectJobDefinition(
+                "E", depends=[{"unexpanded_id": "D-target", "start_mtime": 100}],
+                targets=["E-target"], effect=200),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("E", {}, lazy=True)
+        execution_manager.start_execution(inline=True)
+        build_graph = execution_manager.build
+        expanded_before_delete = "D" in build_graph
+        build_graph.get_target("D-target").do_get_mtime = mock.Mock(return_value=None)
+
+        # When
+        execution_manager.running = True
+        execution_manager.external_update_targets(["D-target"])
+
+        # Then
+        self.assertFalse(expanded_before_delete)
+        self.assertIn("D", build_graph)
+        self.assertTrue(build_graph.get_target("D-target").expanded_directions["up"])
+        self.assertTrue(build_graph.get_job("D").get_should_run())
+        self.assertEqual(execution_manager._work_queue.get_nowait(), "D")
+
+    def test_graph_pruner(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"retention_max_age": "1h",
+                              "retention_batch_size": 1})
+        execution_manager.running = True
+        execution_manager.submit("B", {
+            "start_time": arrow.get("2015-01-01T00:00:00+00:00"),
+            "end_time": arrow.get("2015-01-01T01:00:00+00:00"),
+        })
+        execution_manager.start_execution(inline=True)
+        pruner = execution_manager.graph_pruner
+
+        # When
+        kept = pruner.prune(now=arrow.get("2015-01-01T01:30:00+00:00"))
+        removed = pruner.prune(now=arrow.get("2015-01-01T03:00:00+00:00"))
+
+        # Then
+        self.assertEqual(kept, 0)
+        self.assertEqual(removed, 5)
+        self.assertEqual(len(execution_manager.build.node), 0)
+        self.assertEqual(pruner.n_pruned_jobs, 2)
+        self.assertEqual(execution_manager.get_snapshot().status["retention"]["n_pruned_nodes"], 5)
+
+    def test_batched_execution(self):
+        # Given
+        jobs = [
+            BatchEffectJobDefinition("A", file_step="5min", depends=None,
+                config={"max_batch_size": 4},
+                targets=[{"unexpanded_id": "A-target-%Y-%m-%d-%H-%M", "file_step": "5min"}]),
+        ]
+        build_manager = BuildManager(jobs, metas=[])
+        execution_manager = ExecutionManager(build_manager, BatchMockExecutor)
+        execution_manager.running = True
+        execution_manager.submit("A", {
+            "start_time": arrow.get("2015-01-01T00:00:00+00:00"),
+            "end_time": arrow.get("2015-01-01T00:30:00+00:00"),
+        })
+
+        # When
+        execution_manager.start_execution(inline=True)
+
+        # Then
+        self.assertEqual(sorted(execution_manager.executor.commands),
+                         ["batch 00:00 00:20", "batch 00:20 00:30"])
+        self.assertEqual(execution_manager.completed_jobs, 6)
+        self.assertEqual(execution_manager.execution_times, {})
+        for job_id, job in execution_manager.build.job_iter():
+            self.assertEqual(job.count, 1)
+            self.assertFalse(job.is_running)
+            self.assertFalse(job.get_should_run())
+
+    def test_job_batch_group(self):
+        # Given
+        jobs = [
+            BatchEffectJobDefinition("A", file_step="5min", depends=None,
+                targets=[{"unexpanded_id": "A-target-%Y-%m-%d-%H-%M", "file_step": "5min"}]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        build_graph = execution_manager.build
+        build_graph.add_job("A", {
+            "start_time": arrow.get("2015-01-01T00:00:00+00:00"),
+            "end_time": arrow.get("2015-01-01T00:30:00+00:00"),
+        })
+        members = [build_graph.get_job(x) for x in (
+            "A_2015-01-01-00-25-00", "A_2015-01-01-00-00-00",
+            "A_2015-01-01-00-05-00", "A_2015-01-01-00-15-00")]
+
+        # When
+        groups = builder.jobs.JobBatch.group(members, 2)
+
+        # Then
+        self.assertItemsEqual(
+            [[x.get_id() for x in group] for group in groups],
+            [["A_2015-01-01-00-00-00", "A_2015-01-01-00-05-00"],
+             ["A_2015-01-01-00-15-00"],
+             ["A_2015-01-01-00-25-00"]])
+
+    def test_resource_pool(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"],
+                                config={"resources": {"memory": 6, "disk": 1}}),
+            EffectJobDefinition("B", depends=None, targets=["B-target"],
+                                config={"resources": {"memory": 20}}),
+            EffectJobDefinition("C", depends=None, targets=["C-target"],
+                                config={"resources": {"cpu": 1}}),
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"resources": {"memory": 8, "cpu": 1}})
+        for job_id in ("A", "B", "C"):
+            execution_manager.build.add_job(job_id, {})
+
+        # When
+        acquired = [execution_manager._acquire_resources(x) for x in ("A", "B", "C")]
+        status = execution_manager.resource_pool.get_status()
+        execution_manager.executor.finish_job(
+                execution_manager.build.get_job("A"),
+                ExecutionResult(False, True, "", ""))
+
+        # Then
+        self.assertEqual(acquired, [True, False, True])
+        self.assertEqual(status["available"], {"memory": 2, "cpu": 0})
+        self.assertEqual(execution_manager._work_queue.get_nowait(), "B")
+        self.assertTrue(execution_manager._acquire_resources("B"))
+        self.assertEqual(execution_manager.resource_pool.available, {"memory": 0, "cpu": 0})
+
+    def test_timed_out_job_keeps_resources(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"],
+                                config={"resources": {"cpu": 1}}),
+            EffectJobDefinition("B", depends=None, targets=["B-target"],
+                                config={"resources": {"cpu": 1}}),
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"resources": {"cpu": 1}})
+        execution_manager.job_timeout = 0
+        execution_manager.timer_queue = mock.MagicMock()
+        for job_id in ("A", "B"):
+            execution_manager.build.add_job(job_id, {})
+        job = execution_manager.build.get_job("A")
+        execution_manager._acquire_resources("A")
+        execution_manager._acquire_resources("B")
+        execution_manager.execution_times[job] = arrow.get().replace(seconds=-1)
+        execution_manager.running = True
+
+        def stop(seconds):
+            execution_manager.running = False
+
+        # When
+        with mock.patch("builder.execution._interruptable_sleep", stop):
+            execution_manager._check_for_timeouts()
+        available_after_timeout = dict(execution_manager.resource_pool.available)
+        reacquired = execution_manager._acquire_resources("A")
+        execution_manager.executor.finish_job(job, ExecutionResult(False, False, "", ""))
+
+        # Then
+        self.assertEqual(available_after_timeout, {"cpu": 0})
+        self.assertFalse(reacquired)
+        self.assertEqual(execution_manager._work_queue.get_nowait(), "B")
+        self.assertEqual(execution_manager._work_queue.get_nowait(), "A")
+        self.assertEqual(execution_manager.resource_pool.available, {"cpu": 1})
+
+    def test_retry_backoff(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"],
+                                config={"retry_backoff_max": 5}),
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"retry_backoff": 2, "retry_jitter": 0})
+        execution_manager.timer_queue = mock.MagicMock()
+        execution_manager.build.add_job("A", {})
+        job = execution_manager.build.get_job("A")
+        job.get_should_run_immediate = mock.Mock(return_value=True)
+        failed = ExecutionResult(False, False, "", "")
+
+        # When
+        delays = []
+        for _ in xrange(3):
+            job.is_running = True
+            execution_manager.executor.finish_job(job, failed)
+            delays.append(execution_manager.timer_queue.call_later.call_args[0][0])
+            execution_manager._complete_job("A")
+        queued_while_waiting = execution_manager._work_queue.qsize()
+        retry = execution_manager.timer_queue.call_later.call_args[0][1]
+        retry()
+
+        # Then
+        self.assertEqual(delays, [2, 4, 5])
+        self.assertEqual(queued_while_waiting, 0)
+        self.assertIsNone(job.retry_on)
+        self.assertEqual(execution_manager._work_queue.get_nowait(), "A")
+        self.assertEqual(execution_manager.get_snapshot().status["n_scheduled_retries"], 3)
+
+    def test_circuit_breaker(self):
+        # Given
+        jobs = [
+            EffectTimestampExpandedJobDefinition("A", file_step="5min", depends=None,
+                targets=[{"unexpanded_id": "A-target-%Y-%m-%d-%H-%M", "file_step": "5min"}]),
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"circuit_breaker": {"failure_rate": 0.5, "window": 4,
+                                                  "min_failures": 2, "reset_timeout": 60}})
+        execution_manager.timer_queue = mock.MagicMock()
+        build_graph = execution_manager.build
+        build_graph.add_job("A", {
+            "start_time": arrow.get("2015-01-01T00:00:00+00:00"),
+            "end_time": arrow.get("2015-01-01T00:30:00+00:00"),
+        })
+        job_ids = sorted(job_id for job_id, _ in build_graph.job_iter())
+        failed = ExecutionResult(False, False, "", "")
+        succeeded = ExecutionResult(False, True, "", "")
+        work_queue = execution_manager._work_queue
+
+        # When
+        for job_id in job_ids[:2]:
+            execution_manager.executor.finish_job(build_graph.get_job(job_id), failed)
+        execution_manager._update_build(
+                lambda: map(execution_manager.add_to_work_queue, job_ids))
+        queued_while_open = work_queue.qsize()
+        status_while_open = execution_manager.get_snapshot().status["circuit_breakers"]["A"]
+        probe = execution_manager.timer_queue.call_later.call_args[0][1]
+        probe()
+        probe_job_id = work_queue.get_nowait()
+        queued_while_probing = work_queue.qsize()
+        execution_manager.executor.finish_job(build_graph.get_job(job_ids[0]), failed)
+        state_after_other_result = execution_manager.circuit_breakers["A"].state
+        execution_manager.executor.finish_job(build_graph.get_job(probe_job_id), succeeded)
+
+        # Then
+        self.assertEqual(queued_while_open, 0)
+        self.assertEqual(status_while_open["state"], "open")
+        self.assertEqual(status_while_open["n_paused_jobs"], 6)
+        self.assertEqual(queued_while_probing, 0)
+        self.assertEqual(state_after_other_result, "half_open")
+        self.assertEqual(execution_manager.circuit_breakers["A"].state, "closed")
+        self.assertEqual(work_queue.qsize(), 5)
+
+    def test_circuit_breaker_records_batch_once(self):
+        # Given
+        jobs = [
+            EffectTimestampExpandedJobDefinition("A", file_step="5min", depends=None,
+                targets=[{"unexpanded_id": "A-target-%Y-%m-%d-%H-%M", "file_step": "5min"}]),
+        ]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"circuit_breaker": {"failure_rate": 0.5, "window": 4,
+                                                  "min_failures": 2, "reset_timeout": 60}})
+        execution_manager.timer_queue = mock.MagicMock()
+        build_graph = execution_manager.build
+        build_graph.add_job("A", {
+            "start_time": arrow.get("2015-01-01T00:00:00+00:00"),
+            "end_time": arrow.get("2015-01-01T00:15:00+00:00"),
+        })
+        job_batch = builder.jobs.JobBatch(sorted(
+            (job for _, job in build_graph.job_iter()),
+            key=lambda x: x.build_context["start_time"]))
+
+        # When
+        execution_manager.executor.finish_job(
+                job_batch, ExecutionResult(False, False, "", ""))
+
+        # Then
+        circuit_breaker = execution_manager.circuit_breakers["A"]
+        self.assertEqual(len(job_batch), 3)
+        self.assertEqual(list(circuit_breaker.results), [False])
+        self.assertEqual(circuit_breaker.state, "closed")
+
+    def test_passed_curfews_publish_one_snapshot(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"]),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.build.add_job("B", {})
+        execution_manager.running = True
+        version = execution_manager.get_snapshot().version
+
+        def stop(seconds):
+            execution_manager.running = False
+
+        # When
+        with mock.patch("builder.execution._interruptable_sleep", stop):
+            execution_manager._check_for_passed_curfews()
+
+        # Then
+        self.assertEqual(execution_manager.get_snapshot().version, version + 1)
+
+    def test_passed_curfew_is_paused_by_circuit_breaker(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = self._get_execution_manager(
+                jobs, config={"circuit_breaker": {"min_failures": 1, "window": 1}})
+        execution_manager.timer_queue = mock.MagicMock()
+        execution_manager.build.add_job("A", {})
+        job = execution_manager.build.get_job("A")
+        execution_manager.record_job_result(job, False)
+        job.past_curfew = mock.Mock(return_value=True)
+        job.get_stale = mock.Mock(return_value=True)
+        job.get_buildable = mock.Mock(return_value=True)
+        job.get_should_run = mock.Mock(return_value=True)
+
+        # When
+        stale_jobs = []
+        execution_manager._update_build(
+                lambda: execution_manager._check_passed_curfew("A", stale_jobs))
+
+        # Then
+        self.assertEqual(stale_jobs, [job])
+        self.assertEqual(execution_manager._work_queue.qsize(), 0)
+        self.assertEqual(execution_manager._paused_job_ids["A"], {"A"})
+
+    def test_cache_expiry(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", targets=["A-target"], cache_time="10min",
+                                depends=[{"unexpanded_id": "B-target", "start_mtime": time.time()}],
+                                effect=time.time() - 600 + 0.2),
+        ]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("A", {})
+        work_queue = execution_manager._work_queue
+        work_queue.get_nowait()
+
+        # When
+        execution_manager.execute("A")
+        cache_expires_on = execution_manager.build.get_job("A").cache_expires_on
+        job_id = work_queue.get(timeout=5)
+
+        # Then
+        self.assertAlmostEqual(cache_expires_on, time.time(), delta=0.5)
+        self.assertEqual(job_id, "A")
+        self.assertIsNone(execution_manager.build.get_job("A").cache_expires_on)
+
+    def test_cache_expiry_rescheduled(self):
+        # Given
+        jobs = [EffectJobDefinition("A", targets=["A-target"],
+                                    cache_time="10min")]
+        execution_manager = self._get_execution_manager(jobs)
+        execution_manager.running = True
+        execution_manager.submit("A", {})
+        job = execution_manager.build.get_job("A")
+        job.get_cache_expiry = mock.Mock(return_value=time.time() + 60)
+        execution_manager.schedule_cache_expiry(job)
+
+        # When
+        job.get_cache_expiry.return_value = time.time() + 120
+        execution_manager.schedule_cache_expiry(job)
+
+        # Then
+        self.assertEqual(len(execution_manager.timer_queue), 1)
+        self.assertEqual(len(execution_manager._cache_expiry_timers), 1)
+
     def test_effect_job(self):
         # Given
         jobs = [
@@ -1303,3 +2104,132 @@ class ExecutionDaemonTests(unittest.TestCase):
 
         # Then
         self.assertEqual(execution_manager.executor.execute.call_count, 2)
+
+    def test_get_int_argument(self):
+        # Given
+        arguments = {"offset": "10", "limit": "ten", "chunk_size": "0"}
+        handler = mock.Mock()
+        handler.get_argument = lambda name, default=None: arguments.get(name, default)
+
+        # When
+        offset = builder.execution._get_int_argument(handler, "offset", 0)
+        missing = builder.execution._get_int_argument(handler, "missing", 5)
+
+        # Then
+        self.assertEqual(offset, 10)
+        self.assertEqual(missing, 5)
+        self.assertRaisesRegexp(ValueError, "limit must be an integer",
+                                builder.execution._get_int_argument,
+                                handler, "limit", None)
+        self.assertRaisesRegexp(ValueError, "chunk_size must be at least 1",
+                                builder.execution._get_int_argument,
+                                handler, "chunk_size", 1000, minimum=1)
+
+
+class GraphRendererTests(unittest.TestCase):
+    def _get_graph_snapshot(self):
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"])
+        ]
+        execution_manager = ExecutionManager(BuildManager(jobs, []), ExtendedMockExecutor)
+        execution_manager.running = True
+        execution_manager.submit("B", {})
+        return execution_manager.get_graph_snapshot()
+
+    def test_render_is_cached_by_query_and_version(self):
+        # Given
+        graph_snapshot = self._get_graph_snapshot()
+        renderer = builder.execution.GraphRenderer(max_workers=1)
+        process = mock.Mock(returncode=0)
+        process.communicate.return_value = ("png data", "")
+
+        # When
+        with mock.patch("subprocess.Popen", return_value=process) as popen:
+            first = renderer.render(graph_snapshot, {}, "png").result()
+            second = renderer.render(graph_snapshot, {}, "png").result()
+            other = renderer.render(graph_snapshot, {"job_definition_ids": ["A"]}, "png").result()
+
+        # Then
+        self.assertEqual(first, "png data")
+        self.assertEqual(second, "png data")
+        self.assertEqual(other, "png data")
+        self.assertEqual(popen.call_count, 2)
+        self.assertEqual(popen.call_args[0][0][1:], ["-Tpng"])
+        dot = process.communicate.call_args_list[0][0][0]
+        self.assertTrue(dot.startswith("strict digraph"))
+        self.assertIn('"A" -> "A-target"', dot)
+
+    def test_render_failures_are_not_cached(self):
+        # Given
+        graph_snapshot = self._get_graph_snapshot()
+        renderer = builder.execution.GraphRenderer(max_workers=1)
+        process = mock.Mock(returncode=1)
+        process.communicate.return_value = ("", "bad")
+
+        # When
+        with mock.patch("subprocess.Popen", return_value=process) as popen:
+            self.assertRaises(RuntimeError, renderer.render(graph_snapshot, {}, "pdf").result)
+            process.returncode = 0
+            data = renderer.render(graph_snapshot, {}, "pdf").result()
+
+        # Then
+        self.assertEqual(data, "")
+        self.assertEqual(popen.call_count, 2)
+
+    def test_render_too_big(self):
+        # Given
+        graph_snapshot = self._get_graph_snapshot()
+        renderer = builder.execution.GraphRenderer(max_workers=1)
+        renderer.max_dot_size = 10
+
+        # When
+        with mock.patch("subprocess.Popen") as popen:
+            data = renderer.render(graph_snapshot, {}, "pdf").result()
+            dot = renderer.render(graph_snapshot, {}, "dot").result()
+
+        # Then
+        self.assertIsNone(data)
+        self.assertFalse(popen.called)
+        self.assertIn('"B-target"', dot)
+
+
+class TimerQueueTests(unittest.TestCase):
+
+    def test_calls_in_order(self):
+        # Given
+        timer_queue = builder.execution.TimerQueue()
+        calls = []
+        done = threading.Event()
+
+        # When
+        timer_queue.call_later(0.05, lambda: calls.append("b") or done.set())
+        timer_queue.call_later(0, lambda: calls.append("a"))
+        done.wait(5)
+
+        # Then
+        self.assertEqual(calls, ["a", "b"])
+        self.assertEqual(len(timer_queue), 0)
+
+    def test_cancel(self):
+        # Given
+        timer_queue = builder.execution.TimerQueue()
+        calls = []
+        done = threading.Event()
+        timers = [timer_queue.call_later(0.05, lambda: calls.append("a"))
+                  for _ in xrange(3)]
+        timer_queue.call_later(0.1, lambda: calls.append("b") or done.set())
+
+        # When
+        for timer in timers:
+            timer_queue.cancel(timer)
+        timer_queue.cancel(timers[0])
+        n_pending = len(timer_queue)
+        n_heap = len(timer_queue._calls)
+        done.wait(5)
+
+        # Then
+        self.assertEqual(n_pending, 1)
+        self.assertEqual(n_heap, 1)
+        self.assertEqual(calls, ["b"])
+        self.assertEqual(len(timer_queue), 0)
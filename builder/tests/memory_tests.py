@@ -0,0 +1,132 @@
+"""Used to test the memory reports of build graphs"""
+
+import unittest
+
+import arrow
+import mock
+
+import builder.memory
+from builder.build import BuildManager
+from builder.execution import ExecutionManager
+from builder.tests.tests_jobs import *
+from builder.tests.execution_tests import ExtendedMockExecutor
+
+
+class MemoryReportTest(unittest.TestCase):
+
+    def _get_build(self):
+        jobs = [
+            SimpleTimestampExpandedTestJob(
+                "A", file_step="5min",
+                targets=[{"unexpanded_id": "A-target-%Y-%m-%d-%H-%M",
+                          "file_step": "5min"}]),
+            SimpleTimestampExpandedTestJob(
+                "B", file_step="5min",
+                depends=[{"unexpanded_id": "A-target-%Y-%m-%d-%H-%M",
+                          "file_step": "5min"}],
+                targets=[{"unexpanded_id": "B-target-%Y-%m-%d-%H-%M",
+                          "file_step": "5min"}]),
+        ]
+        build_manager = BuildManager(jobs, [])
+        build = build_manager.make_build()
+        build_context = {"start_time": arrow.get("2015-01-01T00:00"),
+                         "end_time": arrow.get("2015-01-01T00:30")}
+        build.add_job("B", build_context)
+        return build
+
+    def test_memory_report(self):
+        # Given
+        build = self._get_build()
+
+        # When
+        report = builder.memory.get_memory_report(build, top=1)
+
+        # Then
+        kinds = report["kinds"]
+        self.assertEqual(kinds["jobs"]["count"], 12)
+        self.assertEqual(kinds["targets"]["count"], 12)
+        self.assertEqual(kinds["dependencies"]["count"], 6)
+        self.assertEqual(kinds["node_attributes"]["count"], 30)
+        self.assertEqual(kinds["edge_attributes"]["count"],
+                         build.number_of_edges())
+        self.assertGreater(kinds["build_contexts"]["count"], 0)
+        for kind in builder.memory.KINDS:
+            self.assertGreater(kinds[kind]["bytes"], 0, kind)
+        self.assertEqual(report["total_bytes"],
+                         sum(x["bytes"] for x in kinds.itervalues()))
+        self.assertEqual(len(report["top_unexpanded_ids"]), 1)
+        self.assertEqual(report["top_unexpanded_ids"][0]["count"], 6)
+
+    def test_shared_nodes_are_sized(self):
+        # Given
+        build = self._get_build()
+        seen = set()
+        dependency_id = next(node_id for node_id in build.node
+                             if build.is_dependency_type(node_id))
+        dependency = build.node[dependency_id]["object"]
+
+        # When
+        dependency_size = builder.memory.get_node_size(dependency, seen)
+        member_sizes = [builder.memory.get_node_size(target, seen)
+                        for target in dependency.members]
+
+        # Then
+        self.assertGreater(dependency_size, 0)
+        self.assertTrue(member_sizes)
+        for size in member_sizes:
+            self.assertGreater(size, 0)
+
+    def test_growth(self):
+        # Given
+        build = self._get_build()
+        profiler = builder.memory.MemoryProfiler()
+
+        # When
+        first = profiler.report(build)
+        build.add_job("B", {"start_time": arrow.get("2015-01-01T01:00"),
+                            "end_time": arrow.get("2015-01-01T01:10")})
+        second = profiler.report(build)
+
+        # Then
+        self.assertIsNone(first["growth"])
+        self.assertEqual(second["growth"]["kinds"]["jobs"]["count"], 4)
+        self.assertGreater(second["growth"]["total_bytes"], 0)
+
+    def test_tracemalloc_missing(self):
+        # When
+        with mock.patch.object(builder.memory, "tracemalloc", None):
+            profiler = builder.memory.MemoryProfiler(tracemalloc_frames=1)
+            report = profiler.report(self._get_build())
+
+        # Then
+        self.assertIsNone(report["tracemalloc"])
+
+    def test_execution_manager_report(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = ExecutionManager(BuildManager(jobs, []),
+                                             ExtendedMockExecutor)
+        execution_manager.build.add_job("A", {})
+
+        # When
+        report = execution_manager.get_memory_report(deep=True)
+
+        # Then
+        self.assertEqual(report["kinds"]["jobs"]["count"], 1)
+        self.assertEqual(report["kinds"]["targets"]["count"], 1)
+
+    def test_execution_manager_counts_report(self):
+        # Given
+        jobs = [EffectJobDefinition("A", depends=None, targets=["A-target"])]
+        execution_manager = ExecutionManager(BuildManager(jobs, []),
+                                             ExtendedMockExecutor)
+        execution_manager.build.add_job("A", {})
+        execution_manager.memory_profiler.report = mock.Mock()
+
+        # When
+        report = execution_manager.get_memory_report()
+
+        # Then
+        self.assertEqual(report["node_counts"]["job"], 1)
+        self.assertEqual(report["node_counts"]["target"], 1)
+        self.assertFalse(execution_manager.memory_profiler.report.called)
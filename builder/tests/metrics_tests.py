@@ -0,0 +1,115 @@
+"""Used to test the metrics collected by the execution daemon"""
+
+import unittest
+
+import builder.metrics
+from builder.build import BuildManager
+from builder.execution import ExecutionManager
+from builder.tests.tests_jobs import *
+from builder.tests.execution_tests import ExtendedMockExecutor
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_disabled_registry_records_nothing(self):
+        # Given
+        registry = builder.metrics.Registry()
+        counter = registry.counter("test_total", "A counter")
+        histogram = registry.histogram("test_seconds", "A histogram")
+
+        # When
+        counter.inc()
+        histogram.observe(1)
+        with registry.timer(histogram):
+            pass
+
+        # Then
+        self.assertEqual(counter.get(), 0)
+        self.assertEqual(histogram.get_count(), 0)
+        self.assertEqual(registry.render(),
+                         "# HELP test_seconds A histogram\n"
+                         "# TYPE test_seconds histogram\n"
+                         "# HELP test_total A counter\n"
+                         "# TYPE test_total counter\n")
+
+    def test_render(self):
+        # Given
+        registry = builder.metrics.Registry(enabled=True)
+        counter = registry.counter("test_total", "A counter")
+        gauge = registry.gauge("test_nodes", "A gauge")
+        histogram = registry.histogram("test_seconds", "A histogram",
+                                       buckets=(1, 5))
+
+        # When
+        counter.inc(target_type="A")
+        counter.inc(2, target_type="A")
+        gauge.set_values([({"kind": "job"}, 3)])
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(10)
+
+        # Then
+        self.assertEqual(registry.render(),
+                         "# HELP test_nodes A gauge\n"
+                         "# TYPE test_nodes gauge\n"
+                         'test_nodes{kind="job"} 3\n'
+                         "# HELP test_seconds A histogram\n"
+                         "# TYPE test_seconds histogram\n"
+                         'test_seconds_bucket{le="1"} 1\n'
+                         'test_seconds_bucket{le="5"} 2\n'
+                         'test_seconds_bucket{le="+Inf"} 3\n'
+                         "test_seconds_count 3\n"
+                         "test_seconds_sum 13.5\n"
+                         "# HELP test_total A counter\n"
+                         "# TYPE test_total counter\n"
+                         'test_total{target_type="A"} 3\n')
+
+    def test_register_twice(self):
+        # Given
+        registry = builder.metrics.Registry()
+
+        # When
+        counter = registry.counter("test_total", "A counter")
+
+        # Then
+        self.assertIs(registry.counter("test_total", "A counter"), counter)
+        self.assertRaises(ValueError, registry.gauge, "test_total", "A gauge")
+
+
+class ExecutionMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        builder.metrics.REGISTRY.clear()
+        builder.metrics.enable()
+
+    def tearDown(self):
+        builder.metrics.disable()
+        builder.metrics.REGISTRY.clear()
+
+    def test_execution_metrics(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"])
+        ]
+        execution_manager = ExecutionManager(BuildManager(jobs, []),
+                                             ExtendedMockExecutor)
+        execution_manager.running = True
+
+        # When
+        execution_manager.submit("B", {})
+        execution_manager.start_execution(inline=True)
+        execution_manager.update_graph_metrics()
+
+        # Then
+        registry = builder.metrics.REGISTRY
+        self.assertEqual(registry.get("builder_job_run_seconds").get_count(), 2)
+        self.assertEqual(registry.get("builder_queue_wait_seconds").get_count(), 2)
+        self.assertEqual(registry.get("builder_add_job_seconds").get_count(), 1)
+        self.assertGreater(registry.get("builder_build_lock_hold_seconds").get_count(), 0)
+        self.assertGreater(registry.get("builder_should_run_recomputations_total").get(), 0)
+        self.assertGreaterEqual(registry.get("builder_target_stat_calls_total").get(
+                target_type="Target"), 2)
+        self.assertEqual(registry.get("builder_graph_nodes").get(kind="job"), 2)
+        self.assertEqual(registry.get("builder_graph_nodes").get(kind="target"), 2)
+        self.assertIn('builder_graph_edges{kind="produces"} 2', registry.render())
@@ -0,0 +1,103 @@
+"""Used to test the process spawner"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import builder.spawner
+from builder.build import BuildManager
+from builder.execution import ExecutionManager, LocalExecutor
+from builder.tests.tests_jobs import *
+
+
+class SpawnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawner = builder.spawner.Spawner()
+
+    def tearDown(self):
+        self.spawner.stop()
+
+    def test_run(self):
+        # When
+        returncode, stdout, stderr = self.spawner.run(["sh", "-c", "echo out; echo err >&2; exit 3"])
+
+        # Then
+        self.assertEqual(returncode, 3)
+        self.assertEqual(stdout, "out\n")
+        self.assertEqual(stderr, "err\n")
+        self.assertNotEqual(self.spawner.get_pid(), os.getpid())
+
+    def test_run_missing_command(self):
+        # When
+        returncode, _, stderr = self.spawner.run(["builder-no-such-command"])
+        next_returncode, _, _ = self.spawner.run(["true"])
+
+        # Then
+        self.assertIsNone(returncode)
+        self.assertIn("Could not start", stderr)
+        self.assertEqual(next_returncode, 0)
+
+    def test_restarts_after_exit(self):
+        # Given
+        self.spawner.start()
+        pid = self.spawner.get_pid()
+        os.kill(pid, 9)
+        self.spawner._process.wait()
+
+        # When
+        returncode, stdout, _ = self.spawner.run(["echo", "again"])
+
+        # Then
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, "again\n")
+        self.assertNotEqual(self.spawner.get_pid(), pid)
+
+    def test_not_rerun_after_exit_while_running(self):
+        # Given
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "runs")
+
+        # When
+        returncode, _, stderr = self.spawner.run(
+            ["sh", "-c", "echo run >> {}; kill -9 $PPID".format(path)])
+        next_returncode, _, _ = self.spawner.run(["true"])
+
+        # Then
+        self.assertIsNone(returncode)
+        self.assertIn("failed running", stderr)
+        with open(path) as f:
+            self.assertEqual(f.read(), "run\n")
+        self.assertEqual(next_returncode, 0)
+
+
+class LocalExecutorSpawnerTest(unittest.TestCase):
+
+    def _execute(self, command, config=None):
+        jobs = [SimpleTestJobDefinition("A", targets=["A-target"], command=command)]
+        build_manager = BuildManager(jobs, metas=[])
+        execution_manager = ExecutionManager(build_manager, LocalExecutor, config=config)
+        execution_manager.build.add_job("A", {})
+        try:
+            return execution_manager.execute("A"), execution_manager.executor
+        finally:
+            if execution_manager.executor.spawner is not None:
+                execution_manager.executor.spawner.stop()
+
+    def test_shell_command(self):
+        # When
+        result, executor = self._execute("echo spawned")
+
+        # Then
+        self.assertTrue(result.status)
+        self.assertEqual(result.stdout, "spawned\n")
+
+    def test_shell_command_without_spawner(self):
+        # When
+        result, executor = self._execute("false", config={"use_spawner": False})
+
+        # Then
+        self.assertFalse(result.status)
+        self.assertIsNone(executor.spawner)
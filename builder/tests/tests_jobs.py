@@ -15,9 +15,13 @@ import builder.expanders
 
 class FakeTarget(builder.targets.Target):
 
+    def do_get_mtime(self):
+        return self.mtime
+
     @staticmethod
     def get_bulk_exists_mtime(targets):
-        return {target.get_id(): {"exists": target.mtime is not None, "mtime": target.mtime} for target in targets}
+        mtimes = {target.get_id(): target.do_get_mtime() for target in targets}
+        return {target_id: {"exists": mtime is not None, "mtime": mtime} for target_id, mtime in mtimes.iteritems()}
 
 
 def new_expand_wrapper(old_expand, target_mtime):
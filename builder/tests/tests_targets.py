@@ -2,11 +2,17 @@
 build api specifically the target ones
 """
 
+import collections
 import fnmatch
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import mock
 
+import builder.objectstore
 import builder.targets
 
 
@@ -283,3 +289,252 @@ class GlobLocalFileSystemTargetTest(unittest.TestCase):
         self.assertEqual(file2_mtime, None)
 
 
+class ObjectStoreTargetTest(unittest.TestCase):
+    """Used to test the object store targets against a directory backed
+    object store
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = {
+            "bucket/logs/2015/a.gz": 1,
+            "bucket/logs/2015/b.gz": 3,
+            "bucket/logs/2015/c.txt": 5,
+            "bucket/logs/2016/a.gz": 7,
+            "bucket/top.gz": 9,
+        }
+        for path, mtime in self.files.iteritems():
+            local_path = os.path.join(self.root, *path.split("/"))
+            if not os.path.exists(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            open(local_path, "w").close()
+            os.utime(local_path, (mtime, mtime))
+
+        self.client = builder.objectstore.LocalDirectoryObjectStoreClient(
+                self.root)
+        self.client.list_objects = mock.Mock(
+                wraps=self.client.list_objects)
+        self.client.head_object = mock.Mock(wraps=self.client.head_object)
+        pool = builder.objectstore.ObjectStoreConnectionPool(
+                lambda: self.client, max_size=2, page_size=2)
+
+        class TestObjectStoreTarget(builder.targets.ObjectStoreTarget):
+            connection_pool = pool
+
+        class TestGlobObjectStoreTarget(
+                builder.targets.GlobObjectStoreTarget):
+            connection_pool = pool
+
+        self.target_type = TestObjectStoreTarget
+        self.glob_target_type = TestGlobObjectStoreTarget
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_list_objects_pagination(self):
+        # when
+        page1, marker1 = self.client.list_objects("bucket", "logs/",
+                                                  max_keys=2)
+        page2, marker2 = self.client.list_objects("bucket", "logs/",
+                                                  marker=marker1, max_keys=2)
+        all_objects = list(self.client.iter_objects("bucket", "logs/2015/",
+                                                    page_size=1))
+
+        # then
+        self.assertEqual(page1, [("logs/2015/a.gz", 1), ("logs/2015/b.gz", 3)])
+        self.assertEqual(page2, [("logs/2015/c.txt", 5), ("logs/2016/a.gz", 7)])
+        self.assertIsNone(marker2)
+        self.assertEqual([x[0] for x in all_objects],
+                         ["logs/2015/a.gz", "logs/2015/b.gz", "logs/2015/c.txt"])
+
+    def test_list_objects_delimiter(self):
+        # when
+        root_objects, _ = self.client.list_objects("bucket", "",
+                                                   delimiter="/")
+        logs_objects, _ = self.client.list_objects("bucket", "logs/",
+                                                   delimiter="/")
+        year_objects = list(self.client.iter_objects(
+                "bucket", "logs/2015/", page_size=1, delimiter="/"))
+
+        # then
+        self.assertEqual(root_objects, [("top.gz", 9)])
+        self.assertEqual(logs_objects, [])
+        self.assertEqual([x[0] for x in year_objects],
+                         ["logs/2015/a.gz", "logs/2015/b.gz", "logs/2015/c.txt"])
+
+    def test_iter_objects_walks_once(self):
+        # given
+        self.client._get_keys = mock.Mock(wraps=self.client._get_keys)
+
+        # when
+        all_objects = list(self.client.iter_objects("bucket", "logs/",
+                                                    page_size=1))
+
+        # then
+        self.assertEqual(len(all_objects), 4)
+        self.assertEqual(self.client.list_objects.call_count, 4)
+        self.assertEqual(self.client._get_keys.call_count, 1)
+
+    def test_get_mtime(self):
+        # given
+        target1 = self.target_type("logs", "s3://bucket/logs/2015/b.gz", {})
+        target2 = self.target_type("logs", "bucket/logs/2015/missing.gz", {})
+
+        # when
+        mtime1 = target1.get_mtime()
+        mtime2 = target2.get_mtime()
+
+        # then
+        self.assertEqual(mtime1, 3)
+        self.assertIsNone(mtime2)
+        self.assertFalse(self.client.list_objects.called)
+
+    def test_get_bulk_exists_mtime(self):
+        # given
+        ids = [
+            "bucket/logs/2015/a.gz",
+            "bucket/logs/2015/b.gz",
+            "bucket/logs/2015/missing.gz",
+            "bucket/logs/2016/a.gz",
+        ]
+        targets = [self.target_type("logs", x, {}) for x in ids]
+
+        # when
+        exists_mtime = self.target_type.get_bulk_exists_mtime(targets)
+
+        # then
+        self.assertEqual(exists_mtime["bucket/logs/2015/a.gz"],
+                         {"exists": True, "mtime": 1})
+        self.assertEqual(exists_mtime["bucket/logs/2015/b.gz"],
+                         {"exists": True, "mtime": 3})
+        self.assertEqual(exists_mtime["bucket/logs/2015/missing.gz"],
+                         {"exists": False, "mtime": None})
+        self.assertEqual(exists_mtime["bucket/logs/2016/a.gz"],
+                         {"exists": True, "mtime": 7})
+        # 2015 is listed in two pages, 2016 only has one target so it is
+        # answered with a head request
+        self.assertEqual(self.client.list_objects.call_count, 2)
+        self.assertIn(mock.call("bucket", "logs/2016/a.gz"),
+                      self.client.head_object.call_args_list)
+
+    def test_glob_get_bulk_exists_mtime(self):
+        # given
+        glob1 = self.glob_target_type("logs", "bucket/logs/*/*.gz", {})
+        glob2 = self.glob_target_type("logs", "bucket/logs/2015/*.csv", {})
+
+        # when
+        exists_mtime = self.glob_target_type.get_bulk_exists_mtime(
+                [glob1, glob2])
+        glob_mtime = glob1.get_mtime()
+
+        # then
+        self.assertEqual(exists_mtime["bucket/logs/*/*.gz"],
+                         {"exists": True, "mtime": 7})
+        self.assertEqual(exists_mtime["bucket/logs/2015/*.csv"],
+                         {"exists": False, "mtime": None})
+        self.assertEqual(glob_mtime, 7)
+
+    def test_glob_matches_one_segment_at_a_time(self):
+        # given
+        glob1 = self.glob_target_type("logs", "bucket/logs/*.gz", {})
+        glob2 = self.glob_target_type("logs", "bucket/*.gz", {})
+        glob3 = self.glob_target_type("logs", "bucket/logs/2015/?.gz", {})
+
+        # when
+        exists_mtime = self.glob_target_type.get_bulk_exists_mtime(
+                [glob1, glob2, glob3])
+
+        # then
+        self.assertEqual(exists_mtime["bucket/logs/*.gz"],
+                         {"exists": False, "mtime": None})
+        self.assertEqual(exists_mtime["bucket/*.gz"],
+                         {"exists": True, "mtime": 9})
+        self.assertEqual(exists_mtime["bucket/logs/2015/?.gz"],
+                         {"exists": True, "mtime": 3})
+
+    def test_missing_connection_pool(self):
+        # given
+        target = builder.targets.ObjectStoreTarget(
+                "logs", "bucket/logs/2015/a.gz", {})
+
+        # then
+        self.assertRaises(RuntimeError, target.get_mtime)
+
+
+class BulkExistsMtimeParallelTest(unittest.TestCase):
+    """Used to test refreshing targets of many types at once"""
+
+    def test_types_refresh_concurrently(self):
+        # given
+        local_done = threading.Event()
+
+        class SlowTarget(builder.targets.Target):
+            @staticmethod
+            def get_bulk_exists_mtime(targets):
+                # Only finishes if the local targets are refreshed while
+                # this one is still running
+                local_done.wait(5)
+                return {x.unique_id: {"exists": local_done.is_set(),
+                                      "mtime": 1} for x in targets}
+
+        class QuickTarget(builder.targets.Target):
+            bulk_chunk_size = 2
+
+            @staticmethod
+            def get_bulk_exists_mtime(targets):
+                if len(targets) > 2:
+                    raise AssertionError("targets were not chunked")
+                local_done.set()
+                return {x.unique_id: {"exists": True, "mtime": 2}
+                        for x in targets}
+
+        slow_target = SlowTarget("slow", "slow", {})
+        quick_targets = [QuickTarget("quick", "quick{}".format(i), {})
+                         for i in xrange(5)]
+
+        # when
+        exists_mtime, timings = builder.targets.get_bulk_exists_mtime_parallel(
+                [slow_target] + quick_targets, max_workers=2)
+
+        # then
+        self.assertEqual(exists_mtime["slow"], {"exists": True, "mtime": 1})
+        for i in xrange(5):
+            self.assertEqual(exists_mtime["quick{}".format(i)]["mtime"], 2)
+        self.assertEqual(set(timings), {SlowTarget, QuickTarget})
+        self.assertFalse(slow_target.is_cached())
+
+    def test_chunk_size(self):
+        # given
+        chunks = collections.defaultdict(list)
+
+        class ChunkedTarget(builder.targets.Target):
+            bulk_chunk_size = 3
+
+            @staticmethod
+            def get_bulk_exists_mtime(targets):
+                chunks[ChunkedTarget].append(len(targets))
+                return {}
+
+        class UnchunkedTarget(builder.targets.Target):
+            bulk_chunk_size = None
+
+            @staticmethod
+            def get_bulk_exists_mtime(targets):
+                chunks[UnchunkedTarget].append(len(targets))
+                return {}
+
+        targets = ([ChunkedTarget("c", "c{}".format(i), {}) for i in xrange(5)]
+                   + [UnchunkedTarget("u", "u{}".format(i), {}) for i in xrange(5)])
+
+        # when
+        builder.targets.get_bulk_exists_mtime_parallel(
+                targets, max_workers=1, chunk_size=2)
+        chunks_by_size = dict(chunks)
+        chunks.clear()
+        builder.targets.get_bulk_exists_mtime_parallel(
+                targets, max_workers=1, chunk_size=10)
+
+        # then
+        self.assertEqual(chunks_by_size[ChunkedTarget], [2, 2, 1])
+        self.assertEqual(chunks_by_size[UnchunkedTarget], [5])
+        self.assertEqual(chunks[ChunkedTarget], [3, 2])
+        self.assertEqual(chunks[UnchunkedTarget], [5])
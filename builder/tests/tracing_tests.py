@@ -0,0 +1,105 @@
+"""Used to test the sampled span tracing"""
+
+import json
+import threading
+import unittest
+
+import mock
+
+import builder.tracing
+from builder.build import BuildManager
+from builder.execution import ExecutionManager
+from builder.tests.tests_jobs import *
+from builder.tests.execution_tests import ExtendedMockExecutor
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_disabled_tracer_records_nothing(self):
+        # Given
+        tracer = builder.tracing.Tracer()
+
+        @tracer.traced()
+        def f():
+            return 1
+
+        # When
+        with tracer.span("a"):
+            value = f()
+
+        # Then
+        self.assertEqual(value, 1)
+        self.assertEqual(tracer.get_chrome_trace()["traceEvents"], [])
+
+    def test_sampling_follows_root(self):
+        # Given
+        tracer = builder.tracing.Tracer(sample_rate=0.5)
+
+        @tracer.traced("child")
+        def child():
+            pass
+
+        # When
+        with mock.patch("random.random", side_effect=[0.1, 0.9]):
+            with tracer.span("sampled", n=1):
+                child()
+            with tracer.span("not_sampled"):
+                child()
+
+        # Then
+        events = tracer.get_chrome_trace()["traceEvents"]
+        self.assertItemsEqual([x["name"] for x in events], ["sampled", "child"])
+        sampled = [x for x in events if x["name"] == "sampled"][0]
+        self.assertEqual(sampled["ph"], "X")
+        self.assertEqual(sampled["args"], {"n": 1})
+        self.assertEqual(sampled["tid"], threading.current_thread().ident)
+
+    def test_ring_buffer(self):
+        # Given
+        tracer = builder.tracing.Tracer(sample_rate=1, buffer_size=2)
+
+        # When
+        for name in ("a", "b", "c"):
+            with tracer.span(name):
+                pass
+        try:
+            with tracer.span("error"):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        # Then
+        events = tracer.get_chrome_trace()["traceEvents"]
+        self.assertEqual([x["name"] for x in events], ["c", "error"])
+        self.assertEqual(events[1]["args"], {"error": "ValueError"})
+
+    def test_execution_spans(self):
+        # Given
+        jobs = [
+            EffectJobDefinition("A", depends=None, targets=["A-target"]),
+            EffectJobDefinition("B", depends=["A-target"], targets=["B-target"])
+        ]
+        execution_manager = ExecutionManager(BuildManager(jobs, []),
+                                             ExtendedMockExecutor)
+        execution_manager.running = True
+        builder.tracing.clear()
+        builder.tracing.configure(sample_rate=1)
+
+        # When
+        try:
+            execution_manager.submit("B", {})
+            execution_manager.start_execution(inline=True)
+        finally:
+            builder.tracing.configure(sample_rate=0)
+        trace = builder.tracing.get_chrome_trace()
+        builder.tracing.clear()
+
+        # Then
+        names = set(x["name"] for x in trace["traceEvents"])
+        self.assertTrue({"ExecutionManager.submit", "BuildGraph.add_job",
+                         "BuildGraph._self_expand",
+                         "ExecutionManager.update_targets",
+                         "ExecutionManager.update_parents_should_run",
+                         "ExecutionManager.get_next_jobs_to_run",
+                         "ExecutionManager.execute"} <= names)
+        json.dumps(trace)
@@ -0,0 +1,157 @@
+"""Used to test the warm worker pool"""
+
+import functools
+import os
+import sys
+import unittest
+
+import builder.workers
+from builder.build import BuildManager
+from builder.execution import ExecutionManager, LocalExecutor
+from builder.tests.tests_jobs import *
+
+
+def greet(name):
+    print "hello", name
+
+
+def fail():
+    sys.stderr.write("about to fail\n")
+    raise ValueError("failed")
+
+
+def exit_worker():
+    os._exit(1)
+
+
+def print_pid():
+    print os.getpid()
+
+
+_HELD = []
+
+
+def hold_memory(n_bytes):
+    _HELD.append(" " * n_bytes)
+
+
+def print_held():
+    print len(_HELD)
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = builder.workers.WorkerPool(size=1)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_run(self):
+        # When
+        status, stdout, stderr = self.pool.run(functools.partial(greet, "world"))
+
+        # Then
+        self.assertTrue(status)
+        self.assertEqual(stdout, "hello world\n")
+        self.assertEqual(stderr, "")
+
+    def test_run_failure(self):
+        # When
+        status, stdout, stderr = self.pool.run(fail)
+
+        # Then
+        self.assertFalse(status)
+        self.assertIn("about to fail", stderr)
+        self.assertIn("ValueError: failed", stderr)
+
+    def test_run_unpicklable(self):
+        # When
+        status, _, stderr = self.pool.run(lambda: None)
+
+        # Then
+        self.assertFalse(status)
+        self.assertIn("Could not send", stderr)
+        self.assertEqual(self.pool.n_recycled, 0)
+
+    def test_worker_exits(self):
+        # When
+        status, _, _ = self.pool.run(exit_worker)
+        next_status, _, _ = self.pool.run(functools.partial(greet, "again"))
+
+        # Then
+        self.assertFalse(status)
+        self.assertTrue(next_status)
+        self.assertEqual(self.pool.n_recycled, 1)
+
+    def test_workers_are_reused_and_recycled(self):
+        # Given
+        pool = builder.workers.WorkerPool(size=1, max_jobs=2)
+
+        # When
+        try:
+            pids = [pool.run(print_pid)[1] for _ in xrange(4)]
+        finally:
+            pool.shutdown()
+
+        # Then
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertNotIn(str(os.getpid()) + "\n", pids)
+        self.assertEqual(pool.n_recycled, 2)
+
+    def test_max_rss_counts_growth_since_start(self):
+        # Given
+        pool = builder.workers.WorkerPool(size=1, max_rss=32 * 1024 * 1024)
+
+        # When
+        try:
+            pids = [pool.run(print_pid)[1] for _ in xrange(2)]
+            n_recycled_before = pool.n_recycled
+            pool.run(functools.partial(hold_memory, 64 * 1024 * 1024))
+            next_pid = pool.run(print_pid)[1]
+        finally:
+            pool.shutdown()
+
+        # Then
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(n_recycled_before, 0)
+        self.assertEqual(pool.n_recycled, 1)
+        self.assertNotEqual(next_pid, pids[1])
+
+    def test_workers_are_new_interpreters(self):
+        # Given
+        hold_memory(1)
+
+        # When
+        try:
+            status, stdout, stderr = self.pool.run(print_held)
+        finally:
+            del _HELD[:]
+
+        # Then
+        self.assertTrue(status, stderr)
+        self.assertEqual(stdout, "0\n")
+
+
+class LocalExecutorWorkerTest(unittest.TestCase):
+
+    def test_callable_command(self):
+        # Given
+        jobs = [SimpleTestJobDefinition("A", targets=["A-target"],
+                                        command=functools.partial(greet, "A"))]
+        build_manager = BuildManager(jobs, metas=[])
+        execution_manager = ExecutionManager(build_manager, LocalExecutor)
+        execution_manager.build.add_job("A", {})
+
+        # When
+        try:
+            result = execution_manager.execute("A")
+        finally:
+            execution_manager.executor.worker_pool.shutdown()
+
+        # Then
+        self.assertTrue(result.status)
+        self.assertEqual(result.stdout, "hello A\n")
+        self.assertEqual(execution_manager._complete_queue.get_nowait(), "A")
@@ -0,0 +1,160 @@
+"""Sampled span tracing for the hot paths of the build
+
+A span records the time spent in a with block or in a call to a function
+decorated with traced. Sampling is decided when the outermost span on a
+thread starts and spans started inside it follow that decision, so a sampled
+trace always holds every span below its root. Finished spans are kept in a
+fixed size ring buffer and can be dumped in the Chrome trace event format,
+which can be loaded in to chrome://tracing.
+
+Tracing is disabled by default. While disabled starting a span costs a
+single attribute lookup.
+
+    builder.tracing.configure(sample_rate=0.01)
+
+    with builder.tracing.span("refresh", n_targets=len(targets)):
+        ...
+"""
+
+import collections
+import functools
+import os
+import random
+import threading
+import time
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ("tracer", "name", "args", "sampled", "start")
+
+    def __init__(self, tracer, name, args, sampled):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.sampled = sampled
+        self.start = None
+
+    def __enter__(self):
+        self.tracer._local.stack.append(self.sampled)
+        if self.sampled:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._local.stack.pop()
+        if self.sampled:
+            args = self.args
+            if exc_type is not None:
+                args = dict(args, error=exc_type.__name__)
+            self.tracer._record(self.name, self.start, time.time(), args)
+
+
+class _ThreadState(threading.local):
+    def __init__(self):
+        self.stack = []
+
+
+class Tracer(object):
+    """Records sampled spans in to a ring buffer
+
+    args:
+        sample_rate: The fraction of root spans to record, 0 disables
+            tracing
+        buffer_size: The number of spans to keep
+    """
+    def __init__(self, sample_rate=0.0, buffer_size=10000):
+        self.sample_rate = sample_rate
+        self.events = collections.deque(maxlen=buffer_size)
+        self._local = _ThreadState()
+        self._pid = os.getpid()
+
+    def configure(self, sample_rate=None, buffer_size=None):
+        if buffer_size is not None and buffer_size != self.events.maxlen:
+            self.events = collections.deque(self.events, maxlen=buffer_size)
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def span(self, name, **args):
+        """Returns a context manager that records the time spent in its with
+        block if the trace it is part of is sampled
+        """
+        if not self.sample_rate:
+            return _NULL_SPAN
+        stack = self._local.stack
+        if stack:
+            sampled = stack[-1]
+        else:
+            sampled = random.random() < self.sample_rate
+        return _Span(self, name, args, sampled)
+
+    def traced(self, name=None):
+        """Decorates a function so every call is a span named name, the
+        function's name by default
+        """
+        def decorator(f):
+            span_name = name or f.__name__
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.sample_rate:
+                    return f(*args, **kwargs)
+                with self.span(span_name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _record(self, name, start, stop, args):
+        # deque.append is atomic so no lock is needed
+        self.events.append((name, start, stop, threading.current_thread().ident, args))
+
+    def clear(self):
+        self.events.clear()
+
+    def get_chrome_trace(self):
+        """Returns the recorded spans as a dict in the Chrome trace event
+        format
+        """
+        trace_events = []
+        for name, start, stop, thread_id, args in list(self.events):
+            trace_events.append({
+                "name": name,
+                "cat": "builder",
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int((stop - start) * 1e6),
+                "pid": self._pid,
+                "tid": thread_id,
+                "args": args,
+            })
+        trace_events.sort(key=lambda x: x["ts"])
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+
+TRACER = Tracer()
+
+
+def configure(sample_rate=None, buffer_size=None):
+    TRACER.configure(sample_rate=sample_rate, buffer_size=buffer_size)
+
+def span(name, **args):
+    return TRACER.span(name, **args)
+
+def traced(name=None):
+    return TRACER.traced(name)
+
+def get_chrome_trace():
+    return TRACER.get_chrome_trace()
+
+def clear():
+    TRACER.clear()
@@ -6,10 +6,6 @@ import datetime as dt
 
 import dateutil as du
 import arrow
-try:
-    import pandas as pd
-except ImportError:
-    pd = None
 
 def _parse_frequency(freq):
     '''
@@ -106,6 +102,9 @@ class BuilderArrowFactory(arrow.ArrowFactory):
         start_inclusive=start_inclusive, end_inclusive=end_inclusive)
 
     def get(self, *args, **kwargs):
+        # pandas is slow to import and only needs to be checked for if it has
+        # already been imported by whoever is passing in the timestamp
+        pd = sys.modules.get("pandas")
         if pd is not None and len(args) == 1 and isinstance(args[0], pd.Timestamp):
             return super(BuilderArrowFactory, self).get(args[0])
         elif len(args) == 1 and isinstance(
@@ -160,6 +159,7 @@ class BuilderArrow(arrow.Arrow):
 
     @property
     def pandas(self):
+        import pandas as pd
         return pd.Timestamp(self.datetime)
 
 arrow_factory = BuilderArrowFactory(BuilderArrow)
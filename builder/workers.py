@@ -0,0 +1,243 @@
+"""A pool of long lived worker processes that run python callable commands
+
+A job definition can return a callable from get_command instead of a shell
+string. LocalExecutor runs callables in a worker from the pool so the cost
+of starting an interpreter and importing modules is only paid when a worker
+starts and not for every job.
+
+Workers are new interpreters started the same way as the spawner, they are
+not forked from the daemon. Forking would copy the daemon's build graph in to
+every worker and risk deadlocking on locks held by the daemon's other threads.
+A worker gets the daemon's sys.path and imports the preload modules before
+taking any work. A worker is replaced after it has run max_jobs jobs or when
+its resident set size has grown by more than max_rss bytes since it started.
+
+The callable and its result are pickled to and from the worker over its
+stdin and stdout, use module level functions or functools.partial objects of
+them and not functions defined in __main__. A call succeeds if it returns
+without raising, anything it prints is returned as its stdout and stderr.
+
+    pool = builder.workers.WorkerPool(size=4, preload=["pandas"])
+    status, stdout, stderr = pool.run(functools.partial(aggregate, day))
+"""
+
+import cPickle
+import importlib
+import os
+import Queue
+import resource
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from StringIO import StringIO
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+def _get_rss():
+    """Returns the resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        pass
+    # Without /proc fall back to the peak, OS X reports bytes and others
+    # kilobytes
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return peak_rss
+
+
+def _call(command):
+    """Calls command and returns its status, stdout and stderr"""
+    stdout, stderr = StringIO(), StringIO()
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        command()
+        status = True
+    except Exception:
+        traceback.print_exc()
+        status = False
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+    return status, stdout.getvalue(), stderr.getvalue()
+
+
+def _load_and_call(data):
+    """Unpickles the command in data and calls it"""
+    try:
+        command = cPickle.loads(data)
+    except Exception:
+        return False, "", "Could not load the command:\n{}".format(
+            traceback.format_exc())
+    return _call(command)
+
+
+def _serve(requests, responses):
+    """Runs the commands read from requests until it is closed or the worker
+    should be recycled
+
+    The first request is (sys.path, preload, max_jobs, max_rss), every
+    request after it is a pickled command.
+    """
+    try:
+        path, preload, max_jobs, max_rss = cPickle.load(requests)
+    except EOFError:
+        return
+    sys.path[:] = path
+    for module in preload:
+        importlib.import_module(module)
+    baseline_rss = _get_rss()
+
+    n_jobs = 0
+    while True:
+        try:
+            data = cPickle.load(requests)
+        except EOFError:
+            return
+
+        status, stdout, stderr = _load_and_call(data)
+        n_jobs += 1
+        recycle = ((max_jobs is not None and n_jobs >= max_jobs)
+                   or (max_rss is not None
+                       and _get_rss() - baseline_rss > max_rss))
+        cPickle.dump((status, stdout, stderr, recycle), responses,
+                     cPickle.HIGHEST_PROTOCOL)
+        responses.flush()
+        if recycle:
+            return
+
+
+def main():
+    requests = sys.stdin
+    # Keep anything written to stdout off of the response pipe
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    _serve(requests, responses)
+
+
+class Worker(object):
+    """A worker process and the pipes used to send it commands"""
+
+    def __init__(self, preload=(), max_jobs=None, max_rss=None):
+        path = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        self.process = subprocess.Popen(
+                [sys.executable, path], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, close_fds=True)
+        cPickle.dump((list(sys.path), list(preload), max_jobs, max_rss),
+                     self.process.stdin, cPickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+        self.n_jobs = 0
+
+    def run(self, command):
+        """Runs command in the worker, returns its status, stdout, stderr and
+        whether the worker has exited and must be replaced
+        """
+        self.n_jobs += 1
+        # Pickle the command before writing anything so that a command that
+        # can not be pickled does not leave half a request on the pipe
+        try:
+            data = cPickle.dumps(command, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError) as e:
+            return False, "", "Could not send {!r}: {}".format(command, e), False
+        try:
+            cPickle.dump(data, self.process.stdin, cPickle.HIGHEST_PROTOCOL)
+            self.process.stdin.flush()
+            return cPickle.load(self.process.stdout)
+        except (EOFError, IOError) as e:
+            return (False, "", "Worker {} exited: {}".format(self.process.pid, e),
+                    True)
+
+    def stop(self, timeout=1):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+class WorkerPool(object):
+    """A fixed number of warm workers, commands are run by the first idle one
+
+    args:
+        size: The number of workers
+        preload: The names of modules every worker imports when it starts
+        max_jobs: Replace a worker after it has run this many jobs, None to
+            never replace workers for the number of jobs they have run
+        max_rss: Replace a worker once its resident set size has grown by more
+            than this many bytes since it started, None for no limit
+    """
+    def __init__(self, size=1, preload=(), max_jobs=None, max_rss=None):
+        self.size = size
+        self.preload = list(preload)
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.n_jobs = 0
+        self.n_recycled = 0
+        self._lock = threading.Lock()
+        self._idle = Queue.Queue()
+        self._workers = []
+        self._started = False
+
+    def _new_worker(self):
+        return Worker(self.preload, max_jobs=self.max_jobs, max_rss=self.max_rss)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            for _ in xrange(self.size):
+                worker = self._new_worker()
+                self._workers.append(worker)
+                self._idle.put(worker)
+            self._started = True
+
+    def run(self, command):
+        """Runs command in a worker, blocks until it is done and returns its
+        status, stdout and stderr
+        """
+        self.start()
+        worker = self._idle.get()
+        status, stdout, stderr, recycle = worker.run(command)
+        with self._lock:
+            self.n_jobs += 1
+            if recycle:
+                LOG.debug("Replacing worker {} after {} jobs".format(
+                    worker.process.pid, worker.n_jobs))
+                worker.stop()
+                self._workers.remove(worker)
+                worker = self._new_worker()
+                self._workers.append(worker)
+                self.n_recycled += 1
+        self._idle.put(worker)
+        return status, stdout, stderr
+
+    def shutdown(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+            self._workers = []
+            self._idle = Queue.Queue()
+            self._started = False
+
+    def get_status(self):
+        return {
+            "size": self.size,
+            "n_jobs": self.n_jobs,
+            "n_recycled": self.n_recycled,
+        }
+
+
+if __name__ == "__main__":
+    main()